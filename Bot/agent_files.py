@@ -1,16 +1,91 @@
 import os
+import time
+import logging
 import html
-from typing import Optional, Set
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from aiogram.types import Message
 
 from .llm import upload_file_to_vector_store
-from .llm import delete_file_from_vector_store
+from .llm import delete_file_from_vector_store, list_vector_store_files
 from .db import db
+from .routing import extract_keywords, message_router
+from .tenants import TenantLocal
+
+logger = logging.getLogger(__name__)
+
+KB_DELETE_CONCURRENCY = int(os.getenv("KB_DELETE_CONCURRENCY", "4"))
+# Файл попадает в vector store раньше, чем в agent_files: свежие файлы сверка не трогает.
+KB_RECONCILE_GRACE_SECONDS = int(os.getenv("KB_RECONCILE_GRACE_SECONDS", "600"))
+
+
+class ReconcileReport:
+    def __init__(self, vector_store_id: str, store_files: int, db_files: int):
+        self.vector_store_id = vector_store_id
+        self.store_files = store_files
+        self.db_files = db_files
+        self.missing_in_store: list = []
+        self.missing_in_db: List[str] = []
+        self.other_store: list = []
+        self.skipped_recent = 0
+        self.dry_run = True
+        self.repaired_db = 0
+        self.repaired_store = 0
+        self.failed = 0
+
+    @property
+    def clean(self) -> bool:
+        return not self.missing_in_store and not self.missing_in_db
+
+    def format(self, limit: int = 10) -> str:
+        lines = [
+            f"Сверка базы знаний с vector store <code>{html.escape(self.vector_store_id)}</code>",
+            f"Файлов в vector store: {self.store_files}, в базе: {self.db_files}",
+            "",
+            f"Есть в базе, нет в vector store: {len(self.missing_in_store)}",
+        ]
+        for row in self.missing_in_store[:limit]:
+            lines.append(f"  • {row['id']}. {html.escape(row['filename'])}")
+        if len(self.missing_in_store) > limit:
+            lines.append(f"  … и ещё {len(self.missing_in_store) - limit}")
+
+        lines.append(f"Есть в vector store, нет в базе: {len(self.missing_in_db)}")
+        for file_id in self.missing_in_db[:limit]:
+            lines.append(f"  • <code>{html.escape(file_id)}</code>")
+        if len(self.missing_in_db) > limit:
+            lines.append(f"  … и ещё {len(self.missing_in_db) - limit}")
+
+        if self.skipped_recent:
+            lines.append(f"Пропущено свежих файлов (загрузка может быть не завершена): {self.skipped_recent}")
+        if self.other_store:
+            lines.append(
+                f"Записей другого vector store (не сверяются и не удаляются): {len(self.other_store)}"
+            )
+            for row in self.other_store[:limit]:
+                store = html.escape(row["vector_store_id"] or "не указан")
+                lines.append(f"  • {row['id']}. {html.escape(row['filename'])} — <code>{store}</code>")
+            if len(self.other_store) > limit:
+                lines.append(f"  … и ещё {len(self.other_store) - limit}")
+
+        lines.append("")
+        if self.clean:
+            lines.append("Расхождений нет.")
+        elif self.dry_run:
+            lines.append("Это пробный прогон, ничего не изменено.")
+        else:
+            lines.append(
+                f"Удалено записей из базы: {self.repaired_db}, "
+                f"файлов из vector store: {self.repaired_store}, ошибок: {self.failed}"
+            )
+        return "\n".join(lines)
 
 
 class AgentFileManager:
     def __init__(self):
         self.waiting_for_file_upload: Set[int] = set()
+        # Отмеченные для массового удаления файлы, по админам.
+        self.selected: Dict[int, Set[int]] = {}
     
     def is_waiting_for_file(self, user_id: int) -> bool:
         return user_id in self.waiting_for_file_upload
@@ -45,8 +120,8 @@ class AgentFileManager:
             save_path = os.path.join(tmp_dir, filename)
 
             await message.bot.download_file(file_path, save_path)
-        except Exception as e:
-            print("Ошибка при скачивании файла:", e)
+        except Exception:
+            logger.exception("Ошибка при скачивании файла %s", filename)
             return "Ошибка при загрузке файла из Telegram."
 
         openai_file_id = None
@@ -54,6 +129,7 @@ class AgentFileManager:
             openai_file_id = await upload_file_to_vector_store(save_path, vector_store_id)
             if not openai_file_id:
                 return "Не удалось загрузить файл в vector store."
+            keywords = await asyncio.to_thread(extract_keywords, filename, save_path, mime_type)
         finally:
             try:
                 os.remove(save_path)
@@ -67,7 +143,9 @@ class AgentFileManager:
             vector_store_id=vector_store_id,
             mime_type=mime_type,
             file_size=file_size,
+            keywords=keywords,
         )
+        await message_router.load()
 
         self.clear_waiting_for_file(message.from_user.id)
         return (
@@ -94,7 +172,7 @@ class AgentFileManager:
     
 
     async def delete_file(self, file_id: int) -> bool:
-        row = await db.get_agent_file(file_id)
+        row = await db.get_agent_file(file_id, primary=True)
         if not row:
             return False
 
@@ -108,10 +186,108 @@ class AgentFileManager:
             )
 
         await db.delete_agent_file(file_id)
+        await message_router.load()
         return True
 
     async def get_recent_files(self, limit: int = 10, offset: int = 0):
         return await db.list_agent_files(limit=limit, offset=offset)
 
+    def toggle_selected(self, admin_id: int, file_id: int) -> Set[int]:
+        selected = self.selected.setdefault(admin_id, set())
+        selected.symmetric_difference_update({file_id})
+        return selected
+
+    def get_selected(self, admin_id: int) -> Set[int]:
+        return self.selected.get(admin_id, set())
+
+    def clear_selected(self, admin_id: int) -> None:
+        self.selected.pop(admin_id, None)
+
+    async def _delete_remote(self, items: Iterable[Tuple[str, str]]) -> List[bool]:
+        semaphore = asyncio.Semaphore(KB_DELETE_CONCURRENCY)
+
+        async def delete_one(vector_store_id: str, openai_file_id: str) -> bool:
+            async with semaphore:
+                return await delete_file_from_vector_store(
+                    vector_store_id=vector_store_id,
+                    file_id=openai_file_id,
+                )
+
+        return await asyncio.gather(*(delete_one(vs, f) for vs, f in items))
+
+    async def _delete_rows(self, rows: list) -> Tuple[int, int]:
+        remote = [row for row in rows if row["openai_file_id"] and row["vector_store_id"]]
+        results = await self._delete_remote((row["vector_store_id"], row["openai_file_id"]) for row in remote)
+
+        # Записи, чей файл не удалось удалить в OpenAI, оставляем — их подберёт повтор или сверка.
+        failed_ids = {row["id"] for row, ok in zip(remote, results) if not ok}
+        to_delete = [row["id"] for row in rows if row["id"] not in failed_ids]
+
+        deleted = await db.delete_agent_files(to_delete) if to_delete else 0
+        if deleted:
+            await message_router.load()
+        return deleted, len(failed_ids)
+
+    async def delete_files(self, file_ids: Iterable[int]) -> Tuple[int, int]:
+        """Удаляет несколько файлов; возвращает (удалено, ошибок)."""
+        rows = await db.get_agent_files(list(file_ids), primary=True)
+        return await self._delete_rows(rows)
+
+    async def list_files_older_than(self, days: int) -> list:
+        before = datetime.now(timezone.utc) - timedelta(days=days)
+        return await db.list_agent_files_before(before, primary=True)
+
+    async def delete_files_older_than(self, days: int) -> Tuple[int, int]:
+        return await self._delete_rows(await self.list_files_older_than(days))
+
+    async def reconcile(self, vector_store_id: str, dry_run: bool = True) -> ReconcileReport:
+        """
+        Сравнивает файлы vector store с записями agent_files этого же store. Записи без файла
+        в vector store и файлы без записи в базе удаляются, если dry_run выключен.
+        Записи других vector store только показываются в отчёте.
+        """
+        store_files, rows, other_rows = await asyncio.gather(
+            list_vector_store_files(vector_store_id),
+            db.list_agent_file_refs(vector_store_id, primary=True),
+            db.list_agent_file_refs_outside(vector_store_id, primary=True),
+        )
+
+        store_ids = {file_id for file_id, _ in store_files}
+        # Файл, на который ссылается запись любого store, сиротой не считаем.
+        db_ids = {row["openai_file_id"] for row in (*rows, *other_rows) if row["openai_file_id"]}
+        grace_cutoff = time.time() - KB_RECONCILE_GRACE_SECONDS
+
+        report = ReconcileReport(vector_store_id, len(store_files), len(rows))
+        report.other_store = list(other_rows)
+        report.missing_in_store = [row for row in rows if row["openai_file_id"] not in store_ids]
+        for file_id, created_at in store_files:
+            if file_id in db_ids:
+                continue
+            if created_at >= grace_cutoff:
+                report.skipped_recent += 1
+            else:
+                report.missing_in_db.append(file_id)
+
+        report.dry_run = dry_run
+        if dry_run or report.clean:
+            return report
+
+        if report.missing_in_store:
+            report.repaired_db, failed = await self._delete_rows(report.missing_in_store)
+            report.failed += failed
+
+        if report.missing_in_db:
+            results = await self._delete_remote((vector_store_id, file_id) for file_id in report.missing_in_db)
+            report.repaired_store = sum(results)
+            report.failed += len(results) - report.repaired_store
+
+        logger.info(
+            "Knowledge base reconciled: %s rows and %s store files removed, %s failed",
+            report.repaired_db,
+            report.repaired_store,
+            report.failed,
+        )
+        return report
+
 
-agent_file_manager = AgentFileManager()
+agent_file_manager = TenantLocal(AgentFileManager)
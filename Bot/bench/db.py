@@ -0,0 +1,389 @@
+"""
+Бенчмарк методов Database на большом синтетическом наборе данных.
+
+    python -m Bot.bench.db seed --database bot_bench --users 500000 --messages 10000000
+    python -m Bot.bench.db run --database bot_bench --concurrency 16 --iterations 500 --out baseline.json
+    python -m Bot.bench.db compare baseline.json current.json --threshold 0.2
+
+Работает только с отдельной базой из --database (остальные параметры — из DB_*).
+seed заливает данные через COPY кусками, поэтому память не растёт с объёмом.
+run гоняет каждый метод через обычный пул Database (пишущие — в транзакции
+с откатом, данные не меняются) и сохраняет перцентили
+задержки вместе с планом EXPLAIN (ANALYZE, BUFFERS) для типичного вызова.
+compare печатает разницу двух прогонов и завершается с кодом 1 при регрессии.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import statistics
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from ..db import (
+    db,
+    Database,
+    GET_USER_MESSAGES_SQL,
+    SEARCH_MESSAGES_SQL,
+    DELETE_OLD_MESSAGES_SQL,
+    GET_CONVERSATION_STATE_SQL,
+    LIST_AGENT_FILES_SQL,
+)
+from .utils import percentile
+
+SEED_CHUNK = 50_000
+
+WORDS = [
+    "привет", "заказ", "доставка", "оплата", "возврат", "цена", "скидка", "курьер", "адрес", "товар",
+    "размер", "гарантия", "подписка", "тариф", "менеджер", "спасибо", "когда", "сколько", "можно",
+    "нужно", "подскажите", "пожалуйста", "срок", "статус", "номер", "карта", "счет", "договор",
+]
+ROLES = ["user", "assistant", "user", "assistant", "admin"]
+
+EXPLAIN_QUERIES = {
+    "get_user_messages": (GET_USER_MESSAGES_SQL, lambda ctx: (ctx.user_id(), 20)),
+    "search_messages": (SEARCH_MESSAGES_SQL, lambda ctx: (ctx.user_id(), random.choice(WORDS), 5)),
+    "delete_old_messages": (DELETE_OLD_MESSAGES_SQL, lambda ctx: (ctx.user_id(), 3)),
+    "get_conversation_state": (GET_CONVERSATION_STATE_SQL, lambda ctx: (ctx.telegram_id(),)),
+    "list_agent_files": (LIST_AGENT_FILES_SQL, lambda ctx: (10, ctx.file_offset())),
+}
+
+
+class BenchContext:
+    def __init__(self, min_user_id: int, max_user_id: int, files: int):
+        self.min_user_id = min_user_id
+        self.max_user_id = max_user_id
+        self.files = files
+
+    def user_id(self) -> int:
+        return random.randint(self.min_user_id, self.max_user_id)
+
+    def telegram_id(self) -> int:
+        return 10_000_000 + self.user_id()
+
+    def file_offset(self) -> int:
+        return random.randint(0, max(0, self.files - 10))
+
+
+def random_text() -> str:
+    return " ".join(random.choices(WORDS, k=random.randint(3, 25)))
+
+
+async def seed(args) -> None:
+    await db.connect()
+    try:
+        await db.create_table()
+
+        existing = await db.fetchrow("SELECT COUNT(*) AS c FROM users;")
+        if existing["c"] and not args.force:
+            print(f"В базе уже {existing['c']} пользователей. Добавьте --force, чтобы дописать данные.")
+            return
+
+        now = datetime.now(timezone.utc)
+        started = time.perf_counter()
+
+        async with db.pool.acquire() as conn:
+            offset = await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM users;")
+
+            for start in range(0, args.users, SEED_CHUNK):
+                count = min(SEED_CHUNK, args.users - start)
+                records = [
+                    (
+                        10_000_000 + offset + start + i + 1,
+                        f"user{offset + start + i + 1}" if random.random() < 0.7 else None,
+                        now - timedelta(days=random.uniform(0, 365)),
+                    )
+                    for i in range(count)
+                ]
+                await conn.copy_records_to_table(
+                    "users", records=records, columns=["telegram_id", "username", "created_at"]
+                )
+                print(f"users: {start + count}/{args.users}")
+
+            min_user_id, max_user_id = await conn.fetchrow("SELECT MIN(id), MAX(id) FROM users;")
+
+            # Небольшая доля клиентов пишет большую часть сообщений.
+            hot_users = max(1, (max_user_id - min_user_id) // 20)
+            window = timedelta(days=365)
+            for start in range(0, args.messages, SEED_CHUNK):
+                count = min(SEED_CHUNK, args.messages - start)
+                records = []
+                for i in range(count):
+                    if random.random() < 0.6:
+                        user_id = random.randint(min_user_id, min_user_id + hot_users)
+                    else:
+                        user_id = random.randint(min_user_id, max_user_id)
+                    created_at = now - window + window * ((start + i) / args.messages)
+                    records.append((user_id, random.choice(ROLES), random_text(), created_at))
+                await conn.copy_records_to_table(
+                    "messages", records=records, columns=["user_id", "role", "content", "created_at"]
+                )
+                print(f"messages: {start + count}/{args.messages}")
+
+            conversations = [
+                (
+                    10_000_000 + user_id,
+                    "admin" if random.random() < 0.05 else "ai",
+                    None,
+                    None,
+                )
+                for user_id in random.sample(range(min_user_id, max_user_id + 1), min(args.users, max_user_id - min_user_id + 1) // 10)
+            ]
+            await conn.copy_records_to_table(
+                "conversations",
+                records=conversations,
+                columns=["user_telegram_id", "mode", "taken_by_admin_id", "taken_at"],
+            )
+
+            files = [
+                (f"file_{i}.pdf", f"tg_file_{i}", f"file-{i}", "vs_bench", "application/pdf", 1024 * i)
+                for i in range(args.files)
+            ]
+            await conn.copy_records_to_table(
+                "agent_files",
+                records=files,
+                columns=["filename", "telegram_file_id", "openai_file_id", "vector_store_id", "mime_type", "file_size"],
+            )
+
+            await conn.execute("ANALYZE;")
+
+        print(f"Seed finished in {time.perf_counter() - started:.1f}s")
+    finally:
+        await db.disconnect()
+
+
+async def _measure(
+    name: str,
+    call: Callable[[], Awaitable],
+    iterations: int,
+    concurrency: int,
+) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await call()
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"{name}: {e!r}")
+                return
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(statistics.mean(latencies), 3) if latencies else None,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p90_ms": round(percentile(latencies, 90), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3) if latencies else None,
+    }
+
+
+class TransactionPool:
+    """Подменяет пул Database одним соединением, чтобы метод выполнился в нашей транзакции."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+async def _rolled_back(call: Callable[[Database], Awaitable]) -> None:
+    # Пишущие методы меряем в транзакции с откатом, чтобы прогоны не меняли набор данных.
+    # BEGIN и ROLLBACK входят в замер, но одинаково во всех прогонах.
+    async with db.pool.acquire() as conn:
+        tx = conn.transaction()
+        await tx.start()
+        try:
+            tx_db = Database()
+            tx_db.pool = TransactionPool(conn)
+            await call(tx_db)
+        finally:
+            await tx.rollback()
+
+
+async def _explain(query: str, params: Tuple) -> Dict:
+    # EXPLAIN ANALYZE выполняет запрос, поэтому DELETE откатываем.
+    async with db.pool.acquire() as conn:
+        tx = conn.transaction()
+        await tx.start()
+        try:
+            raw = await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", *params)
+        finally:
+            await tx.rollback()
+
+    plan = json.loads(raw)[0] if isinstance(raw, str) else raw[0]
+    root = plan["Plan"]
+    return {
+        "execution_ms": plan.get("Execution Time"),
+        "planning_ms": plan.get("Planning Time"),
+        "root_node": root.get("Node Type"),
+        "shared_hit_blocks": root.get("Shared Hit Blocks"),
+        "shared_read_blocks": root.get("Shared Read Blocks"),
+        "plan": plan,
+    }
+
+
+async def run(args) -> None:
+    await db.connect()
+    try:
+        stats = await db.fetchrow(
+            """
+            SELECT (SELECT MIN(id) FROM users) AS min_user_id,
+                   (SELECT MAX(id) FROM users) AS max_user_id,
+                   (SELECT COUNT(*) FROM agent_files) AS files,
+                   (SELECT reltuples::bigint FROM pg_class WHERE relname = 'messages') AS messages_estimate,
+                   (SELECT reltuples::bigint FROM pg_class WHERE relname = 'users') AS users_estimate,
+                   version() AS pg_version;
+            """
+        )
+        if stats["min_user_id"] is None:
+            print("База пустая — сначала запустите seed.")
+            return
+
+        ctx = BenchContext(stats["min_user_id"], stats["max_user_id"], stats["files"])
+
+        calls: Dict[str, Callable[[], Awaitable]] = {
+            "get_user_messages": lambda: db.get_user_messages(ctx.user_id(), limit=20),
+            "search_messages": lambda: db.search_messages(ctx.user_id(), random.choice(WORDS), limit=5),
+            "delete_old_messages": lambda: _rolled_back(
+                lambda tx_db: tx_db.delete_old_messages(ctx.user_id(), 3)
+            ),
+            "get_conversation_state": lambda: db.get_conversation_state(ctx.telegram_id()),
+            "list_agent_files": lambda: db.list_agent_files(limit=10, offset=ctx.file_offset()),
+        }
+
+        results = {}
+        for name, call in calls.items():
+            if args.only and name not in args.only:
+                continue
+
+            # Прогрев, чтобы первые холодные чтения не попадали в перцентили.
+            for _ in range(min(20, args.iterations)):
+                await call()
+
+            result = await _measure(name, call, args.iterations, args.concurrency)
+            query, make_params = EXPLAIN_QUERIES[name]
+            result["explain"] = await _explain(query, make_params(ctx))
+            results[name] = result
+
+            print(
+                f"{name:<24} p50={result['p50_ms']:>8.2f}ms p90={result['p90_ms']:>8.2f}ms "
+                f"p99={result['p99_ms']:>8.2f}ms ops/s={result['ops_per_sec']:>8.1f} "
+                f"plan={result['explain']['root_node']}"
+            )
+
+        report = {
+            "meta": {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "database": os.getenv("DB_NAME"),
+                "concurrency": args.concurrency,
+                "iterations": args.iterations,
+                "users_estimate": stats["users_estimate"],
+                "messages_estimate": stats["messages_estimate"],
+                "agent_files": stats["files"],
+                "pg_version": stats["pg_version"],
+                "python": platform.python_version(),
+            },
+            "results": results,
+        }
+
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"\nBaseline written to {args.out}")
+    finally:
+        await db.disconnect()
+
+
+def compare(args) -> int:
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)["results"]
+
+    regressions = 0
+    print(f"{'method':<24} {'metric':<7} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in sorted(set(baseline) & set(current)):
+        for metric in ("p50_ms", "p99_ms"):
+            before = baseline[name][metric]
+            after = current[name][metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            flag = ""
+            if change > args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{name:<24} {metric:<7} {before:>10.2f} {after:>10.2f} {change:>+8.0%}{flag}")
+
+        before_plan = baseline[name].get("explain", {}).get("root_node")
+        after_plan = current[name].get("explain", {}).get("root_node")
+        if before_plan != after_plan:
+            print(f"{name:<24} plan changed: {before_plan} -> {after_plan}")
+
+    for name in sorted(set(baseline) - set(current)):
+        print(f"{name:<24} missing in current run")
+
+    return 1 if regressions else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Database benchmark suite.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = sub.add_parser("seed", help="fill a benchmark database with synthetic data")
+    seed_parser.add_argument("--database", required=True)
+    seed_parser.add_argument("--users", type=int, default=500_000)
+    seed_parser.add_argument("--messages", type=int, default=10_000_000)
+    seed_parser.add_argument("--files", type=int, default=200)
+    seed_parser.add_argument("--force", action="store_true")
+
+    run_parser = sub.add_parser("run", help="benchmark Database methods and write a baseline")
+    run_parser.add_argument("--database", required=True)
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--iterations", type=int, default=500)
+    run_parser.add_argument("--only", nargs="*", default=None)
+    run_parser.add_argument("--out", default="db_bench.json")
+
+    compare_parser = sub.add_parser("compare", help="compare two baselines")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(compare(args))
+
+    # Database читает параметры подключения из окружения при connect().
+    os.environ["DB_NAME"] = args.database
+    if args.command == "seed":
+        asyncio.run(seed(args))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Замеряет задержку, которую UpdateDeduplicationMiddleware добавляет к апдейту:
+новый апдейт (claim в БД), повтор из памяти и повтор, пойманный только БД
+(как при доставке во второй процесс). Заодно проверяет, что апдейт, на котором
+упал обработчик, обрабатывается при повторной доставке.
+
+    python -m Bot.bench.dedup --updates 2000 --concurrency 20
+
+Использует базу из DB_* и удаляет свои записи из processed_updates после прогона.
+"""
+import time
+import random
+import asyncio
+import argparse
+from typing import List
+
+from aiogram.types import Update
+
+from ..db import db
+from ..dedup import UpdateDeduplicationMiddleware
+from .utils import format_latencies
+
+
+async def _noop_handler(event, data):
+    return None
+
+
+async def _failing_handler(event, data):
+    raise RuntimeError("handler failed")
+
+
+async def run(args) -> None:
+    await db.connect()
+    await db.create_table()
+
+    # Диапазон заведомо выше реальных update_id Telegram.
+    base = random.randint(10**12, 2 * 10**12)
+    ids = [base + i for i in range(args.updates)]
+    failed_ids = [base + args.updates + i for i in range(args.updates)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(middleware: UpdateDeduplicationMiddleware, update_id: int, out: List[float]) -> None:
+        update = Update(update_id=update_id)
+        async with semaphore:
+            started = time.perf_counter()
+            await middleware(_noop_handler, update, {})
+            out.append((time.perf_counter() - started) * 1000)
+
+    try:
+        first = UpdateDeduplicationMiddleware(window=args.updates * 2)
+        second = UpdateDeduplicationMiddleware(window=args.updates * 2)
+
+        fresh: List[float] = []
+        duplicate_memory: List[float] = []
+        duplicate_db: List[float] = []
+
+        await asyncio.gather(*(feed(first, u, fresh) for u in ids))
+        await asyncio.gather(*(feed(first, u, duplicate_memory) for u in ids))
+        await asyncio.gather(*(feed(second, u, duplicate_db) for u in ids))
+
+        # Обработчик падает в первом процессе — повтор во втором должен пройти.
+        for update_id in failed_ids:
+            try:
+                await first(_failing_handler, Update(update_id=update_id), {})
+            except RuntimeError:
+                pass
+        processed_before = second.stats["processed"]
+        for update_id in failed_ids:
+            await second(_noop_handler, Update(update_id=update_id), {})
+        redelivered = second.stats["processed"] - processed_before
+
+        print(format_latencies("new update", fresh))
+        print(format_latencies("dup (memory)", duplicate_memory))
+        print(format_latencies("dup (db)", duplicate_db))
+        print(f"redelivered after handler error: {redelivered}/{len(failed_ids)}")
+        print()
+        print("first process:", first.stats)
+        print("second process:", second.stats)
+    finally:
+        await db.execute(
+            "DELETE FROM processed_updates WHERE update_id >= $1 AND update_id < $2;",
+            base,
+            base + 2 * args.updates,
+        )
+        await db.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark update deduplication overhead.")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
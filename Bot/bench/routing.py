@@ -0,0 +1,118 @@
+"""
+Сравнивает задержку и стоимость ответов с маршрутизацией и без неё
+на реальном наборе сообщений клиентов.
+
+    python -m Bot.bench.routing messages.txt --limit 200 --concurrency 4
+    python -m Bot.bench.routing messages.jsonl --dry-run
+
+Файл — по одному сообщению на строку, либо JSONL с полями role/content.
+Вызовы идут в настоящий OpenAI API и в usage не записываются.
+"""
+import json
+import asyncio
+import argparse
+import statistics
+from collections import Counter
+from typing import List, Optional
+
+from ..db import db
+from ..llm import _ask_gpt_sync, OPENAI_MODEL
+from ..routing import message_router
+from ..usage import estimate_cost
+from .utils import percentile
+
+
+def load_messages(path: str, limit: int) -> List[str]:
+    messages = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                row = json.loads(line)
+                if row.get("role", "user") != "user":
+                    continue
+                line = row.get("content") or ""
+            if line:
+                messages.append(line)
+            if len(messages) >= limit:
+                break
+    return messages
+
+
+def summarize(name: str, results: List[Optional[dict]]) -> str:
+    ok = [r for r in results if r]
+    latencies = [r["latency_ms"] for r in ok]
+    cost = sum(
+        estimate_cost(r["model"], r["input_tokens"], r["cached_tokens"], r["output_tokens"]) or 0.0
+        for r in ok
+    )
+    return (
+        f"{name:<10} calls={len(ok):<5} errors={len(results) - len(ok):<3} "
+        f"p50={percentile(latencies, 50):>6.0f}ms p95={percentile(latencies, 95):>6.0f}ms "
+        f"mean={statistics.mean(latencies) if latencies else 0:>6.0f}ms "
+        f"in={sum(r['input_tokens'] for r in ok):<8} out={sum(r['output_tokens'] for r in ok):<8} "
+        f"cost=${cost:.4f}"
+    )
+
+
+async def run(args) -> None:
+    messages = load_messages(args.messages, args.limit)
+    if not messages:
+        print("Нет сообщений для прогона.")
+        return
+
+    await db.connect()
+    try:
+        await message_router.load()
+        prompt = args.prompt or await db.get_setting("agent_prompt") or "Ты дружелюбный Telegram-ассистент."
+        vector_store_id = args.vector_store_id or await db.get_setting("agent_vector_store_id")
+    finally:
+        await db.disconnect()
+
+    routes = [message_router.route(text) for text in messages]
+    print(f"Сообщений: {len(messages)}")
+    for label, count in Counter(r.label for r in routes).most_common():
+        print(f"  {label:<20} {count:>5} ({count / len(routes):.0%})")
+
+    if args.dry_run:
+        return
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def call(text: str, model: str, use_file_search: bool) -> Optional[dict]:
+        async with semaphore:
+            _, usage = await asyncio.to_thread(
+                _ask_gpt_sync,
+                text,
+                prompt,
+                vector_store_id if use_file_search else None,
+                None,
+                model,
+            )
+            return usage
+
+    baseline = await asyncio.gather(*(call(text, OPENAI_MODEL, True) for text in messages))
+    routed = await asyncio.gather(
+        *(call(text, route.model, route.use_file_search) for text, route in zip(messages, routes))
+    )
+
+    print()
+    print(summarize("baseline", baseline))
+    print(summarize("routed", routed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark model routing on replayed messages.")
+    parser.add_argument("messages", help="text file (one message per line) or JSONL export")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--prompt", default=None, help="system prompt, defaults to agent_prompt from DB")
+    parser.add_argument("--vector-store-id", default=None)
+    parser.add_argument("--dry-run", action="store_true", help="only print the routing distribution")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""
+Долгий прогон синтетического трафика через Dispatcher: ищет медленный рост памяти
+и подвисания event loop.
+
+    python -m Bot.bench.soak --duration 14400 --rate 20 --users 300
+    python -m Bot.bench.soak --duration 600 --warmup 60 --report-every 30
+
+Telegram и OpenAI подменяются локальными HTTP-серверами в этом же процессе,
+апдейты подаются через dp.feed_update со всеми middleware. Нужна база из DB_*:
+данные пишутся в отдельную схему tenant_soak, которая удаляется после прогона
+(--keep-schema оставляет её для разбора).
+
+Каждые --report-every секунд печатается снимок: память по tracemalloc и RSS,
+p99 задержки запланированных callback'ов event loop и топ мест, где память
+выросла с прошлого снимка. Прогон завершается с кодом 1, если после прогрева
+рост памяти превысил --max-slope-mb-per-hour или p99 лага в каком-либо
+периоде превысил --max-lag-p99-ms.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+import tracemalloc
+from collections import Counter, deque
+from typing import Deque, List, Optional, Tuple
+
+from aiohttp import web
+
+from .utils import percentile
+
+SOAK_TENANT = "soak"
+BOT_ID = 7000000001
+ADMIN_ID = 7000000002
+LOG_CHAT_ID = -1007000000003
+BASE_USER_ID = 7100000000
+
+CLIENT_TEXTS = [
+    "привет",
+    "спасибо!",
+    "Подскажите, сколько стоит доставка в Казань?",
+    "Как оформить возврат товара, если коробка вскрыта?",
+    "У вас есть скидки для постоянных клиентов?",
+    "Заказ 18233 до сих пор не пришёл, что делать?",
+    "Можно ли оплатить картой при получении?",
+    "ок",
+]
+OPERATOR_TEXTS = [
+    "Здравствуйте! Сейчас проверю.",
+    "Передал вопрос на склад, вернусь с ответом.",
+    "Готово, возврат оформлен.",
+]
+
+
+class FakeTelegram:
+    """Отвечает на методы Bot API так, чтобы aiogram мог разобрать ответ. Память ограничена."""
+
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+        self.log_messages: Deque[int] = deque(maxlen=200)
+        self.calls: Counter = Counter()
+
+    def _bot_user(self) -> dict:
+        return {"id": BOT_ID, "is_bot": True, "first_name": "Soak", "username": "soak_bot"}
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        chat = {"id": chat_id, "type": "supergroup", "title": "log"} if chat_id < 0 else {"id": chat_id, "type": "private"}
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": self._bot_user(),
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+
+        if method == "getMe":
+            result = self._bot_user()
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            result = self._message(chat_id, params.get("text", ""))
+            if chat_id == LOG_CHAT_ID:
+                self.log_messages.append(result["message_id"])
+        elif method == "editMessageText":
+            result = self._message(int(params["chat_id"]), params.get("text", ""), int(params["message_id"]))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeOpenAI:
+    """Responses API с фиксированной задержкой и правдоподобным usage."""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self._ids = itertools.count(1)
+        self.calls = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls += 1
+        await asyncio.sleep(self.latency_ms / 1000 * random.uniform(0.5, 1.5))
+
+        n = next(self._ids)
+        input_tokens = random.randint(300, 1500)
+        output_tokens = random.randint(20, 200)
+        return web.json_response(
+            {
+                "id": f"resp_{n}",
+                "object": "response",
+                "created_at": int(time.time()),
+                "model": body.get("model", "gpt-4.1-mini"),
+                "status": "completed",
+                "parallel_tool_calls": True,
+                "tool_choice": "auto",
+                "tools": [],
+                "output": [
+                    {
+                        "type": "message",
+                        "id": f"msg_{n}",
+                        "status": "completed",
+                        "role": "assistant",
+                        "content": [{"type": "output_text", "text": "Синтетический ответ.", "annotations": []}],
+                    }
+                ],
+                "usage": {
+                    "input_tokens": input_tokens,
+                    "input_tokens_details": {"cached_tokens": input_tokens // 2},
+                    "output_tokens": output_tokens,
+                    "output_tokens_details": {"reasoning_tokens": 0},
+                    "total_tokens": input_tokens + output_tokens,
+                },
+            }
+        )
+
+
+class LoopLagMonitor:
+    """Ставит callback на заданное время и меряет, насколько позже он реально выполнился."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self._samples: List[float] = []
+        self._expected = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        self._schedule(asyncio.get_running_loop())
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._expected = loop.time() + self.interval
+        self._handle = loop.call_at(self._expected, self._tick, loop)
+
+    def _tick(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._samples.append((loop.time() - self._expected) * 1000)
+        self._schedule(loop)
+
+    def take(self) -> List[float]:
+        samples, self._samples = self._samples, []
+        return samples
+
+
+async def start_server(handler, path: str) -> Tuple[web.AppRunner, int]:
+    app = web.Application()
+    app.router.add_post(path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, runner.addresses[0][1]
+
+
+def configure_env(telegram_port: int, openai_port: int) -> str:
+    # Модули бота читают окружение при импорте, поэтому всё выставляем до него.
+    config = [
+        {
+            "name": SOAK_TENANT,
+            "token": f"{BOT_ID}:SOAK-local-token",
+            "admin_ids": [ADMIN_ID],
+            "log_chat_id": LOG_CHAT_ID,
+            "bot_username": "soak_bot",
+        }
+    ]
+    fd, path = tempfile.mkstemp(prefix="soak-bots-", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+    os.environ["BOTS_CONFIG"] = path
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "soak-local-key")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("SUMMARY_IDLE_SECONDS", "30")
+    os.environ["SOAK_TELEGRAM_URL"] = f"http://127.0.0.1:{telegram_port}"
+    return path
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+
+        # На macOS ru_maxrss в байтах, и это пик, а не текущее значение.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+def memory_slope(samples: List[Tuple[float, float]]) -> Optional[float]:
+    """Наклон прямой МНК по (часы, МБ) — МБ в час."""
+    if len(samples) < 3:
+        return None
+    n = len(samples)
+    mean_t = sum(t for t, _ in samples) / n
+    mean_m = sum(m for _, m in samples) / n
+    var = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not var:
+        return None
+    return sum((t - mean_t) * (m - mean_m) for t, m in samples) / var
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+    )
+
+
+class TrafficGenerator:
+    """Собирает апдейты: в основном вопросы клиентов, плюс не-текст и действия оператора."""
+
+    def __init__(self, bot, telegram: FakeTelegram, users: int):
+        self.bot = bot
+        self.telegram = telegram
+        self.users = [BASE_USER_ID + i for i in range(users)]
+        self._update_ids = itertools.count(random.randint(10**12, 2 * 10**12))
+        self._message_ids = itertools.count(1)
+        self.kinds: Counter = Counter()
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Soak", "username": f"soak{user_id}"}
+
+    def _private(self, user_id: int, **content) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **content,
+        }
+
+    def next_update(self):
+        from aiogram.types import Update
+
+        roll = random.random()
+        if roll < 0.80:
+            kind, message = "client_text", self._private(random.choice(self.users), text=random.choice(CLIENT_TEXTS))
+        elif roll < 0.85:
+            kind, message = "client_non_text", self._private(random.choice(self.users), dice={"emoji": "🎲", "value": 3})
+        elif roll < 0.89:
+            kind = "operator_open"
+            message = self._private(ADMIN_ID, text=f"/start chat_{random.choice(self.users)}")
+        elif roll < 0.95 and self.telegram.log_messages:
+            kind = "operator_reply"
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": LOG_CHAT_ID, "type": "supergroup", "title": "log"},
+                "from": self._user(ADMIN_ID),
+                "text": random.choice(OPERATOR_TEXTS),
+                "reply_to_message": {
+                    "message_id": random.choice(self.telegram.log_messages),
+                    "date": int(time.time()),
+                    "chat": {"id": LOG_CHAT_ID, "type": "supergroup", "title": "log"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "Soak"},
+                    "text": "...",
+                },
+            }
+        elif roll < 0.97:
+            kind, message = "operator_text", self._private(ADMIN_ID, text=random.choice(OPERATOR_TEXTS))
+        elif roll < 0.99:
+            kind, message = "operator_ai", self._private(ADMIN_ID, text="/ai")
+        else:
+            kind, message = "operator_queue", self._private(ADMIN_ID, text="/queue")
+
+        self.kinds[kind] += 1
+        return Update.model_validate(
+            {"update_id": next(self._update_ids), "message": message},
+            context={"bot": self.bot},
+        )
+
+
+async def run(args) -> int:
+    telegram = FakeTelegram()
+    openai = FakeOpenAI(args.llm_latency_ms)
+    telegram_runner, telegram_port = await start_server(telegram.handle, "/bot{token}/{method}")
+    openai_runner, openai_port = await start_server(openai.handle, "/v1/responses")
+    config_path = configure_env(telegram_port, openai_port)
+
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    from .. import bot as bot_module
+    from ..db import db
+    from ..dedup import update_dedup
+    from ..lifecycle import lifecycle
+    from ..logger import setup_logging, stop_logging
+
+    bot = bot_module.bots[SOAK_TENANT]
+    bot.session = AiohttpSession(api=TelegramAPIServer.from_base(os.environ["SOAK_TELEGRAM_URL"]))
+
+    tracemalloc.start(args.frames)
+    setup_logging()
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    started = time.perf_counter()
+    await db.connect()
+    warm_up_task = await bot_module.start_tenant(SOAK_TENANT, started)
+    update_dedup.start()
+
+    generator = TrafficGenerator(bot, telegram, args.users)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    in_flight = set()
+    totals = Counter()
+
+    async def feed(update) -> None:
+        try:
+            await bot_module.dp.feed_update(bot, update)
+            totals["handled"] += 1
+        except Exception as e:
+            totals["errors"] += 1
+            if totals["errors"] <= 5:
+                print(f"handler error: {e!r}")
+        finally:
+            semaphore.release()
+
+    memory_samples: List[Tuple[float, float]] = []
+    lag_breaches: List[Tuple[float, float]] = []
+    baseline: Optional[tracemalloc.Snapshot] = None
+    previous: Optional[tracemalloc.Snapshot] = None
+    run_started = time.monotonic()
+    next_report = run_started + args.report_every
+    interval = 1 / args.rate
+    next_update_at = run_started
+
+    print(
+        f"soak: duration={args.duration}s rate={args.rate}/s users={args.users} "
+        f"warmup={args.warmup}s budgets: slope<={args.max_slope_mb_per_hour} MB/h, "
+        f"lag p99<={args.max_lag_p99_ms} ms"
+    )
+
+    try:
+        while True:
+            now = time.monotonic()
+            elapsed = now - run_started
+            if elapsed >= args.duration:
+                break
+
+            if semaphore.locked():
+                # Бот не успевает: апдейт пропускаем и считаем, чтобы это было видно в отчёте.
+                totals["skipped"] += 1
+            else:
+                await semaphore.acquire()
+                task = asyncio.create_task(feed(generator.next_update()))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+            if now >= next_report:
+                next_report += args.report_every
+                lags = monitor.take()
+                lag_p99 = percentile(lags, 99)
+                traced_mb = tracemalloc.get_traced_memory()[0] / 2**20
+                warmed_up = elapsed >= args.warmup
+
+                print(
+                    f"[{elapsed:>7.0f}s] handled={totals['handled']} errors={totals['errors']} "
+                    f"skipped={totals['skipped']} in_flight={len(in_flight)} llm={openai.calls} "
+                    f"traced={traced_mb:.1f}MB rss={rss_mb():.1f}MB "
+                    f"lag p50={percentile(lags, 50):.1f}ms p99={lag_p99:.1f}ms max={max(lags) if lags else 0:.1f}ms"
+                )
+
+                if warmed_up:
+                    memory_samples.append((elapsed / 3600, traced_mb))
+                    if lag_p99 > args.max_lag_p99_ms:
+                        lag_breaches.append((elapsed, lag_p99))
+
+                    # Снимок и дифф блокируют loop на секунды: это цена замера, а не лаг бота.
+                    # Монитор на это время останавливаем, а темп апдейтов отсчитываем заново.
+                    monitor.stop()
+                    snapshot = take_snapshot()
+                    if baseline is None:
+                        baseline = snapshot
+                    if previous is not None:
+                        for stat in snapshot.compare_to(previous, "lineno")[: args.top]:
+                            if stat.size_diff > 0:
+                                print(f"    +{stat.size_diff / 1024:>8.1f} KiB {stat.count_diff:>+7} blocks  {stat.traceback}")
+                    previous = snapshot
+                    monitor.start()
+                    next_update_at = time.monotonic()
+
+            # Темп держим по расписанию, а не паузой после каждого апдейта, чтобы не отставать.
+            next_update_at += interval
+            await asyncio.sleep(max(0.0, next_update_at - time.monotonic()))
+    finally:
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        monitor.stop()
+
+        final = take_snapshot()
+        await lifecycle.drain()
+        warm_up_task.cancel()
+        await bot_module.stop_tenant(SOAK_TENANT)
+        await update_dedup.close()
+        if not args.keep_schema:
+            await db.execute(f'DROP SCHEMA IF EXISTS "tenant_{SOAK_TENANT}" CASCADE;')
+        await db.disconnect()
+        await bot.session.close()
+        stop_logging()
+        await telegram_runner.cleanup()
+        await openai_runner.cleanup()
+        os.unlink(config_path)
+
+    print()
+    print("updates:", dict(generator.kinds))
+    print("telegram calls:", dict(telegram.calls.most_common()))
+    if baseline is not None:
+        print(f"top growth since warm-up (top {args.top}):")
+        for stat in final.compare_to(baseline, "traceback" if args.frames > 1 else "lineno")[: args.top]:
+            print(f"    {stat.size_diff / 1024:>+9.1f} KiB {stat.count_diff:>+7} blocks  {stat.traceback}")
+
+    failed = False
+    slope = memory_slope(memory_samples)
+    if slope is None:
+        print("memory slope: мало снимков после прогрева, проверка пропущена")
+    else:
+        ok = slope <= args.max_slope_mb_per_hour
+        failed |= not ok
+        print(f"memory slope: {slope:+.2f} MB/h ({'ok' if ok else 'FAIL'}, budget {args.max_slope_mb_per_hour})")
+
+    if lag_breaches:
+        failed = True
+        worst = max(lag_breaches, key=lambda b: b[1])
+        print(f"loop lag: FAIL, p99 above {args.max_lag_p99_ms} ms in {len(lag_breaches)} periods, worst {worst[1]:.1f} ms at {worst[0]:.0f}s")
+    else:
+        print(f"loop lag: ok, p99 within {args.max_lag_p99_ms} ms in every period")
+
+    if totals["errors"]:
+        failed = True
+        print(f"handler errors: {totals['errors']} (FAIL)")
+
+    return 1 if failed else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Soak test: memory growth and event loop lag under synthetic traffic.")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds")
+    parser.add_argument("--warmup", type=float, default=300, help="seconds excluded from budgets")
+    parser.add_argument("--rate", type=float, default=10, help="updates per second")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--report-every", type=float, default=60, help="seconds between snapshots")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--max-slope-mb-per-hour", type=float, default=8.0)
+    parser.add_argument("--max-lag-p99-ms", type=float, default=100.0)
+    parser.add_argument("--top", type=int, default=10, help="allocators to show per snapshot diff")
+    parser.add_argument("--frames", type=int, default=1, help="tracemalloc traceback depth")
+    parser.add_argument("--keep-schema", action="store_true")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
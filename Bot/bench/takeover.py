@@ -0,0 +1,117 @@
+"""
+Проверяет захват диалога под конкуренцией: несколько админов одновременно жмут
+«Перейти в диалог», владелец одновременно шлёт /ai и /close. В каждом раунде
+ровно один админ должен получить клиента, а ИИ — вернуться ровно один раз.
+
+    python -m Bot.bench.takeover --rounds 200 --admins 5
+
+Использует базу из DB_* и удаляет свои записи после прогона.
+Завершается с кодом 1, если хоть один раунд нарушил инварианты.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+from typing import List
+
+from ..db import db
+from .utils import format_latencies
+
+
+async def timed(out: List[float], coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        out.append((time.perf_counter() - started) * 1000)
+
+
+async def run(args) -> int:
+    await db.connect()
+    await db.create_table()
+
+    # Диапазоны заведомо выше реальных id Telegram.
+    base_user = random.randint(10**12, 2 * 10**12)
+    base_admin = base_user + 10**9
+    users = [base_user + i for i in range(args.rounds)]
+    admins = [base_admin + i for i in range(args.admins)]
+
+    take_ms: List[float] = []
+    return_ms: List[float] = []
+    failures = []
+
+    try:
+        for user_id in users:
+            results = await asyncio.gather(
+                *(timed(take_ms, db.take_over_conversation(user_id, admin_id)) for admin_id in admins)
+            )
+            winners = [admin_id for admin_id, row in zip(admins, results) if row["taken"]]
+            if len(winners) != 1:
+                failures.append(f"user {user_id}: захватили {len(winners)} админов")
+                continue
+
+            owner = winners[0]
+            wrong_owner = [
+                row["owner_admin_id"] for row in results if not row["taken"] and row["owner_admin_id"] != owner
+            ]
+            if wrong_owner:
+                failures.append(f"user {user_id}: проигравшим назван не тот владелец {wrong_owner}")
+
+            # Повторный клик владельца не должен ничего ломать.
+            again = await db.take_over_conversation(user_id, owner)
+            if not again["taken"]:
+                failures.append(f"user {user_id}: владелец не смог открыть свой диалог повторно")
+
+            # Владелец дважды шлёт /ai, остальные тем временем снова жмут кнопку.
+            returns = await asyncio.gather(
+                timed(return_ms, db.return_conversation_to_ai(owner)),
+                timed(return_ms, db.return_conversation_to_ai(owner)),
+                *(db.take_over_conversation(user_id, admin_id) for admin_id in admins if admin_id != owner),
+            )
+            released = sum(1 for row in returns[:2] if row and row["released"])
+            if released != 1:
+                failures.append(f"user {user_id}: ИИ вернули {released} раз")
+
+            mode, holder, _ = await db.get_conversation_state(user_id)
+            if mode == "admin" and holder == owner:
+                failures.append(f"user {user_id}: после /ai клиент остался за прежним владельцем")
+
+        starts = await db.pool.fetchval(
+            "SELECT COUNT(*) FROM takeover_events WHERE user_telegram_id = ANY($1::bigint[]) AND event = 'start';",
+            users,
+        )
+        ends = await db.pool.fetchval(
+            "SELECT COUNT(*) FROM takeover_events WHERE user_telegram_id = ANY($1::bigint[]) AND event = 'end';",
+            users,
+        )
+        still_taken = await db.pool.fetchval(
+            "SELECT COUNT(*) FROM conversations WHERE user_telegram_id = ANY($1::bigint[]) AND mode = 'admin';",
+            users,
+        )
+        if starts - ends != still_taken:
+            failures.append(f"events: start={starts}, end={ends}, в ручном режиме {still_taken}")
+
+        print(format_latencies("take over", take_ms))
+        print(format_latencies("return to ai", return_ms))
+        print(f"rounds={args.rounds} admins={args.admins} start={starts} end={ends} failures={len(failures)}")
+        for line in failures[:20]:
+            print("  " + line)
+    finally:
+        await db.execute("DELETE FROM takeover_events WHERE user_telegram_id = ANY($1::bigint[]);", users)
+        await db.execute("DELETE FROM conversations WHERE user_telegram_id = ANY($1::bigint[]);", users)
+        await db.execute("DELETE FROM admin_sessions WHERE admin_id = ANY($1::bigint[]);", admins)
+        await db.disconnect()
+
+    return 1 if failures else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check takeover under concurrent admins.")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--admins", type=int, default=5)
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+from typing import List
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def format_latencies(name: str, values: List[float]) -> str:
+    return (
+        f"{name:<16} n={len(values):<6} "
+        f"p50={percentile(values, 50):>8.2f}ms "
+        f"p95={percentile(values, 95):>8.2f}ms "
+        f"p99={percentile(values, 99):>8.2f}ms "
+        f"max={max(values) if values else 0:>8.2f}ms"
+    )
@@ -1,4 +1,6 @@
 import os
+import time
+import logging
 import html
 import asyncio
 
@@ -11,31 +13,65 @@ from aiogram.types import (
     CallbackQuery,
 )
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 from typing import Optional, Tuple
 
-from .llm import ask_assistant, create_vector_store
+from .llm import ask_assistant, create_vector_store, llm_limiter, warm_up_client
 from .db import db
 from .agent_files import agent_file_manager
+from .summaries import conversation_summarizer
 
 from .log_utils import send_ai_log, send_admin_user_message
 from .config import ADMIN_IDS
 from .takeover import takeover_router
-from datetime import datetime, timezone
-TAKEOVER_TIMEOUT_MINUTES = 20
+from .operator_desk import operator_router, log_message_map, reply_target, send_operator_reply, deliver_to_client
+from .takeover_expiry import takeover_expiry
+from .broadcast import broadcast_router, broadcast_engine
+from .usage import usage_router, usage_tracker
+from .routing import message_router
+from .dedup import update_dedup
+from .stats import stats_router, stats_aggregator
+from .export import export_router
+from .lifecycle import lifecycle, supervisor
+from .throttling import throttling
+from .tenants import TENANTS, TenantLocal, TenantMiddleware, get_tenant, use_tenant
+from .logger import (
+    LOG_LEVELS,
+    LogContextMiddleware,
+    get_log_level,
+    log_stage,
+    set_log_level,
+    setup_logging,
+    stop_logging,
+)
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+load_dotenv()
 
-bot = Bot(
-    token=TELEGRAM_BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
-)
+# Все боты из BOTS_CONFIG обслуживаются одним Dispatcher в одном event loop.
+bots = {
+    name: Bot(
+        token=config.token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    for name, config in TENANTS.items()
+}
 dp = Dispatcher()
+dp.update.outer_middleware(lifecycle)
+dp.update.outer_middleware(TenantMiddleware())
+dp.update.outer_middleware(LogContextMiddleware())
+dp.update.outer_middleware(update_dedup)
+dp.message.outer_middleware(throttling)
 
 dp.include_router(takeover_router)
+dp.include_router(operator_router)
+dp.include_router(broadcast_router)
+dp.include_router(usage_router)
+dp.include_router(stats_router)
+dp.include_router(export_router)
 
 DEFAULT_AGENT_PROMPT = os.getenv(
     "SYSTEM_PROMPT",
@@ -46,14 +82,26 @@ DEFAULT_AGENT_PROMPT = os.getenv(
     """
 )
 
-AGENT_PROMPT = DEFAULT_AGENT_PROMPT
-WAITING_FOR_PROMPT: set[int] = set()
-AGENT_VECTOR_STORE_ID: Optional[str] = None
+
+
+class AgentState:
+    def __init__(self):
+        config = get_tenant()
+        self.prompt = config.prompt or DEFAULT_AGENT_PROMPT
+        self.prompt_version: Optional[int] = None
+        self.vector_store_id: Optional[str] = config.vector_store_id
+        self.waiting_for_prompt: set[int] = set()
+        self.vector_store_lock = asyncio.Lock()
+
+
+agent_state = TenantLocal(AgentState)
 
 admin_menu_kb = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="Изменить промпт", callback_data="admin_edit_prompt")],
+        [InlineKeyboardButton(text="Версии промпта", callback_data="admin_prompt_versions")],
         [InlineKeyboardButton(text="Файлы агента", callback_data="admin_files")],
+        [InlineKeyboardButton(text="Уровень логов", callback_data="admin_log_level")],
     ]
 )
 
@@ -61,9 +109,16 @@ admin_files_kb = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="Загрузить файл", callback_data="admin_files_upload")],
         [InlineKeyboardButton(text="Список файлов", callback_data="admin_files_list")],
+        [InlineKeyboardButton(text="Выбрать несколько для удаления", callback_data="admin_files_select")],
+        [InlineKeyboardButton(text="Удалить старые файлы", callback_data="admin_files_older")],
+        [InlineKeyboardButton(text="Сверка с vector store", callback_data="admin_files_reconcile")],
     ]
 )
 
+FILES_SELECT_LIMIT = 30
+FILES_OLDER_DAYS = (30, 90, 180, 365)
+PROMPT_VERSIONS_LIMIT = 10
+
 
 @dp.message(Command("admin"))
 async def admin_menu(message: Message):
@@ -72,20 +127,35 @@ async def admin_menu(message: Message):
 
     await message.answer(
         "Админ-меню агента:\n\n"
-        "1️⃣ Изменить промпт агента\n"
-        "2️⃣ Управлять файлами (загрузка/удаление/скачивание)",
+        "1️⃣ Изменить промпт агента или откатить его к прошлой версии\n"
+        "2️⃣ Управлять файлами (загрузка/удаление/скачивание)\n"
+        "3️⃣ Поменять уровень логов без перезапуска",
         reply_markup=admin_menu_kb,
     )
 
 
+@dp.message(Command("health"))
+async def admin_health(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    in_flight = ", ".join(f"{name}: {count}" for name, count in llm_limiter.snapshot().items()) or "нет"
+    await message.answer(
+        f"{update_dedup.format_stats()}\n"
+        f"{throttling.format_stats()}\n"
+        f"Запросов к LLM в работе ({llm_limiter.capacity} слотов): {in_flight}\n\n"
+        f"{supervisor.format_health()}"
+    )
+
+
 @dp.callback_query(F.data == "admin_edit_prompt")
 async def on_admin_edit_prompt(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return await callback.answer("Нет доступа", show_alert=True)
 
-    WAITING_FOR_PROMPT.add(callback.from_user.id)
+    agent_state.waiting_for_prompt.add(callback.from_user.id)
 
-    safe_prompt = html.escape(AGENT_PROMPT)
+    safe_prompt = html.escape(agent_state.prompt)
 
     await callback.message.answer(
         "Отправь новый промпт для агента одним сообщением.\n\n"
@@ -94,31 +164,162 @@ async def on_admin_edit_prompt(callback: CallbackQuery):
     await callback.answer()
 
 
-async def load_agent_vector_store_from_db():
-    global AGENT_VECTOR_STORE_ID
+async def render_prompt_versions() -> Tuple[str, InlineKeyboardMarkup]:
+    # Свежие вызовы ещё в буфере трекера — сбрасываем, чтобы цифры по активной версии были актуальны.
+    await usage_tracker.flush()
+    rows = await db.list_prompt_versions(PROMPT_VERSIONS_LIMIT)
+
+    active = agent_state.prompt_version
+    lines = ["<b>Версии промпта</b>\n"]
+    buttons = []
+    for r in rows:
+        title = f"v{r['id']}" + (" (активна)" if r["id"] == active else "")
+        author = f"админ {r['created_by']}" if r["created_by"] else "по умолчанию"
+        lines.append(f"<b>{title}</b> · {r['created_at'].strftime('%d.%m %H:%M')} · {author}")
+
+        if r["calls"]:
+            cached_ratio = r["cached_tokens"] / r["input_tokens"] if r["input_tokens"] else 0.0
+            lines.append(
+                f"  ответов {r['calls']}, кэш {cached_ratio:.0%} входа, "
+                f"{r['latency_ms_sum'] / r['calls']:.0f} мс, "
+                f"{r['output_tokens'] / r['calls']:.0f} ток. в ответе"
+            )
+        else:
+            lines.append("  ответов пока нет")
+
+        preview = r["prompt"] if len(r["prompt"]) <= 80 else r["prompt"][:80] + "…"
+        lines.append(f"  <i>{html.escape(preview)}</i>")
+
+        if r["id"] != active:
+            buttons.append(
+                [InlineKeyboardButton(text=f"Откатить к v{r['id']}", callback_data=f"admin_prompt_rollback:{r['id']}")]
+            )
+
+    if not rows:
+        lines.append("Версий пока нет.")
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.callback_query(F.data == "admin_prompt_versions")
+async def on_admin_prompt_versions(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
 
-    value = await db.get_setting("agent_vector_store_id")
-    if value is None:
-        vector_store_id = await create_vector_store("Agent knowledge base")
-        await db.set_setting("agent_vector_store_id", vector_store_id)
-        AGENT_VECTOR_STORE_ID = vector_store_id
-        print(f"Vector store not found in DB, created new: {vector_store_id}")
-    else:
-        AGENT_VECTOR_STORE_ID = value
-        print(f"Vector store loaded from DB: {value}")
+    text, kb = await render_prompt_versions()
+    await callback.message.answer(text, reply_markup=kb)
+    await callback.answer()
 
 
-async def load_agent_prompt_from_db():
-    global AGENT_PROMPT
+@dp.callback_query(F.data.startswith("admin_prompt_rollback:"))
+async def on_admin_prompt_rollback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        version_id = int(callback.data.split(":", 1)[1])
+    except ValueError:
+        return await callback.answer("Некорректная версия.", show_alert=True)
+
+    prompt = await db.activate_prompt_version(version_id)
+    if prompt is None:
+        return await callback.answer("Такой версии нет.", show_alert=True)
+
+    agent_state.prompt = prompt
+    agent_state.prompt_version = version_id
+    logger.warning("Agent prompt rolled back to v%s by admin %s", version_id, callback.from_user.id)
+
+    text, kb = await render_prompt_versions()
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer(f"Активна v{version_id}.")
+
+
+def log_level_kb() -> InlineKeyboardMarkup:
+    current = get_log_level()
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=f"• {level}" if level == current else level,
+                    callback_data=f"admin_log_level:{level}",
+                )
+                for level in LOG_LEVELS
+            ]
+        ]
+    )
+
+
+@dp.callback_query(F.data == "admin_log_level")
+async def on_admin_log_level(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
 
-    value = await db.get_setting("agent_prompt")
-    if value is None:
-        AGENT_PROMPT = DEFAULT_AGENT_PROMPT
-        await db.set_setting("agent_prompt", DEFAULT_AGENT_PROMPT)
-        print("Agent prompt not found in DB, set default.")
+    await callback.message.answer(
+        f"Текущий уровень логов: <b>{get_log_level()}</b>\n\nВыбери новый:",
+        reply_markup=log_level_kb(),
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("admin_log_level:"))
+async def on_admin_log_level_set(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    level = callback.data.split(":", 1)[1]
+    try:
+        set_log_level(level)
+    except ValueError:
+        return await callback.answer("Неизвестный уровень.", show_alert=True)
+
+    logger.warning("Log level changed to %s by admin %s", level, callback.from_user.id)
+    await callback.message.edit_text(
+        f"Текущий уровень логов: <b>{level}</b>\n\nВыбери новый:",
+        reply_markup=log_level_kb(),
+    )
+    await callback.answer("Готово.")
+
+
+async def ensure_agent_vector_store() -> str:
+    """
+    Vector store создаётся при первой загрузке файла, а не на старте:
+    пока файлов нет, ассистент отвечает без file_search.
+    """
+    state = agent_state.for_tenant()
+
+    async with state.vector_store_lock:
+        if state.vector_store_id is None:
+            vector_store_id = await create_vector_store(f"Agent knowledge base ({get_tenant().name})")
+            await db.set_setting("agent_vector_store_id", vector_store_id)
+            state.vector_store_id = vector_store_id
+            logger.info("Vector store not found in DB, created new: %s", vector_store_id)
+    return state.vector_store_id
+
+
+async def load_agent_settings_from_db():
+    state = agent_state.for_tenant()
+    settings = await db.get_settings(["agent_prompt", "agent_prompt_version", "agent_vector_store_id"])
+
+    # vector store из BOTS_CONFIG важнее сохранённого в settings.
+    if state.vector_store_id is None:
+        state.vector_store_id = settings.get("agent_vector_store_id")
+    if state.vector_store_id:
+        logger.info("Vector store loaded from DB: %s", state.vector_store_id)
+
+    value = settings.get("agent_prompt")
+    version = settings.get("agent_prompt_version")
+    if value is not None:
+        state.prompt = value
+
+    if version is None:
+        # Установки без истории промптов: текущий промпт становится первой версией.
+        state.prompt_version = await db.create_prompt_version(state.prompt, None)
+        logger.info("Agent prompt saved as v%s.", state.prompt_version)
     else:
-        AGENT_PROMPT = value
-        print("Agent prompt loaded from DB.")
+        state.prompt_version = int(version)
+        logger.info("Agent prompt v%s loaded from DB.", state.prompt_version)
 
 
 @dp.callback_query(F.data == "admin_files")
@@ -230,80 +431,250 @@ async def on_admin_file_delete(callback: CallbackQuery):
     await callback.answer("Удалено.")
 
 
-async def should_route_to_admin(user_telegram_id: int) -> Tuple[bool, Optional[int]]:
-    """
-    Возвращает:
-      (True, admin_id)  -> надо переслать админу (ручной режим активен)
-      (False, None)     -> надо обслуживать ИИ (режим ai или ручной протух)
-    """
-    mode, admin_id, taken_at = await db.get_conversation_state(user_telegram_id)
+async def files_select_kb(admin_id: int) -> InlineKeyboardMarkup:
+    files = await agent_file_manager.get_recent_files(limit=FILES_SELECT_LIMIT, offset=0)
+    selected = agent_file_manager.get_selected(admin_id)
 
-    if mode is None:
-        return False, None
+    rows = [
+        [
+            InlineKeyboardButton(
+                text=f"{'☑️' if row['id'] in selected else '⬜'} {row['filename']}",
+                callback_data=f"admin_files_toggle:{row['id']}",
+            )
+        ]
+        for row in files
+    ]
+    rows.append(
+        [
+            InlineKeyboardButton(text=f"Удалить выбранные ({len(selected)})", callback_data="admin_files_delete_selected"),
+            InlineKeyboardButton(text="Сбросить", callback_data="admin_files_select_clear"),
+        ]
+    )
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
-    if mode != "admin":
-        return False, None
 
-    if not admin_id or taken_at is None:
-        await db.set_conversation_mode(user_telegram_id=user_telegram_id, mode="ai", taken_by_admin_id=None)
-        return False, None
+@dp.callback_query(F.data == "admin_files_select")
+async def on_admin_files_select(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    agent_file_manager.clear_selected(callback.from_user.id)
+    await callback.message.answer(
+        f"Отметь файлы для удаления (показаны последние {FILES_SELECT_LIMIT}):",
+        reply_markup=await files_select_kb(callback.from_user.id),
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("admin_files_toggle:"))
+async def on_admin_files_toggle(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        file_id = int(callback.data.split(":", 1)[1])
+    except (ValueError, IndexError):
+        return await callback.answer("Некорректный ID файла.", show_alert=True)
+
+    agent_file_manager.toggle_selected(callback.from_user.id, file_id)
+    await callback.message.edit_reply_markup(reply_markup=await files_select_kb(callback.from_user.id))
+    await callback.answer()
 
-    now = datetime.now(timezone.utc)
-    if taken_at.tzinfo is None:
-        taken_at = taken_at.replace(tzinfo=timezone.utc)
 
-    minutes_passed = (now - taken_at).total_seconds() / 60
+@dp.callback_query(F.data == "admin_files_select_clear")
+async def on_admin_files_select_clear(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
 
-    if minutes_passed > TAKEOVER_TIMEOUT_MINUTES:
-        await db.set_conversation_mode(user_telegram_id=user_telegram_id, mode="ai", taken_by_admin_id=None)
+    agent_file_manager.clear_selected(callback.from_user.id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=await files_select_kb(callback.from_user.id))
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "admin_files_delete_selected")
+async def on_admin_files_delete_selected(callback: CallbackQuery):
+    admin_id = callback.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    selected = agent_file_manager.get_selected(admin_id)
+    if not selected:
+        return await callback.answer("Ничего не выбрано.", show_alert=True)
+
+    await callback.answer("Удаляю...")
+    deleted, failed = await agent_file_manager.delete_files(selected)
+    agent_file_manager.clear_selected(admin_id)
+
+    text = f"Удалено файлов: {deleted}."
+    if failed:
+        text += f"\nНе удалось удалить из OpenAI: {failed}, записи оставлены в базе."
+    await callback.message.edit_text(text, reply_markup=None)
+
+
+@dp.callback_query(F.data == "admin_files_older")
+async def on_admin_files_older(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text=f"{days} дн.", callback_data=f"admin_files_older:{days}")
+                for days in FILES_OLDER_DAYS
+            ]
+        ]
+    )
+    await callback.message.answer("Удалить файлы, загруженные раньше чем:", reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("admin_files_older:"))
+async def on_admin_files_older_confirm(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        days = int(callback.data.split(":", 1)[1])
+    except (ValueError, IndexError):
+        return await callback.answer("Некорректный срок.", show_alert=True)
+
+    files = await agent_file_manager.list_files_older_than(days)
+    if not files:
+        await callback.message.edit_text(f"Файлов старше {days} дн. нет.")
+        return await callback.answer()
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="Удалить", callback_data=f"admin_files_older_ok:{days}")]]
+    )
+    await callback.message.edit_text(
+        f"Файлов старше {days} дн.: {len(files)}. Удалить их из базы и vector store?",
+        reply_markup=keyboard,
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("admin_files_older_ok:"))
+async def on_admin_files_older_delete(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        days = int(callback.data.split(":", 1)[1])
+    except (ValueError, IndexError):
+        return await callback.answer("Некорректный срок.", show_alert=True)
+
+    await callback.answer("Удаляю...")
+    deleted, failed = await agent_file_manager.delete_files_older_than(days)
+
+    text = f"Удалено файлов старше {days} дн.: {deleted}."
+    if failed:
+        text += f"\nНе удалось удалить из OpenAI: {failed}, записи оставлены в базе."
+    await callback.message.edit_text(text, reply_markup=None)
+
+
+@dp.callback_query(F.data.in_({"admin_files_reconcile", "admin_files_reconcile_fix"}))
+async def on_admin_files_reconcile(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    vector_store_id = agent_state.vector_store_id
+    if vector_store_id is None:
+        return await callback.answer("Vector store ещё не создан: файлов не загружали.", show_alert=True)
+
+    dry_run = callback.data == "admin_files_reconcile"
+    await callback.answer("Сверяю..." if dry_run else "Исправляю...")
+
+    try:
+        report = await agent_file_manager.reconcile(vector_store_id, dry_run=dry_run)
+    except Exception as e:
+        logger.exception("Knowledge base reconcile failed")
+        return await callback.message.answer(f"Ошибка сверки: {html.escape(repr(e))}")
+
+    keyboard = None
+    if dry_run and not report.clean:
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="Исправить", callback_data="admin_files_reconcile_fix")]]
+        )
+
+    if dry_run:
+        await callback.message.answer(report.format(), reply_markup=keyboard)
+    else:
+        await callback.message.edit_text(report.format(), reply_markup=None)
+
+
+async def should_route_to_admin(user_telegram_id: int) -> Tuple[bool, Optional[int]]:
+    """
+    Возвращает:
+      (True, admin_id)  -> надо переслать админу (ручной режим активен)
+      (False, None)     -> надо обслуживать ИИ
+
+    Протухший ручной режим здесь не проверяется: его закрывает takeover_expiry.
+    """
+    mode, admin_id, _ = await db.get_conversation_state(user_telegram_id)
+
+    if mode != "admin" or not admin_id:
         return False, None
 
+    takeover_expiry.touch(user_telegram_id)
     return True, int(admin_id)
 
 
 @dp.message(F.chat.type == "private", ~F.text.startswith("/"))
 async def handle_message(message: Message):
-    global AGENT_PROMPT
-
     user_id = message.from_user.id
     text = message.text or ""
 
-    if user_id in ADMIN_IDS and user_id in WAITING_FOR_PROMPT:
+    if user_id in ADMIN_IDS and user_id in agent_state.waiting_for_prompt:
         new_prompt = text.strip()
 
         if not new_prompt:
             return await message.answer("Промпт не может быть пустым. Отправь текст ещё раз.")
 
-        AGENT_PROMPT = new_prompt
-        WAITING_FOR_PROMPT.remove(user_id)
-        await db.set_setting("agent_prompt", AGENT_PROMPT)
+        version = await db.create_prompt_version(new_prompt, user_id)
+        agent_state.prompt = new_prompt
+        agent_state.prompt_version = version
+        agent_state.waiting_for_prompt.remove(user_id)
 
-        safe_prompt = html.escape(AGENT_PROMPT)
+        safe_prompt = html.escape(new_prompt)
         await message.answer(
-            "Промпт агента обновлён!\n\n"
+            f"Промпт агента обновлён, это версия v{version}.\n"
+            "Откатить можно в админ-меню: «Версии промпта».\n\n"
             f"Текущий промпт:\n<code>{safe_prompt}</code>"
         )
         return
 
     if user_id in ADMIN_IDS and agent_file_manager.is_waiting_for_file(user_id):
-        response = await agent_file_manager.handle_file_upload(message, AGENT_VECTOR_STORE_ID)
+        try:
+            vector_store_id = await ensure_agent_vector_store()
+        except Exception:
+            logger.exception("Vector store creation failed")
+            vector_store_id = None
+
+        response = await agent_file_manager.handle_file_upload(message, vector_store_id)
         if response:
             await message.answer(response)
         return
 
     if user_id in ADMIN_IDS:
+        client_id = await reply_target(message)
+        if client_id:
+            await send_operator_reply(message, client_id)
+            return
+
         target_user_id = await db.get_admin_active_chat(user_id)
 
         if not target_user_id:
-            await message.answer("Нет активного диалога. Открой чат через кнопку в лог-группе.")
+            await message.answer(
+                "Нет активного диалога. Открой чат через кнопку в лог-группе "
+                "или ответь реплаем на сообщение клиента."
+            )
             return
 
-        await bot.send_message(chat_id=target_user_id, text=text)
+        await deliver_to_client(message.bot, target_user_id, text)
         await message.answer("Отправлено клиенту.")
-
-        internal_user_id = await db.save_user(telegram_id=target_user_id, username=None)
-        await db.save_message(user_id=internal_user_id, role="admin", content=text)
-
         return
 
     route_to_admin, admin_id = await should_route_to_admin(message.from_user.id)
@@ -312,13 +683,14 @@ async def handle_message(message: Message):
         username = message.from_user.username
         user_label = f"@{username}" if username else f"id:{user_id}"
 
-        await bot.send_message(
+        forwarded = await message.bot.send_message(
             chat_id=admin_id,
             text=f"Сообщение от клиента ({user_label}):\n{text}"
         )
+        await log_message_map.remember(forwarded, user_id)
 
         await send_admin_user_message(
-            bot=bot,
+            bot=message.bot,
             user=message.from_user,
             user_message=text,
         )
@@ -328,6 +700,7 @@ async def handle_message(message: Message):
             username=message.from_user.username
         )
         await db.save_message(user_id=internal_user_id, role="user", content=text)
+        conversation_summarizer.touch(internal_user_id)
         return
 
     internal_user_id = await db.save_user(
@@ -336,43 +709,119 @@ async def handle_message(message: Message):
     )
 
     user_text = message.text or ""
-    await db.save_message(user_id=internal_user_id, role="user", content=user_text)
+    _, summary, has_quota = await asyncio.gather(
+        db.save_message(user_id=internal_user_id, role="user", content=user_text),
+        conversation_summarizer.get_summary(internal_user_id),
+        usage_tracker.has_quota(user_id),
+    )
 
-    waiting_message = await message.answer("думаю...")
+    if not has_quota:
+        await message.answer("Дневной лимит обращений к ассистенту исчерпан. Попробуйте завтра.")
+        return
 
-    try:
-        reply_text = await ask_assistant(
-            user_text,
-            AGENT_PROMPT,
-            vector_store_id=AGENT_VECTOR_STORE_ID,
+    waiting_message = await message.answer("думаю...")
+    # Если бот остановится раньше ответа, lifecycle заменит «думаю...» на просьбу повторить.
+    with lifecycle.placeholder(waiting_message):
+        with log_stage("routing"):
+            route = message_router.route(user_text)
+            logger.debug("Route: %s (score %.2f)", route.label, route.score)
+
+        with log_stage("llm"):
+            try:
+                reply_text = await ask_assistant(
+                    user_text,
+                    agent_state.prompt,
+                    vector_store_id=agent_state.vector_store_id if route.use_file_search else None,
+                    conversation_summary=summary,
+                    user_telegram_id=user_id,
+                    model=route.model,
+                    route=route.label,
+                    route_score=route.score,
+                    prompt_version=agent_state.prompt_version,
+                )
+            except Exception as e:
+                logger.exception("Assistant request failed")
+                await waiting_message.edit_text(f"Произошла ошибка: {e}")
+                return
+
+        with log_stage("reply"):
+            await db.save_message(user_id=internal_user_id, role="assistant", content=reply_text)
+            conversation_summarizer.touch(internal_user_id)
+            await waiting_message.edit_text(reply_text, parse_mode=None)
+
+    with log_stage("reply"):
+        await send_ai_log(
+            bot=message.bot,
+            user=message.from_user,
+            user_message=user_text,
+            ai_answer=reply_text,
         )
-    except Exception as e:
-        await waiting_message.edit_text(f"Произошла ошибка: {e}")
-        return
 
-    await db.save_message(user_id=internal_user_id, role="assistant", content=reply_text)
-    await waiting_message.edit_text(reply_text, parse_mode=None)
 
-    await send_ai_log(
-        bot=message.bot,            
-        user=message.from_user,   
-        user_message=user_text,  
-        ai_answer=reply_text,       
-    )
+async def warm_up(bot: Bot, started: float) -> None:
+    """
+    Всё, без чего бот может отвечать клиентам, догружается уже после старта
+    polling. До окончания прогрева роутер отправляет всё в основную модель,
+    а протухшие перехваты закроются чуть позже.
+    """
+    try:
+        await asyncio.gather(
+            message_router.load(),
+            takeover_expiry.load(),
+        )
+        takeover_expiry.start(bot)
+        await broadcast_engine.resume(bot)
+        logger.info("Warm-up finished in %.0f ms", (time.perf_counter() - started) * 1000)
+    except Exception:
+        logger.exception("Warm-up failed")
+
+
+async def start_tenant(name: str, started: float) -> asyncio.Task:
+    # Выполняется в отдельной задаче gather, поэтому current_tenant не утекает наружу,
+    # а фоновые задачи бота наследуют его контекст.
+    with use_tenant(name):
+        await db.create_table()
+        await load_agent_settings_from_db()
+        usage_tracker.start()
+        stats_aggregator.start()
+        log_message_map.start()
+        return asyncio.create_task(warm_up(bots[name], started))
+
+
+async def stop_tenant(name: str) -> None:
+    with use_tenant(name):
+        await stats_aggregator.close()
+        await log_message_map.close()
+        await broadcast_engine.close()
+        await takeover_expiry.close()
+        await conversation_summarizer.close()
+        await usage_tracker.close()
 
 
 async def main():
+    started = time.perf_counter()
+    setup_logging()
     await db.connect()
-    await db.create_table()
-    await load_agent_prompt_from_db()
-    await load_agent_vector_store_from_db()
+    warm_up_tasks = await asyncio.gather(*(start_tenant(name, started) for name in TENANTS))
+    warm_up_tasks.append(asyncio.create_task(warm_up_client()))
+    update_dedup.start()
 
     try:
-        print("Bot started...")
-        await dp.start_polling(bot)
+        logger.info("Bots started in %.0f ms: %s", (time.perf_counter() - started) * 1000, ", ".join(TENANTS))
+        # Сессии ботов закрываем сами: они нужны, пока дорабатывают обработчики.
+        await dp.start_polling(*bots.values(), close_bot_session=False)
     finally:
+        # Порядок важен: сначала доделываем ответы, потом сбрасываем буферы в БД,
+        # и только после этого закрываем пул, сессии Telegram и логи.
+        await lifecycle.drain()
+        for task in warm_up_tasks:
+            task.cancel()
+        await asyncio.gather(*(stop_tenant(name) for name in TENANTS))
+        await update_dedup.close()
         await db.disconnect()
-        print("Bot stopped.")
+        await asyncio.gather(*(bot.session.close() for bot in bots.values()))
+        logger.info("Bot stopped.")
+        stop_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
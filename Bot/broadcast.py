@@ -0,0 +1,281 @@
+import os
+import logging
+import time
+import asyncio
+from typing import Dict, Optional
+
+from aiogram import Bot, Router, F
+from aiogram.filters import Command
+from aiogram.filters.command import CommandObject
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.types import (
+    Message,
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+)
+
+from .db import db
+from .config import ADMIN_IDS
+from .tenants import TenantLocal
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE_PER_SECOND = float(os.getenv("BROADCAST_RATE_PER_SECOND", "25"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "50"))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "10"))
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_JOB_ATTEMPTS = 5
+BROADCAST_JOB_RETRY_SECONDS = 5.0
+
+broadcast_router = Router()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        # 429 от Telegram: до retry_after не отправляем вообще ничего.
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    def __init__(self, limiter: TokenBucket):
+        self.limiter = limiter
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()
+        self._stopping = asyncio.Event()
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    def start_job(self, bot: Bot, job_id: int) -> None:
+        if job_id in self._tasks:
+            return
+
+        task = asyncio.create_task(self._run_job(bot, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def cancel_job(self, job_id: int) -> None:
+        self._cancelled.add(job_id)
+
+    async def resume(self, bot: Bot) -> None:
+        jobs = await db.list_running_broadcast_jobs()
+        for job in jobs:
+            logger.info("Broadcast #%s: resuming after user id %s", job["id"], job["last_user_id"])
+            self.start_job(bot, job["id"])
+
+    async def close(self) -> None:
+        # Доотправляем текущую пачку и сохраняем чекпоинт, остальное продолжится после рестарта.
+        self._stopping.set()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _send(self, bot: Bot, telegram_id: int, text: str) -> str:
+        for _ in range(BROADCAST_MAX_RETRIES):
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=telegram_id, text=text, parse_mode=None)
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest:
+                return "failed"
+            except Exception as e:
+                logger.warning("Broadcast send error to %s: %r", telegram_id, e, extra={"sample": "broadcast_send"})
+                return "failed"
+        return "failed"
+
+    async def _run_job(self, bot: Bot, job_id: int) -> None:
+        # После ошибки продолжаем с последнего чекпоинта; если попытки кончились,
+        # помечаем рассылку failed, чтобы она не висела в running до рестарта.
+        delay = BROADCAST_JOB_RETRY_SECONDS
+        try:
+            for attempt in range(1, BROADCAST_JOB_ATTEMPTS + 1):
+                try:
+                    await self._run_job_once(bot, job_id)
+                    return
+                except Exception:
+                    logger.exception("Broadcast #%s failed, attempt %s/%s", job_id, attempt, BROADCAST_JOB_ATTEMPTS)
+
+                if job_id in self._cancelled or attempt == BROADCAST_JOB_ATTEMPTS:
+                    break
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+                    # Останавливаемся: рассылка остаётся running и продолжится после рестарта.
+                    return
+                except asyncio.TimeoutError:
+                    delay *= 2
+
+            status = "cancelled" if job_id in self._cancelled else "failed"
+            try:
+                await db.finish_broadcast_job(job_id, status)
+                job = await db.get_broadcast_job(job_id)
+                if job:
+                    counters = {key: job[key] for key in ("sent", "failed", "blocked")}
+                    await self._report_progress(bot, job, counters, status)
+            except Exception:
+                logger.exception("Broadcast #%s: could not mark as %s", job_id, status)
+        finally:
+            self._cancelled.discard(job_id)
+
+    async def _run_job_once(self, bot: Bot, job_id: int) -> None:
+        job = await db.get_broadcast_job(job_id)
+        if not job or job["status"] != "running":
+            return
+
+        counters = {
+            "sent": job["sent"],
+            "failed": job["failed"],
+            "blocked": job["blocked"],
+        }
+        last_user_id = job["last_user_id"]
+        last_progress_at = 0.0
+        status = "done"
+
+        async for chunk in db.iter_broadcast_recipients(after_user_id=last_user_id, chunk_size=BROADCAST_CHUNK_SIZE):
+            if job_id in self._cancelled:
+                status = "cancelled"
+                break
+            if self._stopping.is_set():
+                return
+
+            results = await asyncio.gather(
+                *(self._send(bot, row["telegram_id"], job["text"]) for row in chunk)
+            )
+
+            blocked_ids = []
+            for row, result in zip(chunk, results):
+                counters[result] += 1
+                if result == "blocked":
+                    blocked_ids.append(row["telegram_id"])
+
+            if blocked_ids:
+                await db.mark_users_blocked(blocked_ids)
+
+            last_user_id = chunk[-1]["id"]
+            await db.checkpoint_broadcast_job(job_id, last_user_id=last_user_id, **counters)
+
+            if time.monotonic() - last_progress_at >= BROADCAST_PROGRESS_SECONDS:
+                last_progress_at = time.monotonic()
+                await self._report_progress(bot, job, counters, "running")
+
+        await db.finish_broadcast_job(job_id, status)
+        await self._report_progress(bot, job, counters, status)
+
+    async def _report_progress(self, bot: Bot, job, counters: dict, status: str) -> None:
+        if not job["progress_chat_id"] or not job["progress_message_id"]:
+            return
+
+        keyboard = None
+        if status == "running":
+            keyboard = InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text="Остановить", callback_data=f"broadcast_cancel:{job['id']}")]]
+            )
+
+        try:
+            await bot.edit_message_text(
+                chat_id=job["progress_chat_id"],
+                message_id=job["progress_message_id"],
+                text=format_progress(job["id"], job["total"], counters, status),
+                reply_markup=keyboard,
+            )
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logger.warning("Broadcast #%s progress error: %r", job["id"], e)
+
+
+def format_progress(job_id: int, total: int, counters: dict, status: str) -> str:
+    titles = {
+        "running": "идёт",
+        "done": "завершена",
+        "cancelled": "остановлена",
+        "failed": "прервана из-за ошибки",
+    }
+    processed = counters["sent"] + counters["failed"] + counters["blocked"]
+    return (
+        f"Рассылка #{job_id} {titles.get(status, status)}\n\n"
+        f"Обработано: {processed} из {total}\n"
+        f"Доставлено: {counters['sent']}\n"
+        f"Заблокировали бота: {counters['blocked']}\n"
+        f"Ошибок: {counters['failed']}"
+    )
+
+
+# Лимиты Telegram считаются на бота, поэтому у каждого бота своё ведро.
+broadcast_engine = TenantLocal(lambda: BroadcastEngine(TokenBucket(BROADCAST_RATE_PER_SECOND)))
+
+
+@broadcast_router.message(Command("broadcast"))
+async def start_broadcast(message: Message, command: CommandObject):
+    admin_id = message.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    text = (command.args or "").strip()
+    if not text:
+        return await message.answer("Использование: /broadcast <текст объявления>")
+
+    total = await db.count_broadcast_recipients()
+    job_id = await db.create_broadcast_job(admin_id=admin_id, text=text, total=total)
+
+    counters = {"sent": 0, "failed": 0, "blocked": 0}
+    progress = await message.answer(
+        format_progress(job_id, total, counters, "running"),
+        reply_markup=InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="Остановить", callback_data=f"broadcast_cancel:{job_id}")]]
+        ),
+    )
+    await db.set_broadcast_progress_message(job_id, progress.chat.id, progress.message_id)
+
+    broadcast_engine.start_job(message.bot, job_id)
+
+
+@broadcast_router.callback_query(F.data.startswith("broadcast_cancel:"))
+async def cancel_broadcast(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        job_id = int(callback.data.split(":", 1)[1])
+    except (ValueError, IndexError):
+        return await callback.answer("Некорректный ID рассылки.", show_alert=True)
+
+    if not broadcast_engine.is_running(job_id):
+        await db.finish_broadcast_job(job_id, "cancelled")
+        return await callback.answer("Рассылка уже не выполняется.")
+
+    broadcast_engine.cancel_job(job_id)
+    await callback.answer("Останавливаю рассылку...")
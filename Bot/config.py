@@ -1,5 +1,9 @@
 import os
 
-ADMIN_IDS = [
-    int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x
-]
\ No newline at end of file
+from .tenants import TenantAdminIds
+
+# Админы текущего бота: при нескольких ботах в процессе список у каждого свой.
+ADMIN_IDS = TenantAdminIds()
+
+TAKEOVER_TIMEOUT_MINUTES = int(os.getenv("TAKEOVER_TIMEOUT_MINUTES", "20"))
+TAKEOVER_EXPIRY_TICK_SECONDS = float(os.getenv("TAKEOVER_EXPIRY_TICK_SECONDS", "5"))
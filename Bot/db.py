@@ -1,30 +1,248 @@
 import os
+import logging
+import asyncio
 import asyncpg
-from typing import Optional
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
 from datetime import datetime
 
+from .tenants import current_tenant, tenant_schema
+from .lifecycle import supervisor
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "10"))
+DB_REPLICA_HEALTH_SECONDS = float(os.getenv("DB_REPLICA_HEALTH_SECONDS", "5"))
+
+# Увеличивать при любом изменении схемы в create_table: при совпадении версии
+# DDL на старте пропускается целиком.
+SCHEMA_VERSION = "5"
+
+# Ошибки, после которых реплику считаем недоступной и идём в primary.
+REPLICA_FAILURES = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+)
+
+# SQL методов, планы которых снимает Bot.bench.db: бенчмарк берёт запросы отсюда,
+# поэтому EXPLAIN всегда идёт по тому же тексту, что выполняют методы.
+GET_USER_MESSAGES_SQL = """
+SELECT role, content
+FROM messages
+WHERE user_id = $1
+ORDER BY created_at ASC
+LIMIT $2;
+"""
+
+SEARCH_MESSAGES_SQL = """
+SELECT content
+FROM messages
+WHERE user_id = $1
+  AND content ILIKE '%' || $2 || '%'
+ORDER BY created_at DESC
+LIMIT $3;
+"""
+
+DELETE_OLD_MESSAGES_SQL = """
+DELETE FROM messages
+WHERE id IN (
+    SELECT id
+    FROM messages
+    WHERE user_id = $1
+    ORDER BY created_at ASC
+    LIMIT $2
+);
+"""
+
+GET_CONVERSATION_STATE_SQL = """
+SELECT mode, taken_by_admin_id, taken_at
+FROM conversations
+WHERE user_telegram_id = $1;
+"""
+
+LIST_AGENT_FILES_SQL = """
+SELECT id, filename, created_at
+FROM agent_files
+ORDER BY created_at DESC
+LIMIT $1 OFFSET $2;
+"""
+
+
+class TenantConnection(asyncpg.Connection):
+    """
+    Соединение помнит, на схему какого бота настроен search_path,
+    и переключает его только при смене бота.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._schema: Optional[str] = None
+
+    async def use_schema(self, schema: str) -> None:
+        if self._schema != schema:
+            # Без public: таблица чужого бота не найдётся, даже если забыть про схему.
+            await self.execute(f'SET search_path TO "{schema}";')
+            self._schema = schema
+
+
+async def _setup_connection(conn) -> None:
+    await conn.use_schema(tenant_schema(current_tenant.get()))
+
+
+async def _reset_connection(conn) -> None:
+    # Незавершённую транзакцию asyncpg откатывает сам. Стандартный reset вдобавок
+    # делает RESET ALL, а это лишний запрос и сброс search_path при каждом возврате в пул.
+    return None
+
+
+POOL_OPTIONS = dict(
+    connection_class=TenantConnection,
+    setup=_setup_connection,
+    reset=_reset_connection,
+)
+
+
 class Database:
     def __init__(self):
         self.pool = None
+        self.replica_pool = None
+        self.replica_healthy = False
+        self.replica_lag_seconds: Optional[float] = None
+        self._replica_health_task: Optional[asyncio.Task] = None
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(
+        primary = asyncpg.create_pool(
             user=os.getenv("DB_USER"),
             password=os.getenv("DB_PASSWORD"),
             database=os.getenv("DB_NAME"),
             host=os.getenv("DB_HOST", "localhost"),
             port=int(os.getenv("DB_PORT", 5432)),
             min_size=1,
-            max_size=5,
+            max_size=int(os.getenv("DB_POOL_SIZE", 5)),
+            **POOL_OPTIONS,
         )
-    
+
+        if not DB_REPLICA_HOST:
+            self.pool = await primary
+            return
+
+        # Пулы primary и реплики поднимаем одновременно.
+        self.pool, _ = await asyncio.gather(primary, self._connect_replica())
+        self._replica_health_task = supervisor.spawn("replica_health", self._replica_health_loop)
+
+    async def _connect_replica(self) -> None:
+        try:
+            self.replica_pool = await asyncpg.create_pool(
+                user=os.getenv("DB_REPLICA_USER", os.getenv("DB_USER")),
+                password=os.getenv("DB_REPLICA_PASSWORD", os.getenv("DB_PASSWORD")),
+                database=os.getenv("DB_REPLICA_NAME", os.getenv("DB_NAME")),
+                host=DB_REPLICA_HOST,
+                port=int(os.getenv("DB_REPLICA_PORT", 5432)),
+                min_size=1,
+                max_size=int(os.getenv("DB_REPLICA_POOL_SIZE", 5)),
+                **POOL_OPTIONS,
+            )
+            await self.check_replica()
+        except REPLICA_FAILURES as e:
+            logger.warning("Replica connect error, reads go to primary: %r", e)
+            self.replica_healthy = False
+
     async def disconnect(self) -> None:
+        if self._replica_health_task is not None:
+            self._replica_health_task.cancel()
+            try:
+                await self._replica_health_task
+            except asyncio.CancelledError:
+                pass
+            self._replica_health_task = None
+
+        if self.replica_pool is not None:
+            await self.replica_pool.close()
+
         if self.pool is not None:
             await self.pool.close()
 
+    async def check_replica(self) -> bool:
+        # Равенство receive и replay LSN на самой реплике ничего не говорит: реплика,
+        # потерявшая связь с primary, ничего не получает, и LSN тоже совпадают.
+        # Поэтому сравниваем replay LSN с текущим LSN primary, снятым перед проверкой.
+        # Пока реплика позади, лаг — время с последней применённой транзакции.
+        primary_lsn = await self.pool.fetchval(
+            "SELECT pg_current_wal_lsn()::text;",
+            timeout=DB_REPLICA_HEALTH_SECONDS,
+        )
+        row = await self.replica_pool.fetchrow(
+            """
+            SELECT pg_is_in_recovery() AS in_recovery,
+                   COALESCE(pg_last_wal_replay_lsn() >= $1::text::pg_lsn, FALSE) AS caught_up,
+                   (SELECT status FROM pg_stat_wal_receiver LIMIT 1) AS receiver_status,
+                   COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0) AS replay_age;
+            """,
+            primary_lsn,
+            timeout=DB_REPLICA_HEALTH_SECONDS,
+        )
+
+        # status виден только с pg_read_all_stats; без прав остаётся проверка по LSN.
+        receiver_status = row["receiver_status"]
+        streaming = receiver_status is None or receiver_status == "streaming"
+
+        if not row["in_recovery"] or (streaming and row["caught_up"]):
+            self.replica_lag_seconds = 0.0
+        else:
+            self.replica_lag_seconds = float(row["replay_age"])
+        healthy = streaming and self.replica_lag_seconds <= DB_REPLICA_MAX_LAG_SECONDS
+
+        if healthy != self.replica_healthy:
+            if healthy:
+                state = "healthy"
+            elif not streaming:
+                state = f"not streaming from primary ({receiver_status})"
+            else:
+                state = f"lagging {self.replica_lag_seconds:.1f}s"
+            logger.warning("Replica is %s.", state)
+        self.replica_healthy = healthy
+        return healthy
+
+    async def _replica_health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(DB_REPLICA_HEALTH_SECONDS)
+            try:
+                if self.replica_pool is None:
+                    await self._connect_replica()
+                else:
+                    await self.check_replica()
+            except REPLICA_FAILURES as e:
+                if self.replica_healthy:
+                    logger.warning("Replica health check failed: %r", e)
+                self.replica_healthy = False
+
+    def _read_pool(self, primary: bool = False):
+        if primary or self.replica_pool is None or not self.replica_healthy:
+            return self.pool
+        return self.replica_pool
+
+    async def fetch_read(self, query: str, *args, primary: bool = False):
+        pool = self._read_pool(primary)
+        if pool is self.pool:
+            return await self.pool.fetch(query, *args)
+
+        try:
+            return await pool.fetch(query, *args)
+        except REPLICA_FAILURES as e:
+            logger.warning("Replica read failed, falling back to primary: %r", e, extra={"sample": "replica_read"})
+            self.replica_healthy = False
+            return await self.pool.fetch(query, *args)
+
+    async def fetchrow_read(self, query: str, *args, primary: bool = False):
+        rows = await self.fetch_read(query, *args, primary=primary)
+        return rows[0] if rows else None
+
     async def fetchrow(self, query: str, *args):
         async with self.pool.acquire() as conn:
             return await conn.fetchrow(query, *args)
@@ -38,7 +256,21 @@ class Database:
             return await conn.execute(query, *args) 
 
 
+    async def schema_is_current(self) -> bool:
+        try:
+            value = await self.get_setting("schema_version")
+        except asyncpg.UndefinedTableError:
+            return False
+        return value == SCHEMA_VERSION
+
     async def create_table(self) -> None:
+        """Создаёт таблицы в схеме текущего бота."""
+        if await self.schema_is_current():
+            return
+
+        schema = tenant_schema(current_tenant.get())
+        await self.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}";')
+
         async with self.pool.acquire() as conn:
             await self.execute(
                 """
@@ -108,6 +340,210 @@ class Database:
                 """
             )
 
+            await conn.execute(
+                """
+                ALTER TABLE conversations
+                    ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+                ALTER TABLE admin_sessions
+                    ADD COLUMN IF NOT EXISTS takeover_timeout_minutes INTEGER;
+                """
+            )
+
+            await conn.execute(
+                """
+                ALTER TABLE users
+                    ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ;
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id SERIAL PRIMARY KEY,
+                    admin_id BIGINT NOT NULL,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',   -- 'running' / 'done' / 'cancelled' / 'failed'
+                    total INTEGER NOT NULL DEFAULT 0,
+                    last_user_id INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    progress_chat_id BIGINT,
+                    progress_message_id BIGINT,
+                    created_at TIMESTAMPTZ DEFAULT NOW(),
+                    finished_at TIMESTAMPTZ
+                );
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_usage (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_telegram_id BIGINT,
+                    purpose TEXT NOT NULL,         -- 'assistant' / 'summary'
+                    model TEXT NOT NULL,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0,
+                    file_search_calls INTEGER NOT NULL DEFAULT 0,
+                    latency_ms INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+
+                CREATE TABLE IF NOT EXISTS llm_usage_hourly (
+                    hour TIMESTAMPTZ NOT NULL,
+                    model TEXT NOT NULL,
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    input_tokens BIGINT NOT NULL DEFAULT 0,
+                    output_tokens BIGINT NOT NULL DEFAULT 0,
+                    cached_tokens BIGINT NOT NULL DEFAULT 0,
+                    file_search_calls BIGINT NOT NULL DEFAULT 0,
+                    latency_ms_sum BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (hour, model)
+                );
+
+                CREATE TABLE IF NOT EXISTS llm_usage_daily (
+                    day DATE NOT NULL,
+                    user_telegram_id BIGINT NOT NULL,   -- 0 для фоновых вызовов без клиента
+                    model TEXT NOT NULL,
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    input_tokens BIGINT NOT NULL DEFAULT 0,
+                    output_tokens BIGINT NOT NULL DEFAULT 0,
+                    cached_tokens BIGINT NOT NULL DEFAULT 0,
+                    file_search_calls BIGINT NOT NULL DEFAULT 0,
+                    latency_ms_sum BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, user_telegram_id, model)
+                );
+
+                ALTER TABLE llm_usage
+                    ADD COLUMN IF NOT EXISTS route TEXT,
+                    ADD COLUMN IF NOT EXISTS route_score REAL;
+                ALTER TABLE agent_files
+                    ADD COLUMN IF NOT EXISTS keywords TEXT[];
+                """
+            )
+
+            # Раньше нетекстовым файлам сохранялись ключевые слова из одного имени,
+            # и роутер считал их проиндексированными. NULL — содержимое не прочитано.
+            await self.execute(
+                r"""
+                UPDATE agent_files
+                SET keywords = NULL
+                WHERE keywords IS NOT NULL
+                  AND COALESCE(mime_type, '') NOT LIKE 'text/%'
+                  AND lower(filename) !~ '\.(txt|md|csv|json|html|htm|xml|yaml|yml)$';
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id BIGINT PRIMARY KEY,
+                    claimed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+
+                CREATE INDEX IF NOT EXISTS processed_updates_claimed_at_idx
+                    ON processed_updates USING brin (claimed_at);
+
+                -- NULL — апдейт ещё в обработке; такой claim можно перехватить после lease.
+                ALTER TABLE processed_updates
+                    ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ;
+                UPDATE processed_updates
+                SET processed_at = claimed_at
+                WHERE processed_at IS NULL;
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS takeover_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_telegram_id BIGINT NOT NULL,
+                    admin_id BIGINT,
+                    event TEXT NOT NULL,             -- 'start' / 'end'
+                    duration_seconds INTEGER,        -- только для 'end'
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+
+                CREATE TABLE IF NOT EXISTS stats_hourly (
+                    hour TIMESTAMPTZ PRIMARY KEY,
+                    user_messages BIGINT NOT NULL DEFAULT 0,
+                    ai_messages BIGINT NOT NULL DEFAULT 0,
+                    admin_messages BIGINT NOT NULL DEFAULT 0,
+                    takeovers_started BIGINT NOT NULL DEFAULT 0,
+                    takeovers_ended BIGINT NOT NULL DEFAULT 0,
+                    takeover_seconds BIGINT NOT NULL DEFAULT 0
+                );
+
+                CREATE TABLE IF NOT EXISTS stats_user_activity (
+                    user_id INTEGER PRIMARY KEY,
+                    last_active_day DATE NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS stats_user_activity_day_idx
+                    ON stats_user_activity (last_active_day);
+
+                CREATE TABLE IF NOT EXISTS stats_active_users (
+                    days INTEGER PRIMARY KEY,        -- окно: 1 / 7 / 30 дней
+                    active_users BIGINT NOT NULL,
+                    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_summaries (
+                    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                    summary TEXT NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    updated_at TIMESTAMPTZ DEFAULT NOW()
+                );
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS prompt_versions (
+                    id SERIAL PRIMARY KEY,
+                    prompt TEXT NOT NULL,
+                    created_by BIGINT,               -- NULL для промпта по умолчанию
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    activated_at TIMESTAMPTZ
+                );
+
+                CREATE TABLE IF NOT EXISTS llm_usage_prompt_versions (
+                    prompt_version INTEGER PRIMARY KEY,
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    input_tokens BIGINT NOT NULL DEFAULT 0,
+                    output_tokens BIGINT NOT NULL DEFAULT 0,
+                    cached_tokens BIGINT NOT NULL DEFAULT 0,
+                    latency_ms_sum BIGINT NOT NULL DEFAULT 0
+                );
+
+                ALTER TABLE llm_usage
+                    ADD COLUMN IF NOT EXISTS prompt_version INTEGER;
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS log_message_map (
+                    chat_id BIGINT NOT NULL,          -- лог-чат или личка админа
+                    message_id BIGINT NOT NULL,
+                    user_telegram_id BIGINT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (chat_id, message_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS log_message_map_created_at_idx
+                    ON log_message_map (created_at);
+                """
+            )
+
+        await self.set_setting("schema_version", SCHEMA_VERSION)
+
 
     async def save_user(self, telegram_id: int, username: Optional[str]):
         row = await self.fetchrow(
@@ -118,10 +554,14 @@ class Database:
         if row:
             return row["id"]
 
+        # Первое сообщение клиента может прийти в два обработчика сразу: вторая вставка
+        # упирается в уникальный telegram_id и просто возвращает уже созданную строку.
         row = await self.fetchrow(
             """
             INSERT INTO users (telegram_id, username)
             VALUES ($1, $2)
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET username = COALESCE(users.username, EXCLUDED.username)
             RETURNING id;
             """,
             telegram_id,
@@ -129,6 +569,13 @@ class Database:
         )
         return row["id"]
 
+    async def get_user_by_telegram_id(self, telegram_id: int, primary: bool = False):
+        return await self.fetchrow_read(
+            "SELECT id, username FROM users WHERE telegram_id = $1;",
+            telegram_id,
+            primary=primary,
+        )
+
     async def save_message(self, user_id: int, role: str, content: str) -> None:
         await self.execute(
             """
@@ -140,32 +587,79 @@ class Database:
             content,
         )
 
-    async def search_messages(self, user_id: int, query: str, limit: int = 5):
-        return await self.fetch(
+    async def search_messages(self, user_id: int, query: str, limit: int = 5, primary: bool = False):
+        return await self.fetch_read(
+            SEARCH_MESSAGES_SQL,
+            user_id,
+            query,
+            limit,
+            primary=primary,
+        )
+
+    async def get_user_messages(self, user_id: int, limit: int = 20, primary: bool = False) -> list:
+        return await self.fetch_read(
+            GET_USER_MESSAGES_SQL,
+            user_id,
+            limit,
+            primary=primary,
+        )
+
+    async def get_recent_history(self, user_id: int, limit: int = 20, primary: bool = False) -> list:
+        rows = await self.fetch_read(
             """
-            SELECT content
+            SELECT role, content, created_at
             FROM messages
             WHERE user_id = $1
-              AND content ILIKE '%' || $2 || '%'
             ORDER BY created_at DESC
-            LIMIT $3;
+            LIMIT $2;
             """,
             user_id,
-            query,
             limit,
+            primary=primary,
         )
+        return list(reversed(rows))
 
-    async def get_user_messages(self, user_id: int, limit: int = 20) -> list:
-        return await self.fetch(
+    async def get_messages_after(self, user_id: int, after_message_id: int, limit: int = 200, primary: bool = False) -> list:
+        return await self.fetch_read(
             """
-            SELECT role, content
+            SELECT id, role, content
             FROM messages
             WHERE user_id = $1
-            ORDER BY created_at ASC
-            LIMIT $2;
+              AND id > $2
+            ORDER BY id ASC
+            LIMIT $3;
             """,
             user_id,
+            after_message_id,
             limit,
+            primary=primary,
+        )
+
+    async def get_user_summary(self, user_id: int, primary: bool = False):
+        return await self.fetchrow_read(
+            """
+            SELECT summary, last_message_id, updated_at
+            FROM user_summaries
+            WHERE user_id = $1;
+            """,
+            user_id,
+            primary=primary,
+        )
+
+    async def save_user_summary(self, user_id: int, summary: str, last_message_id: int) -> None:
+        await self.execute(
+            """
+            INSERT INTO user_summaries (user_id, summary, last_message_id, updated_at)
+            VALUES ($1, $2, $3, NOW())
+            ON CONFLICT (user_id) DO UPDATE
+            SET summary = EXCLUDED.summary,
+                last_message_id = EXCLUDED.last_message_id,
+                updated_at = NOW()
+            WHERE user_summaries.last_message_id < EXCLUDED.last_message_id;
+            """,
+            user_id,
+            summary,
+            last_message_id,
         )
 
     async def get_setting(self, key: str) -> Optional[str]:
@@ -176,6 +670,10 @@ class Database:
             return row["value"]
         return None
 
+    async def get_settings(self, keys: list[str]) -> dict[str, str]:
+        rows = await self.fetch("SELECT key, value FROM settings WHERE key = ANY($1::text[]);", keys)
+        return {row["key"]: row["value"] for row in rows}
+
     async def set_setting(self, key: str, value: str) -> None:
         query = """
             INSERT INTO settings (key, value)
@@ -186,25 +684,73 @@ class Database:
         async with self.pool.acquire() as conn:
             await conn.execute(query, key, value)
 
-    async def count_messages(self, user_id: int) -> int:
-        row = await self.fetchrow(
+    async def create_prompt_version(self, prompt: str, created_by: Optional[int]) -> int:
+        # Новая версия сразу становится активной: agent_prompt и agent_prompt_version меняются вместе с ней.
+        query = """
+        WITH v AS (
+            INSERT INTO prompt_versions (prompt, created_by, activated_at)
+            VALUES ($1, $2, NOW())
+            RETURNING id, prompt
+        ),
+        s AS (
+            INSERT INTO settings (key, value)
+            SELECT x.key, x.value
+            FROM v, LATERAL (VALUES ('agent_prompt', v.prompt), ('agent_prompt_version', v.id::text)) AS x(key, value)
+            ON CONFLICT (key) DO UPDATE
+            SET value = EXCLUDED.value
+        )
+        SELECT id FROM v;
+        """
+        return await self.pool.fetchval(query, prompt, created_by)
+
+    async def activate_prompt_version(self, version_id: int) -> Optional[str]:
+        query = """
+        WITH v AS (
+            UPDATE prompt_versions
+            SET activated_at = NOW()
+            WHERE id = $1
+            RETURNING id, prompt
+        ),
+        s AS (
+            INSERT INTO settings (key, value)
+            SELECT x.key, x.value
+            FROM v, LATERAL (VALUES ('agent_prompt', v.prompt), ('agent_prompt_version', v.id::text)) AS x(key, value)
+            ON CONFLICT (key) DO UPDATE
+            SET value = EXCLUDED.value
+        )
+        SELECT prompt FROM v;
+        """
+        return await self.pool.fetchval(query, version_id)
+
+    async def list_prompt_versions(self, limit: int = 10, primary: bool = False) -> list:
+        return await self.fetch_read(
+            """
+            SELECT v.id, v.prompt, v.created_by, v.created_at, v.activated_at,
+                   COALESCE(u.calls, 0) AS calls,
+                   COALESCE(u.input_tokens, 0) AS input_tokens,
+                   COALESCE(u.output_tokens, 0) AS output_tokens,
+                   COALESCE(u.cached_tokens, 0) AS cached_tokens,
+                   COALESCE(u.latency_ms_sum, 0) AS latency_ms_sum
+            FROM prompt_versions v
+            LEFT JOIN llm_usage_prompt_versions u ON u.prompt_version = v.id
+            ORDER BY v.id DESC
+            LIMIT $1;
+            """,
+            limit,
+            primary=primary,
+        )
+
+    async def count_messages(self, user_id: int, primary: bool = False) -> int:
+        row = await self.fetchrow_read(
             "SELECT COUNT(*) AS count FROM messages WHERE user_id = $1;",
             user_id,
+            primary=primary,
         )
         return row["count"]
 
     async def delete_old_messages(self, user_id: int, extra: int) -> None:
         await self.execute(
-            """
-            DELETE FROM messages
-            WHERE id IN (
-                SELECT id
-                FROM messages
-                WHERE user_id = $1
-                ORDER BY created_at ASC
-                LIMIT $2
-            );
-            """,
+            DELETE_OLD_MESSAGES_SQL,
             user_id,
             extra,
         )
@@ -218,12 +764,13 @@ class Database:
         vector_store_id: Optional[str] = None,
         mime_type: Optional[str] = None,
         file_size: Optional[int] = None,
+        keywords: Optional[list[str]] = None,
     ) -> int:
         row = await self.fetchrow(
             """
             INSERT INTO agent_files (filename, telegram_file_id, openai_file_id,
-                                     vector_store_id, mime_type, file_size)
-            VALUES ($1, $2, $3, $4, $5, $6)
+                                     vector_store_id, mime_type, file_size, keywords)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
             RETURNING id;
             """,
             filename,
@@ -232,29 +779,35 @@ class Database:
             vector_store_id,
             mime_type,
             file_size,
+            keywords,
         )
         return row["id"]
 
-    async def list_agent_files(self, limit: int = 20, offset: int = 0):
+    async def list_agent_file_keywords(self) -> list:
         return await self.fetch(
             """
-            SELECT id, filename, created_at
-            FROM agent_files
-            ORDER BY created_at DESC
-            LIMIT $1 OFFSET $2;
-            """,
+            SELECT id, filename, keywords
+            FROM agent_files;
+            """
+        )
+
+    async def list_agent_files(self, limit: int = 20, offset: int = 0, primary: bool = False):
+        return await self.fetch_read(
+            LIST_AGENT_FILES_SQL,
             limit,
             offset,
+            primary=primary,
         )
 
-    async def get_agent_file(self, file_id: int):
-        return await self.fetchrow(
+    async def get_agent_file(self, file_id: int, primary: bool = False):
+        return await self.fetchrow_read(
             """
             SELECT *
             FROM agent_files
             WHERE id = $1;
             """,
             file_id,
+            primary=primary,
         )
 
     async def delete_agent_file(self, file_id: int) -> None:
@@ -266,8 +819,65 @@ class Database:
             file_id,
         )
 
-    async def count_agent_files(self) -> int:
-        row = await self.fetchrow("SELECT COUNT(*) AS c FROM agent_files;")
+    async def list_agent_files_before(self, before: datetime, primary: bool = False):
+        return await self.fetch_read(
+            """
+            SELECT id, filename, openai_file_id, vector_store_id, created_at
+            FROM agent_files
+            WHERE created_at < $1
+            ORDER BY created_at;
+            """,
+            before,
+            primary=primary,
+        )
+
+    async def get_agent_files(self, file_ids: list[int], primary: bool = False):
+        return await self.fetch_read(
+            """
+            SELECT id, filename, openai_file_id, vector_store_id, created_at
+            FROM agent_files
+            WHERE id = ANY($1::int[])
+            ORDER BY id;
+            """,
+            file_ids,
+            primary=primary,
+        )
+
+    async def list_agent_file_refs(self, vector_store_id: str, primary: bool = False):
+        return await self.fetch_read(
+            """
+            SELECT id, filename, openai_file_id, vector_store_id, created_at
+            FROM agent_files
+            WHERE vector_store_id = $1;
+            """,
+            vector_store_id,
+            primary=primary,
+        )
+
+    async def list_agent_file_refs_outside(self, vector_store_id: str, primary: bool = False):
+        # Записи другого (например, прежнего) vector store: при сверке их не трогаем.
+        return await self.fetch_read(
+            """
+            SELECT id, filename, openai_file_id, vector_store_id, created_at
+            FROM agent_files
+            WHERE vector_store_id IS DISTINCT FROM $1;
+            """,
+            vector_store_id,
+            primary=primary,
+        )
+
+    async def delete_agent_files(self, file_ids: list[int]) -> int:
+        result = await self.execute(
+            """
+            DELETE FROM agent_files
+            WHERE id = ANY($1::int[]);
+            """,
+            file_ids,
+        )
+        return int(result.split()[-1])
+
+    async def count_agent_files(self, primary: bool = False) -> int:
+        row = await self.fetchrow_read("SELECT COUNT(*) AS c FROM agent_files;", primary=primary)
         return row["c"] if row else 0
 
 
@@ -278,19 +888,226 @@ class Database:
         taken_by_admin_id: Optional[int] = None,
     ) -> None:
 
+        # Вместе со сменой режима пишем события захвата/освобождения для /stats.
         query = """
-        INSERT INTO conversations (user_telegram_id, mode, taken_by_admin_id, taken_at)
-        VALUES ($1, $2, $3, CASE WHEN $2 = 'admin' THEN NOW() ELSE NULL END)
-        ON CONFLICT (user_telegram_id) 
-        DO UPDATE SET
-            mode = EXCLUDED.mode,
-            taken_by_admin_id = EXCLUDED.taken_by_admin_id,
-            taken_at = CASE WHEN EXCLUDED.mode='admin' THEN NOW() ELSE NULL END;
+        WITH prev AS (
+            SELECT mode, taken_by_admin_id, taken_at
+            FROM conversations
+            WHERE user_telegram_id = $1
+            FOR UPDATE
+        ),
+        upsert AS (
+            INSERT INTO conversations (user_telegram_id, mode, taken_by_admin_id, taken_at)
+            VALUES ($1, $2, $3, CASE WHEN $2 = 'admin' THEN NOW() ELSE NULL END)
+            ON CONFLICT (user_telegram_id) 
+            DO UPDATE SET
+                mode = EXCLUDED.mode,
+                taken_by_admin_id = EXCLUDED.taken_by_admin_id,
+                taken_at = CASE WHEN EXCLUDED.mode='admin' THEN NOW() ELSE NULL END,
+                expires_at = NULL
+        ),
+        events AS (
+            INSERT INTO takeover_events (user_telegram_id, admin_id, event, duration_seconds)
+            SELECT $1, p.taken_by_admin_id, 'end', GREATEST(0, EXTRACT(EPOCH FROM NOW() - p.taken_at))::int
+            FROM prev p
+            WHERE p.mode = 'admin'
+              AND ($2 <> 'admin' OR p.taken_by_admin_id IS DISTINCT FROM $3)
+            UNION ALL
+            SELECT $1, $3, 'start', NULL
+            WHERE $2 = 'admin'
+              AND NOT EXISTS (
+                  SELECT 1 FROM prev p WHERE p.mode = 'admin' AND p.taken_by_admin_id = $3
+              )
+        )
+        SELECT 1;
         """
 
         await self.pool.execute(query, user_telegram_id, mode, taken_by_admin_id)
 
 
+    async def take_over_conversation(
+        self,
+        user_telegram_id: int,
+        admin_id: int,
+        history_limit: int = 20,
+        activate: bool = True,
+    ):
+        # Захват — compare-and-set в ON CONFLICT: строку забираем, только если она свободна
+        # или уже наша. Сессия админа, событие для /stats, карточка клиента и страница
+        # истории приходят тем же запросом. owner_admin_id читается из снимка до захвата.
+        # activate=False — ответ реплаем из лог-чата: активный диалог админа не переключаем.
+        query = """
+        WITH claim AS (
+            INSERT INTO conversations AS c (user_telegram_id, mode, taken_by_admin_id, taken_at)
+            VALUES ($1, 'admin', $2, NOW())
+            ON CONFLICT (user_telegram_id)
+            DO UPDATE SET
+                mode = 'admin',
+                taken_by_admin_id = $2,
+                taken_at = CASE WHEN c.mode = 'admin' AND c.taken_by_admin_id = $2 THEN c.taken_at ELSE NOW() END,
+                expires_at = NULL
+            WHERE c.mode <> 'admin' OR c.taken_by_admin_id IS NULL OR c.taken_by_admin_id = $2
+            RETURNING c.taken_at
+        ),
+        session AS (
+            INSERT INTO admin_sessions (admin_id, active_user_telegram_id, updated_at)
+            SELECT $2, $1, NOW() FROM claim WHERE $4::boolean
+            ON CONFLICT (admin_id)
+            DO UPDATE SET active_user_telegram_id = EXCLUDED.active_user_telegram_id,
+                        updated_at = NOW()
+        ),
+        events AS (
+            INSERT INTO takeover_events (user_telegram_id, admin_id, event)
+            SELECT $1, $2, 'start' FROM claim WHERE claim.taken_at = NOW()
+        ),
+        u AS (
+            SELECT id, username FROM users WHERE telegram_id = $1
+        ),
+        hist AS (
+            SELECT m.role, m.content, m.created_at
+            FROM messages m
+            JOIN u ON m.user_id = u.id
+            WHERE EXISTS (SELECT 1 FROM claim)
+            ORDER BY m.created_at DESC
+            LIMIT $3
+        )
+        SELECT
+            EXISTS (SELECT 1 FROM claim) AS taken,
+            (SELECT taken_by_admin_id FROM conversations WHERE user_telegram_id = $1) AS owner_admin_id,
+            u.id AS user_id,
+            u.username,
+            (SELECT summary FROM user_summaries s WHERE s.user_id = u.id) AS summary,
+            ARRAY(SELECT role FROM hist ORDER BY created_at) AS roles,
+            ARRAY(SELECT content FROM hist ORDER BY created_at) AS contents
+        FROM (SELECT 1) AS one
+        LEFT JOIN u ON TRUE;
+        """
+        row = await self.pool.fetchrow(query, user_telegram_id, admin_id, history_limit, activate)
+        if not row["taken"] and row["owner_admin_id"] is None:
+            # Соседний захват вставил строку уже после снимка запроса — владельца дочитываем.
+            owner = await self.pool.fetchval(
+                "SELECT taken_by_admin_id FROM conversations WHERE user_telegram_id = $1;",
+                user_telegram_id,
+            )
+            row = {**dict(row), "owner_admin_id": owner}
+        return row
+
+
+    async def return_conversation_to_ai(self, admin_id: int, user_telegram_id: Optional[int] = None):
+        # ИИ возвращаем, только если клиент всё ещё за этим админом: строку блокируем
+        # и проверяем владельца, сессию админа очищаем в том же запросе.
+        # Без user_telegram_id берётся активный диалог админа.
+        query = """
+        WITH session AS (
+            SELECT $2::bigint AS user_telegram_id
+            WHERE $2::bigint IS NOT NULL
+            UNION ALL
+            SELECT active_user_telegram_id
+            FROM admin_sessions
+            WHERE $2::bigint IS NULL AND admin_id = $1 AND active_user_telegram_id IS NOT NULL
+        ),
+        prev AS (
+            SELECT c.user_telegram_id, c.taken_at
+            FROM conversations c
+            JOIN session s ON s.user_telegram_id = c.user_telegram_id
+            WHERE c.mode = 'admin' AND c.taken_by_admin_id = $1
+            FOR UPDATE OF c
+        ),
+        released AS (
+            UPDATE conversations c
+            SET mode = 'ai', taken_by_admin_id = NULL, taken_at = NULL, expires_at = NULL
+            FROM prev p
+            WHERE c.user_telegram_id = p.user_telegram_id
+            RETURNING c.user_telegram_id
+        ),
+        events AS (
+            INSERT INTO takeover_events (user_telegram_id, admin_id, event, duration_seconds)
+            SELECT p.user_telegram_id, $1, 'end', GREATEST(0, EXTRACT(EPOCH FROM NOW() - p.taken_at))::int
+            FROM prev p
+        ),
+        cleared AS (
+            UPDATE admin_sessions
+            SET active_user_telegram_id = NULL, updated_at = NOW()
+            WHERE admin_id = $1 AND active_user_telegram_id IN (SELECT user_telegram_id FROM session)
+        )
+        SELECT
+            s.user_telegram_id,
+            EXISTS (SELECT 1 FROM released) AS released,
+            c.mode,
+            c.taken_by_admin_id AS owner_admin_id
+        FROM session s
+        LEFT JOIN conversations c ON c.user_telegram_id = s.user_telegram_id;
+        """
+        return await self.pool.fetchrow(query, admin_id, user_telegram_id)
+
+
+    async def list_operator_queue(self, admin_id: int, limit: int = 20) -> list:
+        # Сначала клиенты, которые ждут ответа (последнее сообщение от них), дольше всех ждущие — выше.
+        query = """
+        SELECT c.user_telegram_id, u.username, last.role AS last_role, last.created_at AS last_at
+        FROM conversations c
+        LEFT JOIN users u ON u.telegram_id = c.user_telegram_id
+        LEFT JOIN LATERAL (
+            SELECT m.role, m.created_at
+            FROM messages m
+            WHERE m.user_id = u.id
+            ORDER BY m.created_at DESC
+            LIMIT 1
+        ) last ON TRUE
+        WHERE c.mode = 'admin' AND c.taken_by_admin_id = $1
+        ORDER BY (last.role = 'user') DESC NULLS LAST, last.created_at ASC NULLS LAST
+        LIMIT $2;
+        """
+        return await self.pool.fetch(query, admin_id, limit)
+
+
+    async def save_log_message(self, chat_id: int, message_id: int, user_telegram_id: int) -> None:
+        await self.execute(
+            """
+            INSERT INTO log_message_map (chat_id, message_id, user_telegram_id)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (chat_id, message_id) DO NOTHING;
+            """,
+            chat_id,
+            message_id,
+            user_telegram_id,
+        )
+
+
+    async def get_log_message_user(self, chat_id: int, message_id: int) -> Optional[int]:
+        row = await self.fetchrow(
+            "SELECT user_telegram_id FROM log_message_map WHERE chat_id = $1 AND message_id = $2;",
+            chat_id,
+            message_id,
+        )
+        return row["user_telegram_id"] if row else None
+
+
+    async def delete_old_log_messages(self, ttl_days: int) -> str:
+        return await self.execute(
+            "DELETE FROM log_message_map WHERE created_at < NOW() - make_interval(days => $1);",
+            ttl_days,
+        )
+
+
+    async def release_admin_chat(self, admin_id: int) -> Optional[int]:
+        # Очистка и чтение прежнего значения одним запросом: два /close подряд не закроют диалог дважды.
+        query = """
+        WITH old AS (
+            SELECT admin_id, active_user_telegram_id
+            FROM admin_sessions
+            WHERE admin_id = $1
+            FOR UPDATE
+        )
+        UPDATE admin_sessions s
+        SET active_user_telegram_id = NULL, updated_at = NOW()
+        FROM old
+        WHERE s.admin_id = old.admin_id AND old.active_user_telegram_id IS NOT NULL
+        RETURNING old.active_user_telegram_id;
+        """
+        return await self.pool.fetchval(query, admin_id)
+
+
     async def set_admin_active_chat(self, admin_id: int, user_telegram_id: int) -> None:
         query = """
         INSERT INTO admin_sessions (admin_id, active_user_telegram_id, updated_at)
@@ -318,15 +1135,601 @@ class Database:
 
 
     async def get_conversation_state(self, user_telegram_id: int) -> tuple[Optional[str], Optional[int], Optional[datetime]]:
-        query = """
-        SELECT mode, taken_by_admin_id, taken_at
-        FROM conversations
-        WHERE user_telegram_id = $1;
-        """
-        row = await self.pool.fetchrow(query, user_telegram_id)
+        row = await self.pool.fetchrow(GET_CONVERSATION_STATE_SQL, user_telegram_id)
         if not row:
             return None, None, None
         return row["mode"], row["taken_by_admin_id"], row["taken_at"]
 
 
+    async def list_admin_conversations(
+        self,
+        default_timeout_minutes: int,
+        user_telegram_ids: Optional[list[int]] = None,
+    ) -> list:
+        query = """
+        SELECT c.user_telegram_id,
+               c.taken_by_admin_id,
+               s.takeover_timeout_minutes,
+               COALESCE(
+                   c.expires_at,
+                   c.taken_at + make_interval(mins => COALESCE(s.takeover_timeout_minutes, $1))
+               ) AS expires_at
+        FROM conversations c
+        LEFT JOIN admin_sessions s ON s.admin_id = c.taken_by_admin_id
+        WHERE c.mode = 'admin'
+          AND ($2::bigint[] IS NULL OR c.user_telegram_id = ANY($2::bigint[]));
+        """
+        return await self.pool.fetch(query, default_timeout_minutes, user_telegram_ids)
+
+
+    async def set_conversation_deadlines(self, user_telegram_ids: list[int], deadlines: list[datetime]) -> None:
+        query = """
+        UPDATE conversations c
+        SET expires_at = d.expires_at
+        FROM unnest($1::bigint[], $2::timestamptz[]) AS d(user_telegram_id, expires_at)
+        WHERE c.user_telegram_id = d.user_telegram_id
+          AND c.mode = 'admin';
+        """
+        await self.pool.execute(query, user_telegram_ids, deadlines)
+
+
+    async def expire_conversations(self, user_telegram_ids: list[int]) -> list:
+        query = """
+        WITH expired AS (
+            SELECT user_telegram_id, taken_by_admin_id, taken_at
+            FROM conversations
+            WHERE user_telegram_id = ANY($1::bigint[])
+              AND mode = 'admin'
+              AND (expires_at IS NULL OR expires_at <= NOW())
+            FOR UPDATE
+        ),
+        released AS (
+            UPDATE conversations c
+            SET mode = 'ai', taken_by_admin_id = NULL, taken_at = NULL, expires_at = NULL
+            FROM expired e
+            WHERE c.user_telegram_id = e.user_telegram_id
+        ),
+        sessions AS (
+            UPDATE admin_sessions s
+            SET active_user_telegram_id = NULL, updated_at = NOW()
+            FROM expired e
+            WHERE s.admin_id = e.taken_by_admin_id
+              AND s.active_user_telegram_id = e.user_telegram_id
+        ),
+        events AS (
+            INSERT INTO takeover_events (user_telegram_id, admin_id, event, duration_seconds)
+            SELECT user_telegram_id, taken_by_admin_id, 'end',
+                   GREATEST(0, EXTRACT(EPOCH FROM NOW() - taken_at))::int
+            FROM expired
+        )
+        SELECT user_telegram_id, taken_by_admin_id FROM expired;
+        """
+        return await self.pool.fetch(query, user_telegram_ids)
+
+
+    async def get_admin_takeover_timeout(self, admin_id: int) -> Optional[int]:
+        query = "SELECT takeover_timeout_minutes FROM admin_sessions WHERE admin_id = $1;"
+        row = await self.pool.fetchrow(query, admin_id)
+        return row["takeover_timeout_minutes"] if row else None
+
+
+    async def set_admin_takeover_timeout(self, admin_id: int, minutes: int) -> None:
+        query = """
+        INSERT INTO admin_sessions (admin_id, takeover_timeout_minutes, updated_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (admin_id)
+        DO UPDATE SET takeover_timeout_minutes = EXCLUDED.takeover_timeout_minutes,
+                    updated_at = NOW();
+        """
+        await self.pool.execute(query, admin_id, minutes)
+
+
+    async def count_broadcast_recipients(self) -> int:
+        row = await self.fetchrow("SELECT COUNT(*) AS c FROM users WHERE blocked_at IS NULL;")
+        return row["c"] if row else 0
+
+    async def iter_broadcast_recipients(
+        self,
+        after_user_id: int = 0,
+        window: int = 5000,
+        chunk_size: int = 100,
+    ) -> AsyncIterator[list]:
+        # Keyset-пагинация по id: соединение берётся из пула на одно окно и не держится
+        # всю многочасовую рассылку, а в памяти лежит одно окно.
+        while True:
+            rows = await self.fetch(
+                """
+                SELECT id, telegram_id
+                FROM users
+                WHERE id > $1
+                  AND blocked_at IS NULL
+                ORDER BY id ASC
+                LIMIT $2;
+                """,
+                after_user_id,
+                window,
+            )
+            if not rows:
+                return
+
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i:i + chunk_size]
+
+            if len(rows) < window:
+                return
+            after_user_id = rows[-1]["id"]
+
+    async def mark_users_blocked(self, telegram_ids: list[int]) -> None:
+        await self.execute(
+            """
+            UPDATE users
+            SET blocked_at = NOW()
+            WHERE telegram_id = ANY($1::bigint[])
+              AND blocked_at IS NULL;
+            """,
+            telegram_ids,
+        )
+
+    async def create_broadcast_job(self, admin_id: int, text: str, total: int) -> int:
+        row = await self.fetchrow(
+            """
+            INSERT INTO broadcast_jobs (admin_id, text, total)
+            VALUES ($1, $2, $3)
+            RETURNING id;
+            """,
+            admin_id,
+            text,
+            total,
+        )
+        return row["id"]
+
+    async def get_broadcast_job(self, job_id: int):
+        return await self.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1;", job_id)
+
+    async def list_running_broadcast_jobs(self) -> list:
+        return await self.fetch(
+            "SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id ASC;"
+        )
+
+    async def set_broadcast_progress_message(self, job_id: int, chat_id: int, message_id: int) -> None:
+        await self.execute(
+            """
+            UPDATE broadcast_jobs
+            SET progress_chat_id = $2, progress_message_id = $3
+            WHERE id = $1;
+            """,
+            job_id,
+            chat_id,
+            message_id,
+        )
+
+    async def checkpoint_broadcast_job(
+        self,
+        job_id: int,
+        *,
+        last_user_id: int,
+        sent: int,
+        failed: int,
+        blocked: int,
+    ) -> None:
+        await self.execute(
+            """
+            UPDATE broadcast_jobs
+            SET last_user_id = $2, sent = $3, failed = $4, blocked = $5
+            WHERE id = $1;
+            """,
+            job_id,
+            last_user_id,
+            sent,
+            failed,
+            blocked,
+        )
+
+    async def finish_broadcast_job(self, job_id: int, status: str) -> None:
+        await self.execute(
+            """
+            UPDATE broadcast_jobs
+            SET status = $2, finished_at = NOW()
+            WHERE id = $1
+              AND status = 'running';
+            """,
+            job_id,
+            status,
+        )
+
+
+    async def save_llm_usage_batch(self, records: list, hourly: list, daily: list, prompt_versions: list) -> None:
+        # Сырые строки и инкременты роллапов пишутся одной транзакцией.
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    "llm_usage",
+                    records=records,
+                    columns=[
+                        "user_telegram_id", "purpose", "model",
+                        "input_tokens", "output_tokens", "cached_tokens",
+                        "file_search_calls", "latency_ms", "created_at",
+                        "route", "route_score", "prompt_version",
+                    ],
+                )
+
+                await conn.executemany(
+                    """
+                    INSERT INTO llm_usage_hourly AS t (hour, model, calls, input_tokens, output_tokens,
+                                                       cached_tokens, file_search_calls, latency_ms_sum)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    ON CONFLICT (hour, model) DO UPDATE
+                    SET calls = t.calls + EXCLUDED.calls,
+                        input_tokens = t.input_tokens + EXCLUDED.input_tokens,
+                        output_tokens = t.output_tokens + EXCLUDED.output_tokens,
+                        cached_tokens = t.cached_tokens + EXCLUDED.cached_tokens,
+                        file_search_calls = t.file_search_calls + EXCLUDED.file_search_calls,
+                        latency_ms_sum = t.latency_ms_sum + EXCLUDED.latency_ms_sum;
+                    """,
+                    hourly,
+                )
+
+                await conn.executemany(
+                    """
+                    INSERT INTO llm_usage_daily AS t (day, user_telegram_id, model, calls, input_tokens,
+                                                      output_tokens, cached_tokens, file_search_calls,
+                                                      latency_ms_sum)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                    ON CONFLICT (day, user_telegram_id, model) DO UPDATE
+                    SET calls = t.calls + EXCLUDED.calls,
+                        input_tokens = t.input_tokens + EXCLUDED.input_tokens,
+                        output_tokens = t.output_tokens + EXCLUDED.output_tokens,
+                        cached_tokens = t.cached_tokens + EXCLUDED.cached_tokens,
+                        file_search_calls = t.file_search_calls + EXCLUDED.file_search_calls,
+                        latency_ms_sum = t.latency_ms_sum + EXCLUDED.latency_ms_sum;
+                    """,
+                    daily,
+                )
+
+                await conn.executemany(
+                    """
+                    INSERT INTO llm_usage_prompt_versions AS t (prompt_version, calls, input_tokens,
+                                                                output_tokens, cached_tokens, latency_ms_sum)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    ON CONFLICT (prompt_version) DO UPDATE
+                    SET calls = t.calls + EXCLUDED.calls,
+                        input_tokens = t.input_tokens + EXCLUDED.input_tokens,
+                        output_tokens = t.output_tokens + EXCLUDED.output_tokens,
+                        cached_tokens = t.cached_tokens + EXCLUDED.cached_tokens,
+                        latency_ms_sum = t.latency_ms_sum + EXCLUDED.latency_ms_sum;
+                    """,
+                    prompt_versions,
+                )
+
+    async def get_user_daily_tokens(self, user_telegram_id: int, day) -> int:
+        row = await self.fetchrow(
+            """
+            SELECT COALESCE(SUM(input_tokens + output_tokens), 0) AS tokens
+            FROM llm_usage_daily
+            WHERE day = $1 AND user_telegram_id = $2;
+            """,
+            day,
+            user_telegram_id,
+        )
+        return int(row["tokens"]) if row else 0
+
+    async def get_usage_by_model(self, since_day, primary: bool = False) -> list:
+        return await self.fetch_read(
+            """
+            SELECT model,
+                   SUM(calls) AS calls,
+                   SUM(input_tokens) AS input_tokens,
+                   SUM(output_tokens) AS output_tokens,
+                   SUM(cached_tokens) AS cached_tokens,
+                   SUM(file_search_calls) AS file_search_calls,
+                   SUM(latency_ms_sum) AS latency_ms_sum
+            FROM llm_usage_daily
+            WHERE day >= $1
+            GROUP BY model
+            ORDER BY model;
+            """,
+            since_day,
+            primary=primary,
+        )
+
+    async def get_top_usage_users(self, day, limit: int = 10, primary: bool = False) -> list:
+        return await self.fetch_read(
+            """
+            SELECT user_telegram_id,
+                   SUM(calls) AS calls,
+                   SUM(input_tokens + output_tokens) AS tokens
+            FROM llm_usage_daily
+            WHERE day = $1
+              AND user_telegram_id <> 0
+            GROUP BY user_telegram_id
+            ORDER BY tokens DESC
+            LIMIT $2;
+            """,
+            day,
+            limit,
+            primary=primary,
+        )
+
+    async def get_hourly_usage(self, since, primary: bool = False) -> list:
+        return await self.fetch_read(
+            """
+            SELECT hour,
+                   SUM(calls) AS calls,
+                   SUM(input_tokens + output_tokens) AS tokens,
+                   SUM(latency_ms_sum) AS latency_ms_sum
+            FROM llm_usage_hourly
+            WHERE hour >= $1
+            GROUP BY hour
+            ORDER BY hour ASC;
+            """,
+            since,
+            primary=primary,
+        )
+
+
+    async def claim_update(self, update_id: int, lease_seconds: float) -> bool:
+        # Незавершённый claim старше lease остался от упавшего процесса — забираем его.
+        row = await self.fetchrow(
+            """
+            INSERT INTO processed_updates (update_id)
+            VALUES ($1)
+            ON CONFLICT (update_id) DO UPDATE
+            SET claimed_at = NOW()
+            WHERE processed_updates.processed_at IS NULL
+              AND processed_updates.claimed_at < NOW() - make_interval(secs => $2)
+            RETURNING update_id;
+            """,
+            update_id,
+            lease_seconds,
+        )
+        return row is not None
+
+    async def finish_update(self, update_id: int) -> None:
+        await self.execute(
+            "UPDATE processed_updates SET processed_at = NOW() WHERE update_id = $1;",
+            update_id,
+        )
+
+    async def release_update(self, update_id: int) -> None:
+        await self.execute(
+            "DELETE FROM processed_updates WHERE update_id = $1 AND processed_at IS NULL;",
+            update_id,
+        )
+
+    async def delete_old_update_claims(self, ttl_hours: int) -> str:
+        return await self.execute(
+            """
+            DELETE FROM processed_updates
+            WHERE claimed_at < NOW() - make_interval(hours => $1);
+            """,
+            ttl_hours,
+        )
+
+
+    async def _advance_high_water_mark(self, conn, key: str) -> int:
+        # FOR UPDATE сериализует агрегатор между процессами.
+        await conn.execute(
+            "INSERT INTO settings (key, value) VALUES ($1, '0') ON CONFLICT (key) DO NOTHING;",
+            key,
+        )
+        row = await conn.fetchrow("SELECT value FROM settings WHERE key = $1 FOR UPDATE;", key)
+        return int(row["value"])
+
+    async def rollup_message_stats(self, batch_size: int, settle_seconds: int) -> int:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                hwm = await self._advance_high_water_mark(conn, "stats_messages_hwm")
+
+                # Самые свежие строки откладываем: транзакции с меньшим id могут ещё не закоммититься.
+                row = await conn.fetchrow(
+                    """
+                    WITH candidates AS (
+                        SELECT id, user_id, role, created_at
+                        FROM messages
+                        WHERE id > $1
+                        ORDER BY id ASC
+                        LIMIT $2
+                    ),
+                    batch AS (
+                        SELECT *
+                        FROM candidates
+                        WHERE id < COALESCE(
+                            (SELECT MIN(id) FROM candidates
+                             WHERE created_at >= NOW() - make_interval(secs => $3)),
+                            9223372036854775807
+                        )
+                    ),
+                    hourly AS (
+                        INSERT INTO stats_hourly AS t (hour, user_messages, ai_messages, admin_messages)
+                        SELECT date_trunc('hour', created_at),
+                               COUNT(*) FILTER (WHERE role = 'user'),
+                               COUNT(*) FILTER (WHERE role = 'assistant'),
+                               COUNT(*) FILTER (WHERE role = 'admin')
+                        FROM batch
+                        GROUP BY 1
+                        ON CONFLICT (hour) DO UPDATE
+                        SET user_messages = t.user_messages + EXCLUDED.user_messages,
+                            ai_messages = t.ai_messages + EXCLUDED.ai_messages,
+                            admin_messages = t.admin_messages + EXCLUDED.admin_messages
+                    ),
+                    activity AS (
+                        INSERT INTO stats_user_activity AS t (user_id, last_active_day)
+                        SELECT user_id, MAX((created_at AT TIME ZONE 'UTC')::date)
+                        FROM batch
+                        WHERE role = 'user'
+                        GROUP BY user_id
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET last_active_day = GREATEST(t.last_active_day, EXCLUDED.last_active_day)
+                    )
+                    SELECT COALESCE(MAX(id), $1) AS hwm, COUNT(*) AS processed
+                    FROM batch;
+                    """,
+                    hwm,
+                    batch_size,
+                    settle_seconds,
+                )
+
+                await conn.execute(
+                    "UPDATE settings SET value = $2 WHERE key = $1;",
+                    "stats_messages_hwm",
+                    str(row["hwm"]),
+                )
+                return row["processed"]
+
+    async def rollup_takeover_stats(self, batch_size: int, settle_seconds: int) -> int:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                hwm = await self._advance_high_water_mark(conn, "stats_takeover_events_hwm")
+
+                row = await conn.fetchrow(
+                    """
+                    WITH candidates AS (
+                        SELECT id, event, duration_seconds, created_at
+                        FROM takeover_events
+                        WHERE id > $1
+                        ORDER BY id ASC
+                        LIMIT $2
+                    ),
+                    batch AS (
+                        SELECT *
+                        FROM candidates
+                        WHERE id < COALESCE(
+                            (SELECT MIN(id) FROM candidates
+                             WHERE created_at >= NOW() - make_interval(secs => $3)),
+                            9223372036854775807
+                        )
+                    ),
+                    hourly AS (
+                        INSERT INTO stats_hourly AS t (hour, takeovers_started, takeovers_ended, takeover_seconds)
+                        SELECT date_trunc('hour', created_at),
+                               COUNT(*) FILTER (WHERE event = 'start'),
+                               COUNT(*) FILTER (WHERE event = 'end'),
+                               COALESCE(SUM(duration_seconds) FILTER (WHERE event = 'end'), 0)
+                        FROM batch
+                        GROUP BY 1
+                        ON CONFLICT (hour) DO UPDATE
+                        SET takeovers_started = t.takeovers_started + EXCLUDED.takeovers_started,
+                            takeovers_ended = t.takeovers_ended + EXCLUDED.takeovers_ended,
+                            takeover_seconds = t.takeover_seconds + EXCLUDED.takeover_seconds
+                    )
+                    SELECT COALESCE(MAX(id), $1) AS hwm, COUNT(*) AS processed
+                    FROM batch;
+                    """,
+                    hwm,
+                    batch_size,
+                    settle_seconds,
+                )
+
+                await conn.execute(
+                    "UPDATE settings SET value = $2 WHERE key = $1;",
+                    "stats_takeover_events_hwm",
+                    str(row["hwm"]),
+                )
+                return row["processed"]
+
+    async def refresh_active_user_counts(self, windows: list[int]) -> None:
+        await self.execute(
+            """
+            INSERT INTO stats_active_users AS t (days, active_users, computed_at)
+            SELECT w.days,
+                   (SELECT COUNT(*) FROM stats_user_activity
+                    WHERE last_active_day > (NOW() AT TIME ZONE 'UTC')::date - w.days),
+                   NOW()
+            FROM unnest($1::int[]) AS w(days)
+            ON CONFLICT (days) DO UPDATE
+            SET active_users = EXCLUDED.active_users,
+                computed_at = EXCLUDED.computed_at;
+            """,
+            windows,
+        )
+
+    async def get_stats_summary(self, since: datetime, days: int, primary: bool = False):
+        return await self.fetchrow_read(
+            """
+            SELECT COALESCE(SUM(h.user_messages), 0) AS user_messages,
+                   COALESCE(SUM(h.ai_messages), 0) AS ai_messages,
+                   COALESCE(SUM(h.admin_messages), 0) AS admin_messages,
+                   COALESCE(SUM(h.takeovers_started), 0) AS takeovers_started,
+                   COALESCE(SUM(h.takeovers_ended), 0) AS takeovers_ended,
+                   COALESCE(SUM(h.takeover_seconds), 0) AS takeover_seconds,
+                   (SELECT active_users FROM stats_active_users WHERE days = $2) AS active_users,
+                   (SELECT computed_at FROM stats_active_users WHERE days = $2) AS active_computed_at
+            FROM stats_hourly h
+            WHERE h.hour >= $1;
+            """,
+            since,
+            days,
+            primary=primary,
+        )
+
+
+    async def iter_export_rows(
+        self,
+        *,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        user_telegram_id: Optional[int] = None,
+        role: Optional[str] = None,
+        chunk_size: int = 5000,
+        primary: bool = False,
+    ) -> AsyncIterator[list]:
+        args = (since, until, user_telegram_id, role, chunk_size)
+        pool = self._read_pool(primary)
+        chunks = self._export_chunks(pool, *args)
+        try:
+            if pool is not self.pool:
+                # В primary уходим, только пока клиенту не отдано ни одной строки.
+                try:
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                except REPLICA_FAILURES as e:
+                    logger.warning(
+                        "Replica export failed, falling back to primary: %r", e, extra={"sample": "replica_read"}
+                    )
+                    self.replica_healthy = False
+                    await chunks.aclose()
+                    chunks = self._export_chunks(self.pool, *args)
+                else:
+                    yield first
+
+            async for rows in chunks:
+                yield rows
+        finally:
+            await chunks.aclose()
+
+    async def _export_chunks(
+        self,
+        pool,
+        since: Optional[datetime],
+        until: Optional[datetime],
+        user_telegram_id: Optional[int],
+        role: Optional[str],
+        chunk_size: int,
+    ) -> AsyncIterator[list]:
+        # Один снимок на всю выгрузку, строки читаются серверным курсором по chunk_size.
+        async with pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                cursor = await conn.cursor(
+                    """
+                    SELECT m.id, u.telegram_id, u.username, m.role, m.content, m.created_at
+                    FROM messages m
+                    JOIN users u ON u.id = m.user_id
+                    WHERE ($1::timestamptz IS NULL OR m.created_at >= $1)
+                      AND ($2::timestamptz IS NULL OR m.created_at < $2)
+                      AND ($3::bigint IS NULL OR u.telegram_id = $3)
+                      AND ($4::text IS NULL OR m.role = $4)
+                    ORDER BY m.id ASC;
+                    """,
+                    since,
+                    until,
+                    user_telegram_id,
+                    role,
+                )
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        return
+                    yield rows
+
 db = Database()
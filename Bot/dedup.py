@@ -0,0 +1,135 @@
+import os
+import logging
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from .db import db
+from .tenants import TENANTS, current_tenant, use_tenant
+from .lifecycle import supervisor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+UPDATE_CLAIM_TTL_HOURS = int(os.getenv("UPDATE_CLAIM_TTL_HOURS", "24"))
+UPDATE_CLAIM_CLEANUP_SECONDS = float(os.getenv("UPDATE_CLAIM_CLEANUP_SECONDS", "600"))
+# Сколько ждать, прежде чем считать незавершённый claim брошенным упавшим процессом.
+UPDATE_CLAIM_LEASE_SECONDS = float(os.getenv("UPDATE_CLAIM_LEASE_SECONDS", "300"))
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """
+    Пропускает каждый update_id один раз. Недавние id держим в памяти,
+    а между процессами и рестартами делим их через таблицу processed_updates.
+    У разных ботов update_id пересекаются, поэтому ключ в памяти — пара (бот, id).
+    Если обработчик упал, claim снимается, и повторная доставка обработает апдейт.
+    """
+
+    def __init__(self, window: int = UPDATE_DEDUP_WINDOW):
+        self.window = window
+        self._seen: "OrderedDict[Tuple[str, int], None]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "processed": 0,
+            "dropped_memory": 0,
+            "dropped_db": 0,
+            "claim_errors": 0,
+            "released": 0,
+            "claim_ms_total": 0.0,
+        }
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        update_id = event.update_id
+        key = (current_tenant.get(), update_id)
+
+        if key in self._seen:
+            self.stats["dropped_memory"] += 1
+            return None
+
+        self._seen[key] = None
+        if len(self._seen) > self.window:
+            self._seen.popitem(last=False)
+
+        started = time.perf_counter()
+        try:
+            claimed = await db.claim_update(update_id, UPDATE_CLAIM_LEASE_SECONDS)
+        except Exception as e:
+            # Лучше ответить дважды, чем потерять сообщение клиента из-за БД.
+            logger.warning("Update %s claim error: %r", update_id, e, extra={"sample": "update_claim"})
+            self.stats["claim_errors"] += 1
+            claimed = True
+        self.stats["claim_ms_total"] += (time.perf_counter() - started) * 1000
+
+        if not claimed:
+            self.stats["dropped_db"] += 1
+            return None
+
+        self.stats["processed"] += 1
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            # И ошибка, и отмена при остановке: апдейт не обработан.
+            await self._release(key)
+            raise
+
+        try:
+            await db.finish_update(update_id)
+        except Exception as e:
+            # Незавершённый claim перехватят только после lease, дубль маловероятен.
+            logger.warning("Update %s finish error: %r", update_id, e, extra={"sample": "update_claim"})
+        return result
+
+    async def _release(self, key: Tuple[str, int]) -> None:
+        self._seen.pop(key, None)
+        self.stats["released"] += 1
+        try:
+            await db.release_update(key[1])
+        except Exception as e:
+            logger.warning("Update %s release error: %r", key[1], e, extra={"sample": "update_claim"})
+
+    def format_stats(self) -> str:
+        claims = self.stats["processed"] + self.stats["dropped_db"] + self.stats["claim_errors"]
+        avg_claim_ms = self.stats["claim_ms_total"] / claims if claims else 0.0
+        return (
+            f"Апдейтов обработано: {self.stats['processed']}\n"
+            f"Дубликатов отброшено: {self.stats['dropped_memory']} (память), "
+            f"{self.stats['dropped_db']} (БД)\n"
+            f"Снято claim после ошибки: {self.stats['released']}\n"
+            f"Ошибок claim: {self.stats['claim_errors']}, "
+            f"в среднем {avg_claim_ms:.1f} мс на claim"
+        )
+
+    def start(self) -> None:
+        self._task = supervisor.spawn("update_claims_cleanup", self._cleanup_loop)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            for name in TENANTS:
+                with use_tenant(name):
+                    try:
+                        result = await db.delete_old_update_claims(UPDATE_CLAIM_TTL_HOURS)
+                        logger.debug("Update claims cleanup: %s", result)
+                    except Exception:
+                        logger.exception("Update claims cleanup error")
+            await asyncio.sleep(UPDATE_CLAIM_CLEANUP_SECONDS)
+
+
+update_dedup = UpdateDeduplicationMiddleware()
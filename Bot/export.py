@@ -0,0 +1,285 @@
+import os
+import logging
+import gzip
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.filters.command import CommandObject
+from aiogram.types import Message, FSInputFile
+
+from .db import db
+from .config import ADMIN_IDS
+from .tenants import DEFAULT_TENANT, TENANTS, use_tenant
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+# Бот может отправить документ до 50 МБ, оставляем запас.
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_FORMATS = ("jsonl", "parquet")
+# Роли, которые реально пишутся в messages.
+EXPORT_ROLES = ("user", "assistant", "admin")
+
+export_router = Router()
+
+
+def _row_to_dict(row) -> dict:
+    return {
+        "id": row["id"],
+        "telegram_id": row["telegram_id"],
+        "username": row["username"],
+        "role": row["role"],
+        "content": row["content"],
+        "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+    }
+
+
+class JsonlPartWriter:
+    def __init__(self, base_path: str, part_bytes: int = EXPORT_PART_BYTES):
+        self.base_path = base_path
+        self.part_bytes = part_bytes
+        self.paths: List[str] = []
+        self._raw = None
+        self._gz = None
+        self._open_next()
+
+    def _open_next(self) -> None:
+        path = f"{self.base_path}.part{len(self.paths) + 1:03d}.jsonl.gz"
+        self.paths.append(path)
+        self._raw = open(path, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb")
+
+    def _close_current(self) -> None:
+        self._gz.close()
+        self._raw.close()
+
+    def write_rows(self, rows: list) -> None:
+        for row in rows:
+            line = json.dumps(_row_to_dict(row), ensure_ascii=False) + "\n"
+            self._gz.write(line.encode("utf-8"))
+
+        # Размер сжатого файла растёт по мере сброса буфера gzip — этого хватает для деления на части.
+        if self._raw.tell() >= self.part_bytes:
+            self._close_current()
+            self._open_next()
+
+    def close(self) -> List[str]:
+        self._close_current()
+        return self.paths
+
+
+class ParquetPartWriter:
+    def __init__(self, base_path: str, part_bytes: int = EXPORT_PART_BYTES):
+        if pa is None:
+            raise RuntimeError("Для выгрузки в Parquet установите pyarrow.")
+
+        self.base_path = base_path
+        self.part_bytes = part_bytes
+        self.paths: List[str] = []
+        self.schema = pa.schema(
+            [
+                ("id", pa.int64()),
+                ("telegram_id", pa.int64()),
+                ("username", pa.string()),
+                ("role", pa.string()),
+                ("content", pa.string()),
+                ("created_at", pa.timestamp("us", tz="UTC")),
+            ]
+        )
+        self._writer = None
+        self._open_next()
+
+    def _open_next(self) -> None:
+        path = f"{self.base_path}.part{len(self.paths) + 1:03d}.parquet"
+        self.paths.append(path)
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write_rows(self, rows: list) -> None:
+        # Каждый чанк курсора становится отдельной row group.
+        table = pa.table(
+            {
+                "id": [r["id"] for r in rows],
+                "telegram_id": [r["telegram_id"] for r in rows],
+                "username": [r["username"] for r in rows],
+                "role": [r["role"] for r in rows],
+                "content": [r["content"] for r in rows],
+                "created_at": [r["created_at"] for r in rows],
+            },
+            schema=self.schema,
+        )
+        self._writer.write_table(table)
+
+        if os.path.getsize(self.paths[-1]) >= self.part_bytes:
+            self._writer.close()
+            self._open_next()
+
+    def close(self) -> List[str]:
+        self._writer.close()
+        return self.paths
+
+
+async def export_messages(
+    out_dir: str,
+    fmt: str = "jsonl",
+    *,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user_telegram_id: Optional[int] = None,
+    role: Optional[str] = None,
+) -> Tuple[List[str], int]:
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    base_path = os.path.join(out_dir, f"messages_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}")
+    writer_cls = JsonlPartWriter if fmt == "jsonl" else ParquetPartWriter
+    writer = writer_cls(base_path)
+
+    total = 0
+    try:
+        async for rows in db.iter_export_rows(
+            since=since,
+            until=until,
+            user_telegram_id=user_telegram_id,
+            role=role,
+            chunk_size=EXPORT_CHUNK_ROWS,
+        ):
+            # Сжатие и запись — в отдельном потоке, чтобы не блокировать event loop.
+            await asyncio.to_thread(writer.write_rows, rows)
+            total += len(rows)
+    finally:
+        paths = await asyncio.to_thread(writer.close)
+
+    # Последняя часть может оказаться пустой, если ротация случилась на последнем чанке.
+    if len(paths) > 1 and total and _is_empty_part(paths[-1], fmt):
+        os.remove(paths.pop())
+
+    return paths, total
+
+
+def _is_empty_part(path: str, fmt: str) -> bool:
+    if fmt == "jsonl":
+        with gzip.open(path, "rb") as f:
+            return not f.read(1)
+    return pq.ParquetFile(path).metadata.num_rows == 0
+
+
+def _parse_day(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+def parse_export_args(args: str) -> dict:
+    """
+    Разбирает аргументы /export: формат и фильтры вида key=value.
+      /export parquet from=2025-01-01 to=2025-01-31 user=123 role=user
+    Дата to включается целиком.
+    """
+    options = {"fmt": "jsonl", "since": None, "until": None, "user_telegram_id": None, "role": None}
+
+    for token in args.split():
+        if token in EXPORT_FORMATS:
+            options["fmt"] = token
+            continue
+
+        key, sep, value = token.partition("=")
+        if not sep:
+            raise ValueError(f"Непонятный аргумент: {token}")
+
+        if key == "from":
+            options["since"] = _parse_day(value)
+        elif key == "to":
+            options["until"] = _parse_day(value) + timedelta(days=1)
+        elif key == "user":
+            options["user_telegram_id"] = int(value)
+        elif key == "role":
+            if value not in EXPORT_ROLES:
+                raise ValueError(f"Роль должна быть одной из: {', '.join(EXPORT_ROLES)}")
+            options["role"] = value
+        else:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+
+    return options
+
+
+@export_router.message(Command("export"))
+async def export_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    try:
+        options = parse_export_args(command.args or "")
+    except ValueError as e:
+        return await message.answer(
+            f"{e}\n\nИспользование: /export [jsonl|parquet] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] "
+            f"[user=ID] [role={'|'.join(EXPORT_ROLES)}]"
+        )
+
+    fmt = options.pop("fmt")
+    status = await message.answer("Готовлю выгрузку...")
+    out_dir = tempfile.mkdtemp(prefix="bot_export_")
+
+    try:
+        paths, total = await export_messages(out_dir, fmt, **options)
+
+        if not total:
+            await status.edit_text("По заданным фильтрам сообщений нет.")
+            return
+
+        await status.edit_text(f"Выгружено сообщений: {total}. Частей: {len(paths)}.")
+        for i, path in enumerate(paths, start=1):
+            await message.answer_document(
+                document=FSInputFile(path),
+                caption=f"Часть {i} из {len(paths)}",
+            )
+    except Exception as e:
+        logger.exception("Export failed")
+        await status.edit_text(f"Ошибка выгрузки: {e}", parse_mode=None)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+async def _cli(args) -> None:
+    options = parse_export_args(" ".join(args.filters))
+    fmt = args.format or options.pop("fmt")
+    options.pop("fmt", None)
+
+    if args.tenant not in TENANTS:
+        raise SystemExit(f"Unknown bot: {args.tenant}")
+
+    await db.connect()
+    try:
+        with use_tenant(args.tenant):
+            paths, total = await export_messages(args.out, fmt, **options)
+    finally:
+        await db.disconnect()
+
+    print(f"Exported {total} messages:")
+    for path in paths:
+        print(f"  {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export conversations to gzip JSONL or Parquet.")
+    parser.add_argument("filters", nargs="*", help="from=YYYY-MM-DD to=YYYY-MM-DD user=ID role=user")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default=None)
+    parser.add_argument("--out", default="exports")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="bot name from BOTS_CONFIG")
+    asyncio.run(_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import html
+import time
+import logging
+import asyncio
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, Update
+
+from .tenants import DEFAULT_TENANT, current_tenant
+
+logger = logging.getLogger(__name__)
+
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "25"))
+SUPERVISOR_BACKOFF_MIN_SECONDS = 1.0
+SUPERVISOR_BACKOFF_MAX_SECONDS = 60.0
+
+RETRY_NOTICE = "Бот перезапускается и не успел ответить. Пожалуйста, отправьте вопрос ещё раз через минуту."
+
+
+class LifecycleManager(BaseMiddleware):
+    """
+    Следит за апдейтами в обработке. При остановке перестаёт принимать новые,
+    ждёт текущие до SHUTDOWN_DRAIN_SECONDS, а клиентам, которым так и не ответили,
+    меняет «думаю...» на просьбу повторить вопрос.
+    """
+
+    def __init__(self, drain_seconds: float = SHUTDOWN_DRAIN_SECONDS):
+        self.drain_seconds = drain_seconds
+        self.stopping = False
+        self._in_flight: Set[asyncio.Task] = set()
+        self._placeholders: Dict[Tuple[int, int], Message] = {}
+        self.stats = {"rejected": 0, "drained": 0, "abandoned": 0}
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.stopping:
+            # Апдейт не подтверждён offset'ом, Telegram отдаст его следующему процессу.
+            self.stats["rejected"] += 1
+            return None
+
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(task)
+
+    @contextmanager
+    def placeholder(self, message: Message):
+        key = (message.chat.id, message.message_id)
+        self._placeholders[key] = message
+        try:
+            yield
+        finally:
+            self._placeholders.pop(key, None)
+
+    async def drain(self) -> None:
+        self.stopping = True
+
+        pending = set(self._in_flight)
+        if pending:
+            logger.info("Shutdown: waiting for %s handlers", len(pending))
+            done, pending = await asyncio.wait(pending, timeout=self.drain_seconds)
+            self.stats["drained"] += len(done)
+
+        # Снимок берём до отмены: отменённые обработчики сами уберут свои заглушки.
+        abandoned = list(self._placeholders.values())
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        self.stats["abandoned"] += len(pending)
+        if abandoned:
+            await asyncio.gather(*(self._notify_abandoned(m) for m in abandoned))
+
+        logger.info(
+            "Shutdown: drained %s handlers, abandoned %s, notified %s clients",
+            self.stats["drained"],
+            len(pending),
+            len(abandoned),
+        )
+
+    async def _notify_abandoned(self, message: Message) -> None:
+        try:
+            await message.edit_text(RETRY_NOTICE, parse_mode=None)
+        except Exception as e:
+            logger.warning("Shutdown: could not edit placeholder in chat %s: %r", message.chat.id, e)
+
+
+class TaskSupervisor:
+    """
+    Запускает долгоживущие фоновые циклы и перезапускает их после падения
+    с экспоненциальной паузой. Состояние каждого цикла видно в /health.
+    """
+
+    def __init__(self):
+        self._services: Dict[str, dict] = {}
+
+    def spawn(self, name: str, factory: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        tenant = current_tenant.get()
+        if tenant != DEFAULT_TENANT:
+            name = f"{tenant}/{name}"
+
+        state = {"state": "running", "restarts": 0, "last_error": None}
+        self._services[name] = state
+        return asyncio.create_task(self._supervise(name, factory, state), name=name)
+
+    async def _supervise(self, name: str, factory: Callable[[], Awaitable[None]], state: dict) -> None:
+        delay = SUPERVISOR_BACKOFF_MIN_SECONDS
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    await factory()
+                    state["state"] = "finished"
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    state["restarts"] += 1
+                    state["last_error"] = repr(e)
+                    state["state"] = "restarting"
+                    # После долгой нормальной работы начинаем паузы заново.
+                    if time.monotonic() - started > SUPERVISOR_BACKOFF_MAX_SECONDS:
+                        delay = SUPERVISOR_BACKOFF_MIN_SECONDS
+                    logger.exception("Background task %s crashed, restarting in %.0f s", name, delay)
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SUPERVISOR_BACKOFF_MAX_SECONDS)
+                state["state"] = "running"
+        finally:
+            if state["state"] != "finished":
+                state["state"] = "stopped"
+
+    def format_health(self) -> str:
+        if not self._services:
+            return "Фоновых задач нет."
+
+        titles = {
+            "running": "работает",
+            "restarting": "перезапускается",
+            "finished": "завершена",
+            "stopped": "остановлена",
+        }
+        lines = ["Фоновые задачи:"]
+        for name, state in sorted(self._services.items()):
+            line = f"• {name}: {titles[state['state']]}"
+            if state["restarts"]:
+                line += f", перезапусков: {state['restarts']}, последняя ошибка: {html.escape(state['last_error'])}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+lifecycle = LifecycleManager()
+supervisor = TaskSupervisor()
@@ -1,8 +1,20 @@
 import os
+import logging
+import time
 import asyncio
-from typing import Optional
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+from .usage import usage_tracker
+from .tenants import current_tenant
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -12,15 +24,122 @@ if not OPENAI_API_KEY:
 
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+OPENAI_MODEL_LIGHT = os.getenv("OPENAI_MODEL_LIGHT", "gpt-4.1-nano")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", OPENAI_MODEL)
+# Сколько запросов к OpenAI одновременно выполняется на весь процесс, для всех ботов вместе.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+SUMMARY_PROMPT = """Ты ведёшь краткую сводку переписки клиента с ассистентом и операторами.
+Тебе дают текущую сводку и новые сообщения. Обнови сводку:
+сохрани важные факты о клиенте, его запросы, договорённости и открытые вопросы,
+убери повторы и несущественные детали. Пиши по-русски, не длиннее 10 пунктов.
+Верни только обновлённую сводку."""
+
+_client: Optional["OpenAI"] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> "OpenAI":
+    # Импорт openai и создание клиента занимают заметное время,
+    # поэтому откладываем их до первого запроса (или до прогрева на старте).
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from openai import DefaultHttpxClient, OpenAI
+
+                # Один клиент и один пул соединений на все боты процесса.
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    base_url=OPENAI_BASE_URL,
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=LLM_MAX_CONCURRENCY * 2,
+                            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                        )
+                    ),
+                )
+    return _client
+
+
+async def warm_up_client() -> None:
+    await asyncio.to_thread(get_client)
+
+
+class FairShareLimiter:
+    """
+    Общий лимит одновременных запросов к LLM, который делится между ботами поровну.
+    Пока есть свободные слоты, запрос проходит сразу. Когда их нет, освободившийся
+    слот получает тот бот из ожидающих, у которого сейчас меньше всего запросов
+    в работе, так что шумный бот не может занять все слоты надолго.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._in_flight: Dict[str, int] = {}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+        self._total = 0
+
+    def _grant(self, tenant: str) -> None:
+        self._in_flight[tenant] = self._in_flight.get(tenant, 0) + 1
+        self._total += 1
+
+    def _wake(self) -> None:
+        while self._total < self.capacity and self._waiters:
+            tenant = min(self._waiters, key=lambda t: self._in_flight.get(t, 0))
+            waiters = self._waiters[tenant]
+            future = waiters.popleft()
+            if not waiters:
+                del self._waiters[tenant]
+            if future.done():
+                continue
+            self._grant(tenant)
+            future.set_result(None)
+
+    async def acquire(self, tenant: str) -> None:
+        if self._total < self.capacity and not self._waiters:
+            self._grant(tenant)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(tenant, deque()).append(future)
+        # Если в очереди остались только отменённые, слот выдаётся сразу.
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдали, но ждущий отменён — возвращаем его следующему.
+                self.release(tenant)
+            raise
+
+    def release(self, tenant: str) -> None:
+        self._in_flight[tenant] -= 1
+        if not self._in_flight[tenant]:
+            del self._in_flight[tenant]
+        self._total -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, tenant: Optional[str] = None):
+        tenant = tenant or current_tenant.get()
+        await self.acquire(tenant)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self._in_flight)
+
+
+llm_limiter = FairShareLimiter(LLM_MAX_CONCURRENCY)
 
-client = OpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url=OPENAI_BASE_URL,  
-)
 
 def _create_vector_store_sync(name: str) -> str:
-    vector_store = client.vector_stores.create(name=name)
-    print(f"Vector store создан: {vector_store.id} ({name})")
+    vector_store = get_client().vector_stores.create(name=name)
+    logger.info("Vector store создан: %s (%s)", vector_store.id, name)
     return vector_store.id
 
 
@@ -28,17 +147,50 @@ async def create_vector_store(name: str) -> str:
     return await asyncio.to_thread(_create_vector_store_sync, name)
 
 
+def _extract_usage(response, model: str, latency_ms: int) -> dict:
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "input_tokens_details", None)
+    output_items = getattr(response, "output", None) or []
+
+    return dict(
+        model=getattr(response, "model", None) or model,
+        input_tokens=getattr(usage, "input_tokens", 0) or 0,
+        output_tokens=getattr(usage, "output_tokens", 0) or 0,
+        cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+        file_search_calls=sum(1 for item in output_items if getattr(item, "type", None) == "file_search_call"),
+        latency_ms=latency_ms,
+    )
+
+
 def _ask_gpt_sync(
     user_text: str,
     system_prompt: str,
     vector_store_id: Optional[str] = None,
-) -> str:
+    conversation_summary: Optional[str] = None,
+    model: Optional[str] = None,
+    prompt_cache_key: Optional[str] = None,
+) -> Tuple[str, Optional[dict]]:
+    model = model or OPENAI_MODEL
     try:
+        # Инструкции и инструменты одинаковы для всех клиентов одной версии промпта,
+        # поэтому OpenAI кэширует этот префикс. Всё, что зависит от клиента, идёт в input после него.
+        input_items = user_text
+        if conversation_summary:
+            input_items = [
+                {
+                    "role": "developer",
+                    "content": f"Краткое содержание предыдущего общения с клиентом:\n{conversation_summary}",
+                },
+                {"role": "user", "content": user_text},
+            ]
+
         kwargs = dict(
-            model=OPENAI_MODEL,
-            input=user_text,
+            model=model,
+            input=input_items,
             instructions=system_prompt,
         )
+        if prompt_cache_key:
+            kwargs["prompt_cache_key"] = prompt_cache_key
 
         if vector_store_id:
             kwargs["tools"] = [
@@ -48,24 +200,88 @@ def _ask_gpt_sync(
                 }
             ]
 
-        response = client.responses.create(**kwargs)
+        started = time.perf_counter()
+        response = get_client().responses.create(**kwargs)
+        usage = _extract_usage(response, model, int((time.perf_counter() - started) * 1000))
 
         if hasattr(response, "output_text") and response.output_text:
-            return response.output_text.strip()
+            return response.output_text.strip(), usage
 
-        return str(response)
+        return str(response), usage
 
     except Exception as e:
-        print("OpenAI API error:", repr(e))
-        return "Ошибка при обращении к модели."
+        logger.error("OpenAI API error: %r", e, extra={"sample": "openai_error"})
+        return "Ошибка при обращении к модели.", None
 
 
 async def ask_assistant(
     user_text: str,
     system_prompt: str,
     vector_store_id: Optional[str] = None,
+    conversation_summary: Optional[str] = None,
+    user_telegram_id: Optional[int] = None,
+    model: Optional[str] = None,
+    route: Optional[str] = None,
+    route_score: Optional[float] = None,
+    prompt_version: Optional[int] = None,
 ) -> str:
-    return await asyncio.to_thread(_ask_gpt_sync, user_text, system_prompt, vector_store_id)
+    # Запросы одной версии промпта одного бота направляем на одни и те же серверы кэша.
+    cache_key = f"{current_tenant.get()}:prompt-{prompt_version}" if prompt_version is not None else None
+
+    async with llm_limiter.slot():
+        reply_text, usage = await asyncio.to_thread(
+            _ask_gpt_sync,
+            user_text,
+            system_prompt,
+            vector_store_id,
+            conversation_summary,
+            model,
+            cache_key,
+        )
+    if usage:
+        usage_tracker.record(
+            user_telegram_id=user_telegram_id,
+            purpose="assistant",
+            route=route,
+            route_score=route_score,
+            prompt_version=prompt_version,
+            **usage,
+        )
+    return reply_text
+
+
+def _summarize_conversation_sync(previous_summary: str, messages: list) -> Tuple[Optional[str], Optional[dict]]:
+    lines = []
+    for m in messages:
+        lines.append(f"{m['role']}: {m['content']}")
+
+    user_input = (
+        f"Текущая сводка:\n{previous_summary or '(пусто)'}\n\n"
+        "Новые сообщения:\n" + "\n".join(lines)
+    )
+
+    try:
+        started = time.perf_counter()
+        response = get_client().responses.create(
+            model=SUMMARY_MODEL,
+            input=user_input,
+            instructions=SUMMARY_PROMPT,
+        )
+        usage = _extract_usage(response, SUMMARY_MODEL, int((time.perf_counter() - started) * 1000))
+        if hasattr(response, "output_text") and response.output_text:
+            return response.output_text.strip(), usage
+        return None, usage
+    except Exception as e:
+        logger.error("OpenAI summary error: %r", e, extra={"sample": "openai_error"})
+        return None, None
+
+
+async def summarize_conversation(previous_summary: str, messages: list) -> Optional[str]:
+    async with llm_limiter.slot():
+        summary, usage = await asyncio.to_thread(_summarize_conversation_sync, previous_summary, messages)
+    if usage:
+        usage_tracker.record(user_telegram_id=None, purpose="summary", **usage)
+    return summary
 
 
 
@@ -75,19 +291,19 @@ def _upload_file_to_vector_store_sync(
 ) -> Optional[str]:
     try:
         with open(filepath, "rb") as f:
-            file_obj = client.files.create(
+            file_obj = get_client().files.create(
                 file=f,
                 purpose="assistants",
             )
 
-        client.vector_stores.files.create_and_poll(
+        get_client().vector_stores.files.create_and_poll(
             vector_store_id=vector_store_id,
             file_id=file_obj.id,
         )
 
         return file_obj.id
     except Exception as e:
-        print("OpenAI upload_to_vector_store error:", repr(e))
+        logger.error("OpenAI upload_to_vector_store error: %r", e)
         return None
 
 
@@ -105,27 +321,50 @@ async def upload_file_to_vector_store(
 def _delete_file_from_vector_store_sync(
     vector_store_id: str,
     file_id: str,
-) -> None:
+) -> bool:
+    from openai import NotFoundError
+
+    # Уже удалённый файл считаем успехом: это и нужно при повторной чистке.
+    ok = True
     try:
-        client.vector_stores.files.delete(
+        get_client().vector_stores.files.delete(
             vector_store_id=vector_store_id,
             file_id=file_id,
         )
+    except NotFoundError:
+        pass
     except Exception as e:
-        print("Error deleting from vector store:", repr(e))
+        logger.error("Error deleting from vector store: %r", e)
+        ok = False
 
     try:
-        client.files.delete(file_id=file_id)
+        get_client().files.delete(file_id=file_id)
+    except NotFoundError:
+        pass
     except Exception as e:
-        print("Error deleting OpenAI file:", repr(e))
+        logger.error("Error deleting OpenAI file: %r", e)
+        ok = False
+
+    return ok
 
 
 async def delete_file_from_vector_store(
     vector_store_id: str,
     file_id: str,
-) -> None:
-    await asyncio.to_thread(
+) -> bool:
+    return await asyncio.to_thread(
         _delete_file_from_vector_store_sync,
         vector_store_id,
         file_id,
     )
+
+
+def _list_vector_store_files_sync(vector_store_id: str) -> List[Tuple[str, int]]:
+    # SDK сам ходит по страницам (по 100 файлов) через курсор after.
+    files = get_client().vector_stores.files.list(vector_store_id=vector_store_id, limit=100)
+    return [(f.id, f.created_at) for f in files]
+
+
+async def list_vector_store_files(vector_store_id: str) -> List[Tuple[str, int]]:
+    """Возвращает (file_id, created_at в unix-секундах) для всех файлов vector store."""
+    return await asyncio.to_thread(_list_vector_store_files_sync, vector_store_id)
@@ -1,12 +1,8 @@
-import os
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, User
-from dotenv import load_dotenv
 
-load_dotenv()
-
-BOT_USERNAME = os.getenv("BOT_USERNAME", "").strip().lstrip("@")
-LOG_CHAT_ID = int(os.getenv("LOG_CHAT_ID", "0"))
+from .tenants import get_tenant
+from .operator_desk import log_message_map
 
 
 async def send_ai_log(
@@ -15,8 +11,8 @@ async def send_ai_log(
     user_message: str,
     ai_answer: str,
 ) -> None:
-
-    if LOG_CHAT_ID == 0:
+    tenant = get_tenant()
+    if tenant.log_chat_id == 0:
         return
 
     username = user.username or "без username"
@@ -27,23 +23,26 @@ async def send_ai_log(
         f"Ответ ИИ:\n{ai_answer}"
     )
 
-    if not BOT_USERNAME:
+    if not tenant.bot_username:
         keyboard = None
     else:
-        open_url = f"https://t.me/{BOT_USERNAME}?start=chat_{user.id}"
+        open_url = f"https://t.me/{tenant.bot_username}?start=chat_{user.id}"
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[[InlineKeyboardButton(text="Перейти в диалог", url=open_url)]]
         )
 
-    await bot.send_message(
-        chat_id=LOG_CHAT_ID,
+    sent = await bot.send_message(
+        chat_id=tenant.log_chat_id,
         text=text,
         reply_markup=keyboard,
     )
+    # Реплай админа на это сообщение уйдёт клиенту.
+    await log_message_map.remember(sent, user.id)
 
 
 async def send_admin_user_message(bot: Bot, user: User, user_message: str) -> None:
-    if LOG_CHAT_ID == 0:
+    tenant = get_tenant()
+    if tenant.log_chat_id == 0:
         return
 
     username = user.username or "без username"
@@ -54,7 +53,8 @@ async def send_admin_user_message(bot: Bot, user: User, user_message: str) -> No
         f"Сообщение: «{user_message}»"
     )
 
-    await bot.send_message(
-        chat_id=LOG_CHAT_ID,
+    sent = await bot.send_message(
+        chat_id=tenant.log_chat_id,
         text=text,
-    )
\ No newline at end of file
+    )
+    await log_message_map.remember(sent, user.id)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from .tenants import current_tenant
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_INTERVAL_SECONDS = float(os.getenv("LOG_SAMPLE_INTERVAL_SECONDS", "60"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+update_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("update_id", default=None)
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("user_id", default=None)
+stage_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("stage", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    # Работает в потоке, который пишет лог, пока contextvars ещё доступны.
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.tenant = current_tenant.get()
+        record.update_id = update_id_var.get()
+        record.user_id = user_id_var.get()
+        record.stage = stage_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Ограничивает шумные сообщения: записи с extra={"sample": "<ключ>"}
+    пропускаются не чаще LOG_SAMPLE_BURST раз за интервал, остальные
+    считаются и попадают в поле suppressed следующей пропущенной записи.
+    """
+
+    def __init__(self, interval: float = LOG_SAMPLE_INTERVAL_SECONDS, burst: int = LOG_SAMPLE_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows: Dict[str, Tuple[float, int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if not key:
+            return True
+
+        now = time.monotonic()
+        started, passed, suppressed = self._windows.get(key, (now, 0, 0))
+        if now - started >= self.interval:
+            started, passed = now, 0
+
+        if passed < self.burst:
+            if suppressed:
+                record.suppressed = suppressed
+            self._windows[key] = (started, passed + 1, 0)
+            return True
+
+        self._windows[key] = (started, passed, suppressed + 1)
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in ("tenant", "update_id", "user_id", "stage", "suppressed"):
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование сообщения и трейсбека остаётся на стороне вызывающего,
+        # а в JSON их собирает уже поток слушателя.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging() -> None:
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL if LOG_LEVEL in LOG_LEVELS else "INFO")
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_log_level() -> str:
+    return logging.getLevelName(logging.getLogger().level)
+
+
+def set_log_level(level: str) -> None:
+    level = level.upper()
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level: {level}")
+    logging.getLogger().setLevel(level)
+
+
+@contextmanager
+def log_stage(stage: str):
+    token = stage_var.set(stage)
+    try:
+        yield
+    finally:
+        stage_var.reset(token)
+
+
+class LogContextMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        update_token = update_id_var.set(event.update_id)
+        user_token = user_id_var.set(user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            user_id_var.reset(user_token)
+            update_id_var.reset(update_token)
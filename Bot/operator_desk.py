@@ -0,0 +1,273 @@
+import os
+import html
+import logging
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple, Union
+
+from aiogram import Bot, Router, F
+from aiogram.filters import Command, Filter
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import (
+    Message,
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    ReactionTypeEmoji,
+)
+
+from .db import db
+from .config import ADMIN_IDS
+from .tenants import TenantLocal
+from .lifecycle import supervisor
+from .summaries import conversation_summarizer
+from .takeover import open_client_chat, owner_link
+from .takeover_expiry import takeover_expiry
+
+logger = logging.getLogger(__name__)
+
+LOG_MAP_CACHE_SIZE = int(os.getenv("LOG_MAP_CACHE_SIZE", "5000"))
+LOG_MAP_TTL_DAYS = int(os.getenv("LOG_MAP_TTL_DAYS", "30"))
+LOG_MAP_CLEANUP_SECONDS = float(os.getenv("LOG_MAP_CLEANUP_SECONDS", "3600"))
+OPERATOR_QUEUE_LIMIT = 20
+
+operator_router = Router()
+
+
+class LogMessageMap:
+    """
+    Помнит, к какому клиенту относится сообщение бота в лог-чате или в личке админа,
+    чтобы ответ реплаем ушёл этому клиенту. Последние записи держим в памяти,
+    остальные читаем из log_message_map.
+    """
+
+    def __init__(self, size: int = LOG_MAP_CACHE_SIZE):
+        self.size = size
+        self._cache: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "db_hits": 0, "misses": 0}
+
+    def _put(self, key: Tuple[int, int], user_telegram_id: int) -> None:
+        self._cache[key] = user_telegram_id
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    async def remember(self, message: Message, user_telegram_id: int) -> None:
+        self._put((message.chat.id, message.message_id), user_telegram_id)
+        try:
+            await db.save_log_message(message.chat.id, message.message_id, user_telegram_id)
+        except Exception as e:
+            # Без записи в БД реплай сработает, пока запись в кэше.
+            logger.warning("Log message map save error: %r", e, extra={"sample": "log_map_save"})
+
+    async def resolve(self, chat_id: int, message_id: int) -> Optional[int]:
+        key = (chat_id, message_id)
+        user_telegram_id = self._cache.get(key)
+        if user_telegram_id is not None:
+            self._cache.move_to_end(key)
+            self.stats["hits"] += 1
+            return user_telegram_id
+
+        user_telegram_id = await db.get_log_message_user(chat_id, message_id)
+        if user_telegram_id is None:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["db_hits"] += 1
+        self._put(key, user_telegram_id)
+        return user_telegram_id
+
+    def start(self) -> None:
+        self._task = supervisor.spawn("log_map_cleanup", self._cleanup_loop)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            try:
+                result = await db.delete_old_log_messages(LOG_MAP_TTL_DAYS)
+                logger.debug("Log message map cleanup: %s", result)
+            except Exception:
+                logger.exception("Log message map cleanup error")
+            await asyncio.sleep(LOG_MAP_CLEANUP_SECONDS)
+
+
+log_message_map = TenantLocal(LogMessageMap)
+
+
+async def reply_target(message: Message) -> Optional[int]:
+    """Клиент, на сообщение о котором админ ответил реплаем, или None."""
+    reply = message.reply_to_message
+    if reply is None or reply.from_user is None or reply.from_user.id != message.bot.id:
+        return None
+    return await log_message_map.resolve(message.chat.id, reply.message_id)
+
+
+async def deliver_to_client(bot: Bot, client_id: int, text: str) -> None:
+    await bot.send_message(chat_id=client_id, text=text, parse_mode=None)
+    takeover_expiry.touch(client_id)
+
+    internal_user_id = await db.save_user(telegram_id=client_id, username=None)
+    await db.save_message(user_id=internal_user_id, role="admin", content=text)
+    conversation_summarizer.touch(internal_user_id)
+
+
+async def send_operator_reply(message: Message, client_id: int) -> None:
+    """
+    Ответ реплаем: клиент закрепляется за админом (если он свободен или уже его),
+    но активный диалог админа не меняется, поэтому так можно вести много клиентов сразу.
+    """
+    admin_id = message.from_user.id
+    text = (message.text or "").strip()
+    if not text:
+        await message.reply("Клиенту пересылаю только текст.")
+        return
+
+    row = await db.take_over_conversation(client_id, admin_id, history_limit=0, activate=False)
+    if not row["taken"]:
+        await message.reply(f"Клиента {client_id} уже ведёт админ {owner_link(row['owner_admin_id'])}.")
+        return
+
+    await takeover_expiry.schedule(client_id, admin_id)
+
+    try:
+        await deliver_to_client(message.bot, client_id, text)
+    except TelegramForbiddenError:
+        await message.reply(f"Клиент {client_id} заблокировал бота, сообщение не доставлено.")
+        return
+
+    if message.chat.type == "private":
+        await message.answer("Отправлено клиенту.")
+        return
+
+    # В лог-чате подтверждаем реакцией, чтобы не засорять ленту.
+    try:
+        await message.react([ReactionTypeEmoji(emoji="👍")])
+    except TelegramBadRequest:
+        pass
+
+
+class OperatorReply(Filter):
+    """Пропускает реплай админа на сообщение бота о клиенте и передаёт обработчику client_id."""
+
+    async def __call__(self, message: Message) -> Union[bool, dict]:
+        if not message.from_user or message.from_user.id not in ADMIN_IDS:
+            return False
+        client_id = await reply_target(message)
+        return {"client_id": client_id} if client_id else False
+
+
+@operator_router.message(
+    F.chat.type.in_({"group", "supergroup"}),
+    ~F.text.startswith("/"),
+    OperatorReply(),
+)
+async def on_log_chat_reply(message: Message, client_id: int):
+    await send_operator_reply(message, client_id)
+
+
+async def render_queue(admin_id: int) -> Tuple[str, InlineKeyboardMarkup]:
+    rows = await db.list_operator_queue(admin_id, OPERATOR_QUEUE_LIMIT)
+    refresh = [InlineKeyboardButton(text="Обновить", callback_data="operator_queue")]
+    if not rows:
+        return "У вас нет клиентов в ручном режиме.", InlineKeyboardMarkup(inline_keyboard=[refresh])
+
+    now = datetime.now(timezone.utc)
+    waiting = sum(1 for r in rows if r["last_role"] == "user")
+    lines = [f"<b>Ваши клиенты</b>: {len(rows)}, ждут ответа: {waiting}\n"]
+    buttons = []
+    for r in rows:
+        client_id = r["user_telegram_id"]
+        label = f"@{r['username']}" if r["username"] else f"id:{client_id}"
+
+        if r["last_role"] == "user":
+            status = f"ждёт ответа {int((now - r['last_at']).total_seconds() // 60)} мин"
+        else:
+            status = "отвечено"
+        lines.append(f"• {html.escape(label)} — {status}")
+
+        buttons.append(
+            [
+                InlineKeyboardButton(text=f"💬 {label}", callback_data=f"operator_open:{client_id}"),
+                InlineKeyboardButton(text="Вернуть ИИ", callback_data=f"operator_ai:{client_id}"),
+            ]
+        )
+
+    lines.append("\nОтвечайте реплаем на сообщение клиента или откройте диалог кнопкой.")
+    buttons.append(refresh)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@operator_router.message(Command("queue"))
+async def operator_queue(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    text, kb = await render_queue(message.from_user.id)
+    await message.answer(text, reply_markup=kb)
+
+
+@operator_router.callback_query(F.data == "operator_queue")
+async def on_operator_queue(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    text, kb = await render_queue(callback.from_user.id)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        # Очередь не изменилась.
+        pass
+    await callback.answer()
+
+
+@operator_router.callback_query(F.data.startswith("operator_open:"))
+async def on_operator_open(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        client_id = int(callback.data.split(":", 1)[1])
+    except ValueError:
+        return await callback.answer("Некорректный клиент.", show_alert=True)
+
+    # История может быть длинной, поэтому диалог всегда открываем в личке админа.
+    try:
+        await open_client_chat(callback.bot, callback.from_user.id, callback.from_user.id, client_id)
+    except TelegramForbiddenError:
+        return await callback.answer("Сначала напишите боту в личку.", show_alert=True)
+    await callback.answer()
+
+
+@operator_router.callback_query(F.data.startswith("operator_ai:"))
+async def on_operator_return_ai(callback: CallbackQuery):
+    admin_id = callback.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    try:
+        client_id = int(callback.data.split(":", 1)[1])
+    except ValueError:
+        return await callback.answer("Некорректный клиент.", show_alert=True)
+
+    row = await db.return_conversation_to_ai(admin_id, client_id)
+    if row and row["released"]:
+        takeover_expiry.cancel(client_id)
+        await callback.answer(f"ИИ возвращён клиенту {client_id}.")
+    else:
+        await callback.answer("Клиент уже не за вами.", show_alert=True)
+
+    text, kb = await render_queue(admin_id)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
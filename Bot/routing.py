@@ -0,0 +1,148 @@
+import os
+import logging
+import re
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from .db import db
+from .llm import OPENAI_MODEL, OPENAI_MODEL_LIGHT
+from .tenants import TenantLocal
+
+logger = logging.getLogger(__name__)
+
+ROUTER_KB_THRESHOLD = float(os.getenv("ROUTER_KB_THRESHOLD", "2.0"))
+ROUTER_SHORT_WORDS = int(os.getenv("ROUTER_SHORT_WORDS", "6"))
+ROUTER_MAX_KEYWORDS = 300
+ROUTER_STEM_LENGTH = 6
+
+TOKEN_RE = re.compile(r"[a-zа-яё0-9]+", re.IGNORECASE)
+
+SMALL_TALK = {
+    "привет", "приветствую", "здравствуй", "здравствуйте", "добрый", "доброе", "день", "утро", "вечер",
+    "спасибо", "благодарю", "спс", "пасибо", "ок", "окей", "хорошо", "понял", "поняла", "понятно",
+    "ясно", "отлично", "супер", "класс", "да", "нет", "ага", "угу", "пока", "до", "свидания",
+    "всего", "доброго", "большое", "очень", "hi", "hello", "hey", "thanks", "thank", "you", "ok",
+    "okay", "bye", "yes", "no",
+}
+
+STOP_WORDS = {
+    "это", "как", "что", "для", "или", "если", "когда", "чтобы", "также", "может", "можно", "есть",
+    "быть", "будет", "было", "были", "который", "которые", "этот", "эти", "так", "уже", "все", "всё",
+    "при", "про", "над", "под", "без", "the", "and", "for", "with", "that", "this", "from", "are",
+    "was", "were", "have", "has", "not", "but", "you", "your",
+}
+
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".html", ".htm", ".xml", ".yaml", ".yml"}
+
+
+class RouteDecision(NamedTuple):
+    model: str
+    use_file_search: bool
+    reason: str
+    score: float
+
+    @property
+    def label(self) -> str:
+        tier = "light" if self.model == OPENAI_MODEL_LIGHT else "full"
+        return f"{tier}:{self.reason}"
+
+
+def tokenize(text: str) -> List[str]:
+    return [t.lower() for t in TOKEN_RE.findall(text or "")]
+
+
+def stem(word: str) -> str:
+    # Грубая обрезка окончаний: «доставка», «доставки», «доставку» дают один ключ.
+    return word[:ROUTER_STEM_LENGTH]
+
+
+def filename_keywords(filename: str) -> List[str]:
+    return [t for t in tokenize(os.path.splitext(filename)[0]) if len(t) >= 3]
+
+
+def extract_keywords(
+    filename: str, filepath: Optional[str] = None, mime_type: Optional[str] = None
+) -> Optional[List[str]]:
+    # Ключевые слова берём из текста файла. Для PDF и прочих нетекстовых файлов
+    # возвращаем None: по одному имени роутер не может судить о содержимом.
+    is_text = (mime_type or "").startswith("text/") or os.path.splitext(filename)[1].lower() in TEXT_EXTENSIONS
+    if not filepath or not is_text:
+        return None
+
+    try:
+        with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+            content = f.read(1_000_000)
+    except OSError:
+        return None
+
+    counter: Counter = Counter(
+        t for t in tokenize(content)
+        if len(t) >= 4 and t not in STOP_WORDS and not t.isdigit()
+    )
+    keywords = [t for t, _ in counter.most_common(ROUTER_MAX_KEYWORDS)]
+    for t in filename_keywords(filename):
+        if t not in keywords:
+            keywords.append(t)
+    return keywords
+
+
+class MessageRouter:
+    def __init__(self):
+        self._doc_freq: Dict[str, int] = {}
+        self._documents = 0
+        self._unknown_documents = 0
+
+    async def load(self) -> None:
+        rows = await db.list_agent_file_keywords()
+        # keywords IS NULL — содержимое файла не прочитано (нетекстовый файл или загружен
+        # до появления keywords): индексируем по имени, но считаем файл неизвестным.
+        self.build(
+            row["keywords"] if row["keywords"] is not None else filename_keywords(row["filename"])
+            for row in rows
+        )
+        self._unknown_documents = sum(1 for row in rows if row["keywords"] is None)
+        logger.info(
+            "Message router: %s documents (%s unindexed), %s keywords.",
+            self._documents,
+            self._unknown_documents,
+            len(self._doc_freq),
+        )
+
+    def build(self, documents: Iterable[Iterable[str]]) -> None:
+        doc_freq: Dict[str, int] = {}
+        count = 0
+        for keywords in documents:
+            count += 1
+            for word in {stem(k) for k in keywords}:
+                doc_freq[word] = doc_freq.get(word, 0) + 1
+
+        self._doc_freq = doc_freq
+        self._documents = count
+
+    def kb_score(self, tokens: List[str]) -> float:
+        score = 0.0
+        for word in {stem(t) for t in tokens}:
+            df = self._doc_freq.get(word)
+            if df:
+                score += math.log((self._documents + 1) / df) + 1
+        return score
+
+    def route(self, text: str) -> RouteDecision:
+        tokens = tokenize(text)
+
+        if not tokens or all(t in SMALL_TALK for t in tokens):
+            return RouteDecision(OPENAI_MODEL_LIGHT, False, "small_talk", 0.0)
+
+        score = self.kb_score(tokens)
+        if score >= ROUTER_KB_THRESHOLD:
+            return RouteDecision(OPENAI_MODEL, True, "kb_match", score)
+
+        # Без полного индекса не можем судить о базе знаний — ищем по файлам как раньше.
+        if self._doc_freq and not self._unknown_documents and len(tokens) <= ROUTER_SHORT_WORDS and "?" not in text:
+            return RouteDecision(OPENAI_MODEL_LIGHT, False, "short_no_kb", score)
+
+        return RouteDecision(OPENAI_MODEL, True, "default", score)
+
+
+message_router = TenantLocal(MessageRouter)
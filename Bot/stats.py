@@ -0,0 +1,155 @@
+import os
+import logging
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from aiogram import Router, F
+from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    Message,
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+)
+
+from .db import db
+from .config import ADMIN_IDS
+from .tenants import TenantLocal
+from .lifecycle import supervisor
+
+logger = logging.getLogger(__name__)
+
+STATS_REFRESH_SECONDS = float(os.getenv("STATS_REFRESH_SECONDS", "60"))
+STATS_ACTIVE_REFRESH_SECONDS = float(os.getenv("STATS_ACTIVE_REFRESH_SECONDS", "600"))
+STATS_BATCH_SIZE = int(os.getenv("STATS_BATCH_SIZE", "50000"))
+STATS_SETTLE_SECONDS = 30
+
+PERIODS = {
+    "day": ("за сутки", 1),
+    "week": ("за неделю", 7),
+    "month": ("за месяц", 30),
+}
+
+stats_router = Router()
+
+stats_kb = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="День", callback_data="stats:day"),
+            InlineKeyboardButton(text="Неделя", callback_data="stats:week"),
+            InlineKeyboardButton(text="Месяц", callback_data="stats:month"),
+        ]
+    ]
+)
+
+
+class StatsAggregator:
+    """
+    Докатывает роллапы /stats по новым строкам messages и takeover_events.
+    Каждый проход берёт только строки за сохранённой в settings отметкой,
+    поэтому стоимость не зависит от размера таблиц.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._active_refreshed_at = 0.0
+
+    def start(self) -> None:
+        self._task = supervisor.spawn("stats_rollup", self._run)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh(self) -> None:
+        while await db.rollup_message_stats(STATS_BATCH_SIZE, STATS_SETTLE_SECONDS) >= STATS_BATCH_SIZE:
+            pass
+        while await db.rollup_takeover_stats(STATS_BATCH_SIZE, STATS_SETTLE_SECONDS) >= STATS_BATCH_SIZE:
+            pass
+
+        if time.monotonic() - self._active_refreshed_at >= STATS_ACTIVE_REFRESH_SECONDS:
+            await db.refresh_active_user_counts([days for _, days in PERIODS.values()])
+            self._active_refreshed_at = time.monotonic()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Stats rollup error")
+            await asyncio.sleep(STATS_REFRESH_SECONDS)
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} мин {seconds} с" if minutes else f"{seconds} с"
+
+
+async def render_stats(period: str) -> str:
+    started = time.perf_counter()
+    title, days = PERIODS[period]
+    since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(days=days)
+
+    row = await db.get_stats_summary(since, days)
+
+    ai = row["ai_messages"]
+    admin = row["admin_messages"]
+    replies = ai + admin
+    ai_share = ai / replies if replies else 0.0
+    avg_takeover = row["takeover_seconds"] / row["takeovers_ended"] if row["takeovers_ended"] else 0
+
+    active = row["active_users"]
+    active_text = str(active) if active is not None else "ещё считается"
+
+    lines = [
+        f"<b>Статистика {title}</b>\n",
+        f"Сообщений от клиентов: {row['user_messages']}",
+        f"Ответов ИИ: {ai}",
+        f"Ответов операторов: {admin}",
+        f"Доля ИИ в ответах: {ai_share:.0%}",
+        f"Активных клиентов: {active_text}",
+        "",
+        f"Перехватов диалога: {row['takeovers_started']}",
+        f"Завершено перехватов: {row['takeovers_ended']}",
+        f"Средняя длительность перехвата: {_format_duration(avg_takeover)}",
+        "",
+        f"<i>Данные с задержкой до {int(STATS_REFRESH_SECONDS + STATS_SETTLE_SECONDS)} с, "
+        f"собрано за {(time.perf_counter() - started) * 1000:.0f} мс</i>",
+    ]
+    return "\n".join(lines)
+
+
+stats_aggregator = TenantLocal(StatsAggregator)
+
+
+@stats_router.message(Command("stats"))
+async def stats_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    await message.answer(await render_stats("day"), reply_markup=stats_kb)
+
+
+@stats_router.callback_query(F.data.startswith("stats:"))
+async def on_stats_period(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("Нет доступа", show_alert=True)
+
+    period = callback.data.split(":", 1)[1]
+    if period not in PERIODS:
+        return await callback.answer("Неизвестный период.", show_alert=True)
+
+    try:
+        await callback.message.edit_text(await render_stats(period), reply_markup=stats_kb)
+    except TelegramBadRequest:
+        # Период не изменился — Telegram не даёт отредактировать сообщение тем же текстом.
+        pass
+    await callback.answer()
@@ -0,0 +1,87 @@
+import os
+import logging
+import asyncio
+from typing import Dict, Optional
+
+from .db import db
+from .llm import summarize_conversation
+from .tenants import TenantLocal
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_IDLE_SECONDS = int(os.getenv("SUMMARY_IDLE_SECONDS", "300"))
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "200"))
+
+
+class ConversationSummarizer:
+    def __init__(self):
+        self._idle_timers: Dict[int, asyncio.TimerHandle] = {}
+        self._running: Dict[int, asyncio.Task] = {}
+
+    def touch(self, user_id: int) -> None:
+        # Сводку обновляем только когда клиент замолчал, а не на каждом сообщении.
+        timer = self._idle_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+
+        loop = asyncio.get_running_loop()
+        self._idle_timers[user_id] = loop.call_later(
+            SUMMARY_IDLE_SECONDS,
+            self._on_idle,
+            user_id,
+        )
+
+    def _on_idle(self, user_id: int) -> None:
+        self._idle_timers.pop(user_id, None)
+
+        if user_id in self._running:
+            self.touch(user_id)
+            return
+
+        task = asyncio.create_task(self._update_safe(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda _: self._running.pop(user_id, None))
+
+    async def _update_safe(self, user_id: int) -> None:
+        try:
+            await self.update_summary(user_id)
+        except Exception:
+            logger.exception("Summary update error for user %s", user_id)
+
+    async def update_summary(self, user_id: int) -> Optional[str]:
+        row = await db.get_user_summary(user_id, primary=True)
+        summary = row["summary"] if row else ""
+        last_message_id = row["last_message_id"] if row else 0
+
+        while True:
+            messages = await db.get_messages_after(user_id, last_message_id, SUMMARY_BATCH_SIZE, primary=True)
+            if not messages:
+                break
+
+            new_summary = await summarize_conversation(summary, messages)
+            if new_summary is None:
+                break
+
+            summary = new_summary
+            last_message_id = messages[-1]["id"]
+            await db.save_user_summary(user_id, summary, last_message_id)
+
+            if len(messages) < SUMMARY_BATCH_SIZE:
+                break
+
+        return summary or None
+
+    async def get_summary(self, user_id: int) -> Optional[str]:
+        row = await db.get_user_summary(user_id)
+        return row["summary"] if row else None
+
+    async def close(self) -> None:
+        for timer in self._idle_timers.values():
+            timer.cancel()
+        self._idle_timers.clear()
+
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+
+conversation_summarizer = TenantLocal(ConversationSummarizer)
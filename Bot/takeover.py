@@ -1,10 +1,13 @@
-from aiogram import Router
+import html
+
+from aiogram import Bot, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.filters.command import CommandObject
 from aiogram.types import Message
 
 from .db import db
 from .config import ADMIN_IDS
+from .takeover_expiry import takeover_expiry
 
 takeover_router = Router()
 
@@ -30,45 +33,44 @@ async def admin_start(message: Message, command: CommandObject):
         await message.answer("Некорректный ID клиента в ссылке.")
         return
 
-    await db.set_conversation_mode(
-        user_telegram_id=user_id,
-        mode="admin",
-        taken_by_admin_id=admin_id
-    )
+    await open_client_chat(message.bot, message.chat.id, admin_id, user_id)
 
-    await db.set_admin_active_chat(admin_id=admin_id, user_telegram_id=user_id)
 
-    row = await db.fetchrow("SELECT id, username FROM users WHERE telegram_id = $1;", user_id)
-    if not row:
-        await message.answer(
-            f"Диалог открыт с клиентом {user_id}, но истории пока нет.\n"
-            "Команды: /close — закрыть диалог, /ai — вернуть ИИ клиенту"
+def owner_link(admin_id: int) -> str:
+    return f'<a href="tg://user?id={admin_id}">{admin_id}</a>'
+
+
+async def open_client_chat(bot: Bot, chat_id: int, admin_id: int, user_id: int) -> bool:
+    """Захватывает клиента и делает его активным диалогом админа. Ответ уходит в chat_id."""
+    row = await db.take_over_conversation(user_telegram_id=user_id, admin_id=admin_id, history_limit=20)
+    if not row["taken"]:
+        await bot.send_message(
+            chat_id,
+            f"Клиента {user_id} уже ведёт админ {owner_link(row['owner_admin_id'])}.\n"
+            "Открыть диалог можно будет после /ai у этого админа или по таймауту.",
         )
-        return
+        return False
 
-    internal_user_id = row["id"]
-    username = row["username"] or "без username"
+    await takeover_expiry.schedule(user_id, admin_id)
 
-    history = await db.fetch(
-        """
-        SELECT role, content, created_at
-        FROM messages
-        WHERE user_id = $1
-        ORDER BY created_at DESC
-        LIMIT 20;
-        """,
-        internal_user_id,
-    )
+    if row["user_id"] is None:
+        await bot.send_message(
+            chat_id,
+            f"Диалог открыт с клиентом {user_id}, но истории пока нет.\n"
+            "Команды: /close — закрыть диалог, /ai — вернуть ИИ клиенту",
+        )
+        return True
 
-    history = list(reversed(history))
+    username = row["username"] or "без username"
+    history = list(zip(row["roles"], row["contents"]))
 
-    lines = [f"Открыт диалог с клиентом @{username} (id: {user_id})\n"]
+    lines = [f"Открыт диалог с клиентом @{html.escape(username)} (id: {user_id})\n"]
+    if row["summary"]:
+        lines.append(f"Краткое содержание:\n{html.escape(row['summary'])}\n")
     if not history:
         lines.append("История пуста.")
     else:
-        for h in history:
-            role = h["role"]
-            content = h["content"]
+        for role, content in history:
             if role == "user":
                 prefix = "Клиент"
             elif role == "assistant":
@@ -77,12 +79,14 @@ async def admin_start(message: Message, command: CommandObject):
                 prefix = "Админ"
             else:
                 prefix = role
-            lines.append(f"{prefix}: {content}")
+            lines.append(f"{prefix}: {html.escape(content)}")
 
     lines.append("\nПишите сюда, я пересилаю сообщение клиенту.")
+    lines.append("Другим клиентам можно отвечать реплаем на их сообщения, очередь — /queue.")
     lines.append("Команды: /close — закрыть диалог, /ai — вернуть ИИ клиенту")
 
-    await message.answer("\n".join(lines))
+    await bot.send_message(chat_id, "\n".join(lines))
+    return True
 
 
 @takeover_router.message(Command("close"))
@@ -91,12 +95,10 @@ async def close_chat(message: Message):
     if admin_id not in ADMIN_IDS:
         return await message.answer("Нет прав.")
 
-    user_id = await db.get_admin_active_chat(admin_id)
+    user_id = await db.release_admin_chat(admin_id)
     if not user_id:
         return await message.answer("Нет активного диалога. Откройте через кнопку в лог-группе.")
 
-    await db.clear_admin_active_chat(admin_id)
-
     await message.answer(
         f"Диалог с клиентом {user_id} закрыт для вас.\n"
         "Режим клиента не менял. Чтобы вернуть ИИ — команда /ai."
@@ -109,16 +111,46 @@ async def return_ai(message: Message):
     if admin_id not in ADMIN_IDS:
         return await message.answer("Нет прав.")
 
-    user_id = await db.get_admin_active_chat(admin_id)
-    if not user_id:
+    row = await db.return_conversation_to_ai(admin_id)
+    if not row:
         return await message.answer("Нет активного диалога. Откройте через кнопку в лог-группе.")
 
-    await db.set_conversation_mode(
-        user_telegram_id=user_id,
-        mode="ai",
-        taken_by_admin_id=None,
-    )
+    user_id = row["user_telegram_id"]
+    if row["released"]:
+        takeover_expiry.cancel(user_id)
+        return await message.answer(f"ИИ возвращён клиенту {user_id}.")
+
+    owner = row["owner_admin_id"]
+    if row["mode"] == "admin" and owner is not None and owner != admin_id:
+        return await message.answer(
+            f"Клиента {user_id} уже ведёт админ {owner_link(owner)}, "
+            "режим не менял. Ваш диалог закрыт."
+        )
+    await message.answer(f"Клиент {user_id} уже на ИИ. Ваш диалог закрыт.")
+
+
+@takeover_router.message(Command("timeout"))
+async def set_takeover_timeout(message: Message, command: CommandObject):
+    admin_id = message.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    arg = (command.args or "").strip()
+    if not arg:
+        minutes = await takeover_expiry.timeout_for(admin_id)
+        return await message.answer(
+            f"Ваш таймаут ручного режима: {minutes} мин.\n"
+            "Изменить: /timeout <минуты>"
+        )
+
+    try:
+        minutes = int(arg)
+    except ValueError:
+        return await message.answer("Укажите таймаут целым числом минут, например /timeout 30")
+
+    if minutes <= 0:
+        return await message.answer("Таймаут должен быть больше нуля.")
 
-    await db.clear_admin_active_chat(admin_id)
-    await message.answer(f"ИИ возвращён клиенту {user_id}.")
+    await takeover_expiry.set_timeout(admin_id, minutes)
+    await message.answer(f"Таймаут ручного режима: {minutes} мин. Отсчёт идёт с последнего сообщения в диалоге.")
 
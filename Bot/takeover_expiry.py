@@ -0,0 +1,217 @@
+import logging
+import heapq
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+
+from .db import db
+from .config import TAKEOVER_TIMEOUT_MINUTES, TAKEOVER_EXPIRY_TICK_SECONDS
+from .tenants import TenantLocal
+from .lifecycle import supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class TakeoverExpiryScheduler:
+    """
+    Держит дедлайны ручного режима в min-heap и возвращает клиентов ИИ,
+    когда оператор не проявлял активности дольше своего таймаута.
+    Продление дедлайна меняет только self._deadlines, а устаревшая запись
+    перекладывается в куче при извлечении.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._deadlines: Dict[int, datetime] = {}
+        self._owners: Dict[int, int] = {}
+        self._timeouts: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+
+    async def load(self) -> None:
+        rows = await db.list_admin_conversations(TAKEOVER_TIMEOUT_MINUTES)
+        now = datetime.now(timezone.utc)
+
+        for row in rows:
+            if row["takeover_timeout_minutes"]:
+                self._timeouts[row["taken_by_admin_id"]] = row["takeover_timeout_minutes"]
+
+            # Загрузка идёт уже после старта polling: свежие перехваты не перетираем.
+            if row["user_telegram_id"] in self._deadlines:
+                continue
+
+            # Диалоги без админа или без времени захвата закрываем сразу.
+            deadline = row["expires_at"] or now
+            self._track(row["user_telegram_id"], row["taken_by_admin_id"], deadline)
+
+        logger.info("Takeover expiry: loaded %s active takeovers.", len(rows))
+
+    def start(self, bot: Bot) -> None:
+        self._bot = bot
+        self._task = supervisor.spawn("takeover_expiry", self._run)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self._flush_deadlines()
+
+    async def timeout_for(self, admin_id: int) -> int:
+        minutes = self._timeouts.get(admin_id)
+        if minutes is None:
+            minutes = await db.get_admin_takeover_timeout(admin_id) or TAKEOVER_TIMEOUT_MINUTES
+            self._timeouts[admin_id] = minutes
+        return minutes
+
+    async def set_timeout(self, admin_id: int, minutes: int) -> None:
+        await db.set_admin_takeover_timeout(admin_id, minutes)
+        self._timeouts[admin_id] = minutes
+
+        for user_id, owner_id in list(self._owners.items()):
+            if owner_id == admin_id:
+                self.touch(user_id)
+
+    async def schedule(self, user_telegram_id: int, admin_id: int) -> None:
+        minutes = await self.timeout_for(admin_id)
+        deadline = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+        self._track(user_telegram_id, admin_id, deadline)
+        self._dirty.add(user_telegram_id)
+
+    def touch(self, user_telegram_id: int) -> None:
+        admin_id = self._owners.get(user_telegram_id)
+        if admin_id is None:
+            return
+
+        minutes = self._timeouts.get(admin_id, TAKEOVER_TIMEOUT_MINUTES)
+        self._track(user_telegram_id, admin_id, datetime.now(timezone.utc) + timedelta(minutes=minutes))
+        self._dirty.add(user_telegram_id)
+
+    def cancel(self, user_telegram_id: int) -> None:
+        self._deadlines.pop(user_telegram_id, None)
+        self._owners.pop(user_telegram_id, None)
+        self._dirty.discard(user_telegram_id)
+
+    def _track(self, user_telegram_id: int, admin_id: Optional[int], deadline: datetime) -> None:
+        previous = self._deadlines.get(user_telegram_id)
+        self._deadlines[user_telegram_id] = deadline
+        self._owners[user_telegram_id] = admin_id
+
+        # Продление не трогает кучу, а более ранний дедлайн нужно положить заново.
+        if previous is None or deadline < previous:
+            heapq.heappush(self._heap, (deadline, user_telegram_id))
+            self._wakeup.set()
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_telegram_id = heapq.heappop(self._heap)
+            current = self._deadlines.get(user_telegram_id)
+
+            if current is None:
+                continue
+
+            if current > now:
+                # Дедлайн продлили после того, как запись попала в кучу.
+                if current != deadline:
+                    heapq.heappush(self._heap, (current, user_telegram_id))
+                continue
+
+            if user_telegram_id not in due:
+                due.append(user_telegram_id)
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Takeover expiry error")
+
+            timeout = TAKEOVER_EXPIRY_TICK_SECONDS
+            if self._heap:
+                until_next = (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds()
+                timeout = max(0.0, min(timeout, until_next))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _tick(self) -> None:
+        await self._flush_deadlines()
+
+        due = self._pop_due(datetime.now(timezone.utc))
+        if due:
+            await self._expire(due)
+
+    async def _flush_deadlines(self) -> None:
+        if not self._dirty:
+            return
+
+        user_ids = [u for u in self._dirty if u in self._deadlines]
+        self._dirty.clear()
+        if not user_ids:
+            return
+
+        deadlines = [self._deadlines[u] for u in user_ids]
+        try:
+            await db.set_conversation_deadlines(user_ids, deadlines)
+        except Exception:
+            self._dirty.update(user_ids)
+            raise
+
+    async def _expire(self, user_ids: List[int]) -> None:
+        rows = await db.expire_conversations(user_ids)
+        expired = {row["user_telegram_id"] for row in rows}
+
+        for row in rows:
+            user_telegram_id = row["user_telegram_id"]
+            admin_id = row["taken_by_admin_id"]
+            self.cancel(user_telegram_id)
+            if admin_id:
+                await self._notify_admin(admin_id, user_telegram_id)
+
+        # Остальных мог продлить или закрыть другой процесс — сверяемся с БД.
+        remaining = [u for u in user_ids if u not in expired]
+        if not remaining:
+            return
+
+        for user_telegram_id in remaining:
+            self.cancel(user_telegram_id)
+
+        rows = await db.list_admin_conversations(TAKEOVER_TIMEOUT_MINUTES, remaining)
+        now = datetime.now(timezone.utc)
+        for row in rows:
+            self._track(row["user_telegram_id"], row["taken_by_admin_id"], row["expires_at"] or now)
+
+    async def _notify_admin(self, admin_id: int, user_telegram_id: int) -> None:
+        if self._bot is None:
+            return
+
+        minutes = self._timeouts.get(admin_id, TAKEOVER_TIMEOUT_MINUTES)
+        try:
+            await self._bot.send_message(
+                chat_id=admin_id,
+                text=(
+                    f"Диалог с клиентом {user_telegram_id} закрыт: "
+                    f"нет активности больше {minutes} мин.\n"
+                    "Клиента снова обслуживает ИИ."
+                ),
+            )
+        except Exception as e:
+            logger.warning("Takeover expiry notify error for admin %s: %r", admin_id, e)
+
+
+takeover_expiry = TenantLocal(TakeoverExpiryScheduler)
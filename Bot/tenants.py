@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# JSON-файл со списком ботов. Без него процесс обслуживает одного бота из переменных окружения.
+BOTS_CONFIG = os.getenv("BOTS_CONFIG")
+DEFAULT_TENANT = "default"
+TENANT_NAME_RE = re.compile(r"^[a-z][a-z0-9_]{0,40}$")
+
+current_tenant: contextvars.ContextVar[str] = contextvars.ContextVar("tenant", default=DEFAULT_TENANT)
+
+
+def tenant_schema(name: str) -> str:
+    # Бот по умолчанию остаётся в public, чтобы существующие установки не пришлось переносить.
+    return "public" if name == DEFAULT_TENANT else f"tenant_{name}"
+
+
+def _parse_ids(value: Union[str, List[int], None]) -> List[int]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [int(x) for x in value.split(",") if x.strip()]
+    return [int(x) for x in value]
+
+
+class TenantConfig:
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        admin_ids: List[int],
+        log_chat_id: int = 0,
+        bot_username: str = "",
+        prompt: Optional[str] = None,
+        vector_store_id: Optional[str] = None,
+    ):
+        self.name = name
+        self.token = token
+        self.admin_ids = admin_ids
+        self.log_chat_id = log_chat_id
+        self.bot_username = bot_username.strip().lstrip("@")
+        self.prompt = prompt
+        self.vector_store_id = vector_store_id
+
+    @property
+    def schema(self) -> str:
+        return tenant_schema(self.name)
+
+    @property
+    def bot_id(self) -> int:
+        # id бота — часть токена до двоеточия, сеть для этого не нужна.
+        return int(self.token.split(":", 1)[0])
+
+
+def load_tenant_configs() -> Dict[str, TenantConfig]:
+    """
+    Формат BOTS_CONFIG:
+      [{"name": "shop", "token": "...", "admin_ids": [1, 2], "log_chat_id": -100...,
+        "bot_username": "shop_bot", "prompt": "...", "vector_store_id": "vs_..."}]
+    prompt и vector_store_id необязательны: по умолчанию берутся из settings бота.
+    """
+    if not BOTS_CONFIG:
+        return {
+            DEFAULT_TENANT: TenantConfig(
+                DEFAULT_TENANT,
+                token=os.getenv("TELEGRAM_BOT_TOKEN", ""),
+                admin_ids=_parse_ids(os.getenv("ADMIN_IDS", "")),
+                log_chat_id=int(os.getenv("LOG_CHAT_ID", "0")),
+                bot_username=os.getenv("BOT_USERNAME", ""),
+                prompt=os.getenv("SYSTEM_PROMPT"),
+            )
+        }
+
+    with open(BOTS_CONFIG, encoding="utf-8") as f:
+        items = json.load(f)
+
+    configs: Dict[str, TenantConfig] = {}
+    for item in items:
+        name = item["name"]
+        if not TENANT_NAME_RE.match(name):
+            raise RuntimeError(f"Некорректное имя бота в BOTS_CONFIG: {name!r}")
+        if name in configs:
+            raise RuntimeError(f"Бот {name!r} указан в BOTS_CONFIG дважды.")
+
+        configs[name] = TenantConfig(
+            name,
+            token=item["token"],
+            admin_ids=_parse_ids(item.get("admin_ids")),
+            log_chat_id=int(item.get("log_chat_id") or 0),
+            bot_username=item.get("bot_username", ""),
+            prompt=item.get("prompt"),
+            vector_store_id=item.get("vector_store_id"),
+        )
+    return configs
+
+
+TENANTS = load_tenant_configs()
+
+
+def get_tenant(name: Optional[str] = None) -> TenantConfig:
+    return TENANTS[name or current_tenant.get()]
+
+
+@contextmanager
+def use_tenant(name: str):
+    token = current_tenant.set(name)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+
+class TenantLocal:
+    """
+    Прокси к объекту, который у каждого бота свой: обращения уходят
+    в экземпляр текущего current_tenant, экземпляры создаются лениво.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instances", {})
+
+    def for_tenant(self, name: Optional[str] = None) -> Any:
+        name = name or current_tenant.get()
+        instances = self._instances
+        if name not in instances:
+            with use_tenant(name):
+                instances[name] = self._factory()
+        return instances[name]
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.for_tenant(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self.for_tenant(), name, value)
+
+
+class TenantAdminIds:
+    # Ведёт себя как список ADMIN_IDS, но отдаёт админов текущего бота.
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in get_tenant().admin_ids
+
+    def __iter__(self):
+        return iter(get_tenant().admin_ids)
+
+    def __len__(self) -> int:
+        return len(get_tenant().admin_ids)
+
+
+class TenantMiddleware(BaseMiddleware):
+    """Определяет бота по апдейту и выставляет current_tenant до остальных middleware."""
+
+    def __init__(self):
+        self._by_bot_id = {config.bot_id: name for name, config in TENANTS.items()}
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = self._by_bot_id.get(data["bot"].id)
+        if name is None:
+            return None
+
+        token = current_tenant.set(name)
+        try:
+            return await handler(event, data)
+        finally:
+            current_tenant.reset(token)
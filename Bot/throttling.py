@@ -0,0 +1,129 @@
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+from .config import ADMIN_IDS
+from .tenants import current_tenant
+
+FLOOD_WINDOW_SECONDS = float(os.getenv("FLOOD_WINDOW_SECONDS", "60"))
+FLOOD_SOFT_LIMIT = int(os.getenv("FLOOD_SOFT_LIMIT", "20"))
+FLOOD_HARD_LIMIT = int(os.getenv("FLOOD_HARD_LIMIT", "40"))
+FLOOD_IDLE_SECONDS = float(os.getenv("FLOOD_IDLE_SECONDS", "600"))
+
+SLOW_DOWN_TEXT = "Вы отправляете сообщения слишком часто. Пожалуйста, подождите немного."
+BLOCKED_TEXT = "Слишком много сообщений. Я отвечу на новые через минуту."
+TEXT_ONLY_TEXT = "Я понимаю только текстовые сообщения. Напишите, пожалуйста, вопрос текстом."
+
+
+class _Window:
+    # Скользящее окно приближаем двумя фиксированными: на клиента хранится несколько чисел, а не список времён.
+    __slots__ = ("started", "current", "previous", "warned", "seen_at")
+
+    def __init__(self, now: float):
+        self.started = now
+        self.current = 0
+        self.previous = 0
+        self.warned = 0  # 1 — просили притормозить, 2 — сообщили о блокировке
+        self.seen_at = now
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту сообщений клиента и не пускает к LLM то, на что ей нечего ответить.
+      - до FLOOD_SOFT_LIMIT сообщений за окно — обычная обработка;
+      - выше мягкого лимита сообщение обрабатывается, но клиент один раз за окно получает просьбу притормозить;
+      - выше FLOOD_HARD_LIMIT сообщения отбрасываются до конца окна.
+    Стикеры, фото, голосовые и пустые сообщения отвечаются сразу, без обращения к модели.
+    Админов не трогаем: им нужны документы для базы знаний.
+    """
+
+    def __init__(
+        self,
+        window: float = FLOOD_WINDOW_SECONDS,
+        soft_limit: int = FLOOD_SOFT_LIMIT,
+        hard_limit: int = FLOOD_HARD_LIMIT,
+        idle_seconds: float = FLOOD_IDLE_SECONDS,
+    ):
+        self.window = window
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.idle_seconds = idle_seconds
+        self._windows: Dict[Tuple[str, int], _Window] = {}
+        self._swept_at = time.monotonic()
+        self.stats = {"passed": 0, "soft_warned": 0, "blocked": 0, "non_text": 0, "evicted": 0}
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.chat.type != "private" or not event.from_user or event.from_user.id in ADMIN_IDS:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        entry, rate = self._hit((current_tenant.get(), event.from_user.id), now)
+
+        if rate > self.hard_limit:
+            self.stats["blocked"] += 1
+            if entry.warned < 2:
+                entry.warned = 2
+                await event.answer(BLOCKED_TEXT, parse_mode=None)
+            return None
+
+        if rate > self.soft_limit and entry.warned < 1:
+            entry.warned = 1
+            self.stats["soft_warned"] += 1
+            await event.answer(SLOW_DOWN_TEXT, parse_mode=None)
+
+        if not (event.text or "").strip():
+            self.stats["non_text"] += 1
+            await event.answer(TEXT_ONLY_TEXT, parse_mode=None)
+            return None
+
+        self.stats["passed"] += 1
+        return await handler(event, data)
+
+    def _hit(self, key: Tuple[str, int], now: float) -> Tuple[_Window, float]:
+        entry = self._windows.get(key)
+        if entry is None:
+            entry = self._windows[key] = _Window(now)
+
+        elapsed = now - entry.started
+        if elapsed >= self.window:
+            # Окно сдвигаем целыми шагами; после долгой паузы прошлое окно пустое.
+            steps = int(elapsed // self.window)
+            entry.previous = entry.current if steps == 1 else 0
+            entry.current = 0
+            entry.warned = 0
+            entry.started += steps * self.window
+            elapsed = now - entry.started
+
+        entry.current += 1
+        entry.seen_at = now
+        return entry, entry.previous * (1 - elapsed / self.window) + entry.current
+
+    def _evict_idle(self, now: float) -> None:
+        if now - self._swept_at < self.idle_seconds:
+            return
+        self._swept_at = now
+
+        idle = [key for key, entry in self._windows.items() if now - entry.seen_at >= self.idle_seconds]
+        for key in idle:
+            del self._windows[key]
+        self.stats["evicted"] += len(idle)
+
+    def format_stats(self) -> str:
+        return (
+            f"Антифлуд: пропущено {self.stats['passed']}, предупреждений {self.stats['soft_warned']}, "
+            f"отброшено {self.stats['blocked']}, не текст {self.stats['non_text']}, "
+            f"клиентов в памяти {len(self._windows)}"
+        )
+
+
+throttling = ThrottlingMiddleware()
@@ -0,0 +1,262 @@
+import os
+import logging
+import time
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import Message
+
+from .db import db
+from .config import ADMIN_IDS
+from .tenants import TenantLocal
+from .lifecycle import supervisor
+
+logger = logging.getLogger(__name__)
+
+USER_DAILY_TOKEN_QUOTA = int(os.getenv("USER_DAILY_TOKEN_QUOTA", "0"))   # 0 — без лимита
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "5"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+USAGE_RECONCILE_SECONDS = float(os.getenv("USAGE_RECONCILE_SECONDS", "300"))
+
+# Цены в долларах за 1M токенов: input / cached input / output.
+# Переопределяются через OPENAI_PRICES="gpt-4.1-mini=0.4/0.1/1.6,gpt-4.1-nano=0.1/0.025/0.4".
+DEFAULT_PRICES = {
+    "gpt-4.1": (2.0, 0.5, 8.0),
+    "gpt-4.1-mini": (0.4, 0.1, 1.6),
+    "gpt-4.1-nano": (0.1, 0.025, 0.4),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+}
+
+
+def _load_prices() -> Dict[str, tuple]:
+    prices = dict(DEFAULT_PRICES)
+    for item in os.getenv("OPENAI_PRICES", "").split(","):
+        if "=" not in item:
+            continue
+        model, values = item.split("=", 1)
+        try:
+            parts = tuple(float(x) for x in values.split("/"))
+        except ValueError:
+            continue
+        if len(parts) == 3:
+            prices[model.strip()] = parts
+    return prices
+
+
+PRICES = _load_prices()
+
+usage_router = Router()
+
+
+def estimate_cost(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> Optional[float]:
+    price = PRICES.get(model)
+    if price is None:
+        # API возвращает модель с датой версии, например gpt-4.1-mini-2025-04-14.
+        matches = [name for name in PRICES if model.startswith(name + "-")]
+        if not matches:
+            return None
+        price = PRICES[max(matches, key=len)]
+    input_price, cached_price, output_price = price
+    uncached = max(0, input_tokens - cached_tokens)
+    return (uncached * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1_000_000
+
+
+class UsageTracker:
+    def __init__(self):
+        self._buffer: list = []
+        self._day: date = datetime.now(timezone.utc).date()
+        self._daily_tokens: Dict[int, int] = {}
+        self._reconciled_at = time.monotonic()
+        self._flush_needed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        *,
+        user_telegram_id: Optional[int],
+        purpose: str,
+        model: str,
+        input_tokens: int,
+        output_tokens: int,
+        cached_tokens: int,
+        file_search_calls: int,
+        latency_ms: int,
+        route: Optional[str] = None,
+        route_score: Optional[float] = None,
+        prompt_version: Optional[int] = None,
+    ) -> None:
+        now = datetime.now(timezone.utc)
+        self._buffer.append(
+            (
+                user_telegram_id,
+                purpose,
+                model,
+                input_tokens,
+                output_tokens,
+                cached_tokens,
+                file_search_calls,
+                latency_ms,
+                now,
+                route,
+                route_score,
+                prompt_version,
+            )
+        )
+
+        self._roll_day(now.date())
+        if user_telegram_id is not None and user_telegram_id in self._daily_tokens:
+            self._daily_tokens[user_telegram_id] += input_tokens + output_tokens
+
+        if len(self._buffer) >= USAGE_BATCH_SIZE:
+            self._flush_needed.set()
+
+    async def has_quota(self, user_telegram_id: int) -> bool:
+        if USER_DAILY_TOKEN_QUOTA <= 0:
+            return True
+
+        today = datetime.now(timezone.utc).date()
+        self._roll_day(today)
+
+        used = self._daily_tokens.get(user_telegram_id)
+        if used is None:
+            used = await db.get_user_daily_tokens(user_telegram_id, today)
+            # Ещё не сброшенные в БД вызовы тоже считаются.
+            used += sum(r[3] + r[4] for r in self._buffer if r[0] == user_telegram_id)
+            self._daily_tokens[user_telegram_id] = used
+
+        return used < USER_DAILY_TOKEN_QUOTA
+
+    def _roll_day(self, today: date) -> None:
+        if today != self._day:
+            self._day = today
+            self._daily_tokens.clear()
+
+    def start(self) -> None:
+        self._task = supervisor.spawn("usage_flush", self._run)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=USAGE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Usage flush error")
+
+            if time.monotonic() - self._reconciled_at >= USAGE_RECONCILE_SECONDS:
+                # Счётчики перечитываются из БД, чтобы учесть вызовы других процессов.
+                self._reconciled_at = time.monotonic()
+                self._daily_tokens.clear()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+
+        hourly: Dict[tuple, list] = {}
+        daily: Dict[tuple, list] = {}
+        versions: Dict[int, list] = {}
+        for user_telegram_id, _, model, inp, out, cached, fs, latency, created_at, _, _, prompt_version in batch:
+            hour = created_at.replace(minute=0, second=0, microsecond=0)
+            for key, bucket in (
+                ((hour, model), hourly),
+                ((created_at.date(), user_telegram_id or 0, model), daily),
+            ):
+                totals = bucket.setdefault(key, [0, 0, 0, 0, 0, 0])
+                totals[0] += 1
+                totals[1] += inp
+                totals[2] += out
+                totals[3] += cached
+                totals[4] += fs
+                totals[5] += latency
+
+            if prompt_version is not None:
+                totals = versions.setdefault(prompt_version, [0, 0, 0, 0, 0])
+                totals[0] += 1
+                totals[1] += inp
+                totals[2] += out
+                totals[3] += cached
+                totals[4] += latency
+
+        try:
+            await db.save_llm_usage_batch(
+                records=batch,
+                hourly=[(*k, *v) for k, v in hourly.items()],
+                daily=[(*k, *v) for k, v in daily.items()],
+                prompt_versions=[(k, *v) for k, v in versions.items()],
+            )
+        except Exception:
+            self._buffer = batch + self._buffer
+            raise
+
+
+usage_tracker = TenantLocal(UsageTracker)
+
+
+@usage_router.message(Command("usage"))
+async def usage_report(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return await message.answer("Нет прав.")
+
+    await usage_tracker.flush()
+
+    today = datetime.now(timezone.utc).date()
+    lines = []
+
+    for title, since in (("Сегодня", today), ("За 7 дней", today - timedelta(days=6))):
+        rows = await db.get_usage_by_model(since)
+        lines.append(f"<b>{title}</b>")
+        if not rows:
+            lines.append("Вызовов не было.\n")
+            continue
+
+        total_cost = 0.0
+        for r in rows:
+            cost = estimate_cost(r["model"], r["input_tokens"], r["cached_tokens"], r["output_tokens"])
+            total_cost += cost or 0.0
+            avg_latency = r["latency_ms_sum"] / r["calls"] if r["calls"] else 0
+            cost_text = f"${cost:.4f}" if cost is not None else "цена неизвестна"
+            lines.append(
+                f"{r['model']}: {r['calls']} вызовов, "
+                f"in {r['input_tokens']} (кэш {r['cached_tokens']}), out {r['output_tokens']}, "
+                f"file_search {r['file_search_calls']}, {avg_latency:.0f} мс в среднем, {cost_text}"
+            )
+        lines.append(f"Итого: ${total_cost:.4f}\n")
+
+    hourly = await db.get_hourly_usage(datetime.now(timezone.utc) - timedelta(hours=24))
+    if hourly:
+        calls = sum(r["calls"] for r in hourly)
+        peak = max(hourly, key=lambda r: r["calls"])
+        lines.append(
+            f"За 24 часа: {calls} вызовов, пик {peak['hour'].strftime('%H:00')} UTC — {peak['calls']} вызовов\n"
+        )
+
+    top = await db.get_top_usage_users(today, limit=10)
+    if top:
+        lines.append("<b>Топ клиентов сегодня</b>")
+        for r in top:
+            lines.append(f"{r['user_telegram_id']}: {r['tokens']} токенов, {r['calls']} вызовов")
+
+    if USER_DAILY_TOKEN_QUOTA > 0:
+        lines.append(f"\nДневной лимит на клиента: {USER_DAILY_TOKEN_QUOTA} токенов")
+
+    await message.answer("\n".join(lines))